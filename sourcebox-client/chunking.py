@@ -0,0 +1,85 @@
+#
+# Chunking
+# content-defined chunking of large files
+#
+# A large file is cut into chunks at positions that depend on its content,
+# not on offsets: a chunk ends after an anchor byte (a newline or one of two
+# rarer bytes, not repeated) if the crc32 of the WINDOW bytes before it has
+# its low MASK_BITS bits clear, but never before MIN_SIZE and at the latest
+# at MAX_SIZE. After an insertion or deletion the chunk boundaries behind it
+# are found again, so only the chunks around an edit change. The anchors are
+# found by the regular expression engine, the file is mapped into memory,
+# so chunking is not much slower than hashing.
+#
+# Every chunk is identified by the sha256 digest of its content. A file is
+# sent as its list of chunk digests (see protocol.OP_CHUNKS), followed by
+# the chunks the receiver does not have yet.
+#
+# This module is used by both the client and the server. The copies in
+# sourcebox-client and sourcebox-server have to be kept identical.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import hashlib
+import mmap
+import re
+import zlib
+
+# smallest and largest chunk (the last chunk of a file may be smaller)
+MIN_SIZE = 256 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+# bytes before an anchor that decide if a chunk ends there
+WINDOW = 48
+# one in 2 ** MASK_BITS anchors ends a chunk
+MASK_BITS = 14
+
+_MASK = (1 << MASK_BITS) - 1
+# the anchor bytes, runs of them count once (e.g. empty lines)
+_ANCHOR = re.compile(r'([\n\x9c\xe5])(?!\1)')
+
+
+# returns the length of the chunk starting at an offset
+# @param data the content (a string or an mmap)
+# @param start the offset of the chunk
+# @returns the length of the chunk
+def cut(data, start=0):
+    length = len(data) - start
+    if length <= MIN_SIZE:
+        return length
+    end = start + min(length, MAX_SIZE)
+    for match in _ANCHOR.finditer(data, start + MIN_SIZE, end):
+        pos = match.start()
+        if not zlib.crc32(data[pos - WINDOW:pos + 1]) & _MASK:
+            return pos + 1 - start
+    return end - start
+
+
+# cuts a content into chunks
+# @param data the content (a string or an mmap)
+# @returns a list of (offset, size, hex digest)
+def chunk_content(data):
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        size = cut(data, offset)
+        chunks.append((offset, size, hashlib.sha256(data[offset:offset + size]).hexdigest()))
+        offset += size
+    return chunks
+
+
+# cuts a file into chunks
+# @param path the file
+# @returns a list of (offset, size, hex digest)
+# @throws IOError, OSError if the file cannot be read
+def chunk_file(path):
+    with open(path, 'rb') as open_file:
+        try:
+            data = mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error, EnvironmentError):
+            # e.g. an empty file
+            return chunk_content(open_file.read())
+        try:
+            return chunk_content(data)
+        finally:
+            data.close()
@@ -8,28 +8,42 @@
 import socket
 import threading
 import logging
-from urllib import pathname2url, url2pathname 
+import protocol
 
 class Client_Communication_Controller(object):
 
     # command constants
-    COMMAND_SENDCREATEFILE = 'CREATE_FILE'
-    COMMAND_SENDLOCKFILE = 'LOCK'
-    COMMAND_SENDUNLOCKFILE = 'UNLOCK'
-    COMMAND_SENDDELETEFILE = 'REMOVE'
-    COMMAND_SENDMODIFYFILE = 'MODIFY'
-    COMMAND_MOVE = 'MOVE'
-    COMMAND_SENDCREATEDIR = 'CREATE_DIR'
-    COMMAND_DELETEDIR = 'DELETE_DIR'
-    COMMAND_INIT = 'INIT'
-    COMMAND_ACK = "OK\n"
+    COMMAND_SENDCREATEFILE = protocol.OP_CREATE_FILE
+    COMMAND_SENDLOCKFILE = protocol.OP_LOCK
+    COMMAND_SENDUNLOCKFILE = protocol.OP_UNLOCK
+    COMMAND_SENDDELETEFILE = protocol.OP_REMOVE
+    COMMAND_SENDMODIFYFILE = protocol.OP_MODIFY
+    COMMAND_MOVE = protocol.OP_MOVE
+    COMMAND_SENDCREATEDIR = protocol.OP_CREATE_DIR
+    COMMAND_DELETEDIR = protocol.OP_DELETE_DIR
+    COMMAND_INIT = protocol.OP_INIT
+    COMMAND_HAVE = protocol.OP_HAVE
+    COMMAND_MANIFEST = protocol.OP_MANIFEST
+    COMMAND_CHUNKS = protocol.OP_CHUNKS
+    COMMAND_CHUNK = protocol.OP_CHUNK
+    COMMAND_ACK = protocol.OP_OK
+
+    # seconds to wait for the answer of the server, after the request was sent
+    TIMEOUT = 8.0
+    # seconds to collect operations before they are sent as one BATCH
+    BATCH_DELAY = 0.05
+    # bytes per second the server stores a file it puts together from chunks
+    # or from a content it has (at least)
+    ASSEMBLY_RATE = 16 * 1024 * 1024
 
     # Constructor
     # @param ip the ip of the server to connect to
     # @param port the port of the server
     # @param computer_name name of the client
+    # @param window maximum number of requests in flight
+    # @param compression if True, offer the server to compress file contents
     # @author Martin Zellner
-    def __init__(self, parent, ip, port, computer_name):
+    def __init__(self, parent, ip, port, computer_name, window=32, compression=True):
 
         # catch logging object
         self.log = logging.getLogger("client")
@@ -43,19 +57,39 @@ class Client_Communication_Controller(object):
         # with the server
         self.controller_socket = self._open_socket(ip, port)
 
+        # requests sent to the server that are not answered yet
+        self.requests = protocol.Request_Tracker(window, self.TIMEOUT)
+        # serializes the frames written by different threads
+        self.send_lock = threading.Lock()
+
+        # operations waiting to be sent as one BATCH (see _queue_operation)
+        self.batch = []
+        self.batch_size = 0
+        self.batch_lock = threading.RLock()
+        self.batch_timer = None
+
+        # decodes the frames of the incoming byte stream (large contents are
+        # spooled to a file outside the box)
+        self.decoder = protocol.Frame_Decoder(spool_dir=parent.fs.spoolPath)
+
         # Inits the connection
-        self._init_connection()
+        self.compress, manifest = self._init_connection(compression)
 
         # Starts a thread listening for server events
         threading_queue = []
         self.command_listener_thread = Command_Recieve_Handler(
-            'Communication_Controller Thread for listening', self.controller_socket, self.parent)
+            'Communication_Controller Thread for listening', self.controller_socket, self.parent,
+            self.requests, self.send_lock, self.decoder)
         # daemonize thread. This makes sure that it does not prevent the Client
         # Prozess from terminating (e.g. on a Keyboard interrupt)
         self.command_listener_thread.daemon = True
         threading_queue.append(self.command_listener_thread)
         self.command_listener_thread.start()
 
+        # the server sends only what is missing in the box
+        if manifest:
+            self.send_manifest()
+
         self.log.info('Client Created Communication_Controller')
 
     # Deconstructor
@@ -72,50 +106,242 @@ class Client_Communication_Controller(object):
 
     # Initialises the connection and identifies the client to the server
     # @author Martin Zellner
-    def _init_connection(self):
-        self.controller_socket.send(
-            self.COMMAND_INIT + ' ' + self.computer_name)
+    # @param compression if True, offer the server to compress file contents
+    # @returns (True if the server agreed to compress file contents,
+    #           True if the server wants a MANIFEST)
+    # @throws IOError if the server does not answer the INIT
+    def _init_connection(self, compression):
+        flags = protocol.FLAG_MANIFEST
+        if compression:
+            flags |= protocol.FLAG_COMPRESSED
+        protocol.send_frame(
+            self.controller_socket, self.COMMAND_INIT, payload=self.computer_name, flags=flags)
+
+        self.controller_socket.settimeout(self.TIMEOUT)
+        try:
+            answer = protocol.read_frame(self.controller_socket, self.decoder)
+        finally:
+            self.controller_socket.settimeout(None)
+        if answer is None or answer.opcode != self.COMMAND_ACK:
+            raise IOError('The server did not accept the connection.')
+        compress = bool(answer.flags & protocol.FLAG_COMPRESSED)
+        if compress:
+            self.log.info('File contents are compressed')
+        return compress, bool(answer.flags & protocol.FLAG_MANIFEST)
+
+    # Sends the list of everything in the box to the server, which answers
+    # with the files that are missing or different
+    def send_manifest(self):
+        entries = self.parent.fs.manifest()
+        self.log.info('Sending MANIFEST of ' + str(len(entries)) + ' entries')
+
+        def manifest_done(request):
+            if not request.ok:
+                self.log.warning('Initial sync failed: ' + str(request.reason))
+            # the changes of the client follow what the server sent
+            self.parent.fs.syncOfflineChanges()
+
+        try:
+            self._send_request(self.COMMAND_MANIFEST, '', protocol.encode_manifest(entries),
+                               wait=False, callback=manifest_done)
+        except IOError, err:
+            self.log.error(str(err))
 
     # Sends a command to the server that creates a file with content
     # @author Paul
     # @param filePath of the new file related to sourceBox, size, content
+    # @param wait if False, return as soon as the command is sent
+    # @param source the file to stream the content from (instead of content)
     # @return boolean
-    def send_create_file(self, filePath, size, content):
-        return self._send_command_with_content(self.COMMAND_SENDCREATEFILE, filePath, size, content)
+    def send_create_file(self, filePath, size, content='', wait=True, source=None):
+        return self._send_command_with_content(self.COMMAND_SENDCREATEFILE, filePath, size, content, wait, source)
 
     # Sends a command to the server that modiry a file with new content
     # @author Paul
     # @param filePath of the new file related to sourceBox, size, content
+    # @param wait if False, return as soon as the command is sent
+    # @param source the file to stream the content from (instead of content)
+    # @return boolean
+    def send_modify_file(self, filePath, size, content='', wait=True, source=None):
+        return self._send_command_with_content(self.COMMAND_SENDMODIFYFILE, filePath, size, content, wait, source)
+
+    # Sends a modification as a delta against the version the server has
+    # Does not report errors, the caller sends the whole file instead.
+    # @param filePath of the file related to sourceBox
+    # @param patch the delta
+    # @return boolean
+    def send_modify_delta(self, filePath, patch):
+        try:
+            self._send_request(self.COMMAND_SENDMODIFYFILE, filePath, patch, flags=protocol.FLAG_DELTA)
+            return True
+        except IOError, err:
+            self.log.debug('Server rejected the delta for ' + filePath + ': ' + str(err))
+            return False
+
+    # Announces the digest of a content before it is sent
+    # Does not report errors, the caller sends the content instead.
+    # @param filePath of the file related to sourceBox
+    # @param command COMMAND_SENDCREATEFILE or COMMAND_SENDMODIFYFILE
+    # @param digest the hex digest of the content
+    # @param size the size of the content (the server stores it before it answers)
+    # @return True if the server had the content (nothing has to be sent)
+    def send_have(self, filePath, command, digest, size=0):
+        try:
+            self._send_request(self.COMMAND_HAVE, filePath, protocol.encode_have(command, digest),
+                               timeout=self.TIMEOUT + float(size) / self.ASSEMBLY_RATE)
+            return True
+        except IOError, err:
+            self.log.debug('Server needs the content of ' + filePath + ': ' + str(err))
+            return False
+
+    # Sends the chunk list of a large file
+    # Does not report errors, the caller sends the whole file instead.
+    # @param filePath of the file related to sourceBox
+    # @param command COMMAND_SENDCREATEFILE or COMMAND_SENDMODIFYFILE
+    # @param size the size of the file
+    # @param digests the hex digests of the chunks
+    # @return the indexes of the chunks the server needs ([] if the file is
+    #         created or modified), None if it failed
+    def send_chunks(self, filePath, command, size, digests):
+        # the server puts the file together before it answers
+        timeout = self.TIMEOUT + float(size) / self.ASSEMBLY_RATE
+        try:
+            request = self._send_request(self.COMMAND_CHUNKS, filePath,
+                                         protocol.encode_chunks(command, size, digests),
+                                         False, callback=lambda request: None, timeout=timeout)
+            try:
+                request.wait(timeout)
+            except IOError:
+                if request.answer is not None and request.answer.opcode == protocol.OP_NEED:
+                    return protocol.decode_missing(request.answer.payload)
+                self.requests.cancel(request, 'Did not recieve a response from the server.')
+                raise
+            return []
+        except (IOError, protocol.Protocol_Error), err:
+            self.log.debug('Could not send the chunks of ' + filePath + ': ' + str(err))
+            return None
+
+    # Sends a chunk of a large file (without waiting for the answer, a chunk
+    # that did not arrive is missing on the next send_chunks)
+    # @param filePath of the file related to sourceBox
+    # @param content the content of the chunk
     # @return boolean
-    def send_modify_file(self, filePath, size, content):
-        return self._send_command_with_content(self.COMMAND_SENDMODIFYFILE, filePath, size, content)
+    def send_chunk(self, filePath, content):
+        def chunk_done(request):
+            if not request.ok:
+                self.log.debug('Server did not store a chunk of ' + filePath + ': ' + str(request.reason))
+        try:
+            self._send_request(self.COMMAND_CHUNK, filePath, content, False, callback=chunk_done)
+            return True
+        except IOError, err:
+            self.log.debug('Could not send a chunk of ' + filePath + ': ' + str(err))
+            return False
+
+    # Sends a request to the server
+    # Blocks while the window of requests in flight is full.
+    # @throws IOError if a timeout occurs or the server answers with an error (only if wait is True)
+    # @param command the command
+    # @param file_path path to the file
+    # @param payload the payload of the frame
+    # @param wait if True, wait for the answer of the server
+    # @param source a file whose content is streamed as payload (instead of payload)
+    # @param flags the flags of the frame
+    # @param callback called with the Pending_Request when it is done (only if wait is False)
+    # @param timeout seconds to wait for the answer (None: TIMEOUT)
+    # @returns the Pending_Request
+    def _send_request(self, command, file_path, payload='', wait=True, source=None, flags=0, callback=None,
+                      timeout=None):
+        # queued operations have to reach the server first
+        with self.batch_lock:
+            if self.batch:
+                self.flush_batch()
+
+        if wait:
+            request = self.requests.register(command, file_path, timeout=timeout)
+        else:
+            request = self.requests.register(
+                command, file_path, callback or self._request_done, timeout=timeout)
+        if source is None and self.compress:
+            payload, flags = protocol.compress_payload(command, payload, flags)
+        try:
+            with self.send_lock:
+                if source is not None:
+                    protocol.send_file_frame(
+                        self.controller_socket, command, file_path, source, flags, request.seq, self.compress)
+                else:
+                    protocol.send_frame(self.controller_socket, command, file_path, payload, flags, request.seq)
+            # the timeout starts with the last byte, not before a large content
+            request.sent()
+        except (socket.error, IOError), err:
+            self.requests.cancel(request, 'Could not send to the server: ' + str(err))
+
+        if wait:
+            try:
+                request.wait(timeout or self.TIMEOUT)
+            except IOError:
+                self.requests.cancel(request, 'Did not recieve a response from the server.')
+                raise
+        return request
+
+    # queues an operation, it is sent with the following ones in one BATCH
+    # @param command the command (one of protocol.BATCH_OPCODES)
+    # @param file_path path to the file
+    # @param payload the payload
+    # @returns True
+    def _queue_operation(self, command, file_path, payload=''):
+        with self.batch_lock:
+            self.batch.append(protocol.Frame(command, path=file_path, payload=payload))
+            self.batch_size += protocol.HEADER.size + len(file_path) + len(payload)
+            if self.batch_size >= protocol.BATCH_MAX_SIZE:
+                self.flush_batch()
+            elif self.batch_timer is None:
+                self.batch_timer = threading.Timer(self.BATCH_DELAY, self.flush_batch)
+                self.batch_timer.daemon = True
+                self.batch_timer.start()
+        return True
+
+    # sends the queued operations (a single one on its own, more as BATCH)
+    def flush_batch(self):
+        with self.batch_lock:
+            if self.batch_timer is not None:
+                self.batch_timer.cancel()
+                self.batch_timer = None
+            entries = self.batch
+            self.batch = []
+            self.batch_size = 0
+            if len(entries) == 1:
+                self._send_request(entries[0].opcode, entries[0].path, entries[0].payload, False)
+            elif entries:
+                self.log.debug('Sending BATCH of ' + str(len(entries)) + ' operations')
+                self._send_request(protocol.OP_BATCH, '', protocol.encode_batch(entries), False)
+
+    # called when a request that nobody waits for is done
+    # @param request the Pending_Request
+    def _request_done(self, request):
+        if not request.ok:
+            self.gui.errorBox(
+                'Error', '[ERROR] ' + str(request.reason))
+            self.log.error(str(request.reason))
 
     # Sends a command to the server (without content)
     # @throws IOError if a timeout occurs
     # @author Martin Zellner
     # @param command the command
     # @param file_path path to the file
+    # @param wait if False, return as soon as the command is sent
     # @returns boolean
-    def _send_command(self, command, file_path):
+    def _send_command(self, command, file_path, wait=True):
         try:
-            # create message
-            message = command + ' ' + pathname2url(file_path)
-            # send message
-            self.controller_socket.send(message)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.command_listener_thread.ok.wait(8.0)
-            self.command_listener_thread.ok.clear()
-            if not status:
-                raise IOError('Did not recieve a response from the server.')
+            if not wait and command in protocol.BATCH_OPCODES:
+                return self._queue_operation(command, file_path)
+            self._send_request(command, file_path, wait=wait)
 
             # if no error was raised
             return True
-        except IOError:
+        except IOError, err:
             self.gui.errorBox(
-                'Error', '[ERROR] Timeout: Did not recieve a response from the server.')
-            self.log.error(
-                'Timeout: Did not recieve a response from the server.')
+                'Error', '[ERROR] ' + str(err))
+            self.log.error(str(err))
 
     # Sends a command to the server (with content)
     # @throws IOError if a timeout occurs
@@ -123,36 +349,24 @@ class Client_Communication_Controller(object):
     # @param command the command
     # @param file_path path to the file
     # @param content the content of the file
+    # @param wait if False, return as soon as the command is sent
+    # @param source the file to stream the content from (instead of content)
     # @returns boolean
-    def _send_command_with_content(self, command, filePath, size, content):
+    def _send_command_with_content(self, command, filePath, size, content, wait=True, source=None):
         try:
-            # create message
-            message = command + ' ' + str(size) + ' ' + pathname2url(filePath)
-
-            # send message
-            self.controller_socket.sendall(message)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.command_listener_thread.ok.wait(8.0)
-            self.command_listener_thread.ok.clear()
-            if not status:
-                raise IOError('Did not recieve a response from the server.')
-
-            # Send the content
-            self.controller_socket.send(content)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.command_listener_thread.ok.wait(8.0)
-            self.command_listener_thread.ok.clear()
-            if not status:
-                raise IOError('Did not recieve a response from the server.')
+            # small files are collected in a BATCH
+            if not wait and command in protocol.BATCH_OPCODES and size < protocol.BATCH_FILE_SIZE:
+                if source is not None:
+                    with open(source, 'rb') as source_file:
+                        content = source_file.read()
+                return self._queue_operation(command, filePath, content)
+            self._send_request(command, filePath, content, wait, source)
 
             return True
-        except IOError:
+        except IOError, err:
             self.gui.errorBox(
-                'Error', '[ERROR] Timeout: Did not recieve a response from the server.')
-            self.log.error(
-                'Timeout: Did not recieve a response from the server.')
+                'Error', '[ERROR] ' + str(err))
+            self.log.error(str(err))
 
     # Sends a lock command to the server
     # @author Paul
@@ -172,46 +386,41 @@ class Client_Communication_Controller(object):
     # @author Paul
     # @param file_path path of the file related to sourceBox root
     # @returns boolean
-    def send_delete_file(self, file_path):
-        return self._send_command(self.COMMAND_SENDDELETEFILE, file_path)
+    def send_delete_file(self, file_path, wait=True):
+        return self._send_command(self.COMMAND_SENDDELETEFILE, file_path, wait)
 
     # Sends a create diractory command to the server
     # @author Paul
     # @param file_path path of the dir related to sourceBox root
     # @returns boolean
-    def send_create_dir(self, path):
-        return self._send_command(self.COMMAND_SENDCREATEDIR, path)
+    def send_create_dir(self, path, wait=True):
+        return self._send_command(self.COMMAND_SENDCREATEDIR, path, wait)
 
     # Sends a delete dir command to the server
     # @author Martin
     # @param file_path path of the dir related to sourceBox root
     # @returns boolean
-    def send_delete_dir(self, path):
-        return self._send_command(self.COMMAND_DELETEDIR, path)
+    def send_delete_dir(self, path, wait=True):
+        return self._send_command(self.COMMAND_DELETEDIR, path, wait)
 
     # Sends a move file command to the server
     # @author Martin
     # @param old_path path of the file
     # @param new_path new path of the file
+    # @param wait if False, return as soon as the command is queued
     # @returns a boolean
     # @throws IOError if a timeout occurs
-    def send_move(self, src_path, dest_path):
+    def send_move(self, src_path, dest_path, wait=True):
         try:
-            mess = self.COMMAND_MOVE + ' ' + pathname2url(src_path) + ' '  + pathname2url(dest_path)
-            self.controller_socket.send(mess)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.command_listener_thread.ok.wait(8.0)
-            self.command_listener_thread.ok.clear()
-            if not status:
-                raise IOError('Did not recieve a response from the server.')
+            if not wait:
+                return self._queue_operation(self.COMMAND_MOVE, src_path, protocol.encode_path(dest_path))
+            self._send_request(self.COMMAND_MOVE, src_path, protocol.encode_path(dest_path))
 
             return True
-        except IOError:
+        except IOError, err:
             self.gui.errorBox(
-                'Error', 'Timeout: Did not recieve a response from the server.')
-            self.log.error(
-                'Timeout: Did not recieve a response from the server.')
+                'Error', str(err))
+            self.log.error(str(err))
 
     # Opens a socket
     # @param ip the ip of the server to connect to
@@ -236,32 +445,33 @@ class Client_Communication_Controller(object):
     # @param sock the socket to close
     def _close_socket(self, sock):
 
-        sock.send('CLOSE')
         self.log.debug('sending close')
-        # Wait for the recieve thread to send us a ok Event
-        status = self.command_listener_thread.ok.wait(8.0)
-        self.command_listener_thread.ok.clear()
-        if not status:
-            raise IOError('Did not recieve a response from the server.')
+        self._send_request(protocol.OP_CLOSE, '')
 
+        self.requests.close()
         sock.close()
         self.log.debug('Connection closed.')
 
 
-# Thread that listens for commands on the incoming connection. If it recieves a "OK\n" it sends a 'ok'- Event
+# Thread that listens for commands on the incoming connection. If it recieves a OK frame it sends a 'ok'- Event
 # @author Martin Zellner
 class Command_Recieve_Handler(threading.Thread):
-    COMMAND_ACK = "OK\n"
-    COMMAND_CREATE = "CREATE"
-    COMMAND_DELETEFILE = "REMOVE"
-    COMMAND_MODIFYFILE = "MODIFY"
-    COMMAND_LOCKFILE = "LOCK"
-    COMMAND_UNLOCKFILE = "UNLOCK"
-    COMMAND_DELETE_DIR = "DELETE_DIR"
-    COMMAND_CREATE_DIR = "CREATE_DIR"
-    COMMAND_MOVE = "MOVE"
-
-    def __init__(self, thread_name, open_socket, parent):
+    COMMAND_ACK = protocol.OP_OK
+    COMMAND_ERROR = protocol.OP_ERROR
+    COMMAND_CREATE = protocol.OP_CREATE_FILE
+    COMMAND_DELETEFILE = protocol.OP_REMOVE
+    COMMAND_MODIFYFILE = protocol.OP_MODIFY
+    COMMAND_LOCKFILE = protocol.OP_LOCK
+    COMMAND_UNLOCKFILE = protocol.OP_UNLOCK
+    COMMAND_DELETE_DIR = protocol.OP_DELETE_DIR
+    COMMAND_CREATE_DIR = protocol.OP_CREATE_DIR
+    COMMAND_MOVE = protocol.OP_MOVE
+    COMMAND_CLOSE = protocol.OP_CLOSE
+    COMMAND_BATCH = protocol.OP_BATCH
+    COMMAND_HAVE = protocol.OP_HAVE
+    COMMAND_NEED = protocol.OP_NEED
+
+    def __init__(self, thread_name, open_socket, parent, requests, send_lock, decoder):
         threading.Thread.__init__(self)
 
         # Write function variables to instance variables of the handler class
@@ -270,9 +480,13 @@ class Command_Recieve_Handler(threading.Thread):
         self.parent = parent
         self.log = logging.getLogger("client")
 
-        # Create 'ok' Event
-        self.ok = threading.Event()
-        self.error = threading.Event()
+        # the Frame_Decoder of the connection (may already hold frames sent
+        # after the answer to INIT)
+        self.decoder = decoder
+
+        # the Request_Tracker of the controller (answers are matched to their requests)
+        self.requests = requests
+        self.send_lock = send_lock
 
         self._stop = False
 
@@ -284,110 +498,136 @@ class Command_Recieve_Handler(threading.Thread):
 
         # endless loop to recieve commands
         while not self._stop:
-            # split the recieved data
             try:
-                data = self.open_socket.recv(1024).split(' ')
+                if not self.decoder.read_from(self.open_socket):
+                    self.log.warning('Server closed the connection')
+                    break
+
+                # one recv may contain several frames (or only part of one)
+                for frame in self.decoder:
+                    self._handle_frame(frame)
+            except protocol.Protocol_Error, err:
+                self.log.error('Protocol error: ' + str(err))
+                break
             except Exception, err:
                 self.log.error(str(err))
+                break
+
+        # nobody will answer the requests in flight anymore
+        self.requests.close()
+        self.decoder.close()
+
+    # acknowledges a command of the server
+    # @param frame the frame to acknowledge
+    def _send_ok(self, frame):
+        with self.send_lock:
+            protocol.send_frame(self.open_socket, self.COMMAND_ACK, seq=frame.seq)
+
+    # rejects a command of the server
+    # @param frame the frame to reject
+    # @param reason the error message
+    def _send_error(self, frame, reason):
+        with self.send_lock:
+            protocol.send_frame(self.open_socket, self.COMMAND_ERROR, payload=reason, seq=frame.seq)
+
+    # asks the server for the content of a HAVE command
+    # @param frame the frame to answer
+    def _send_need(self, frame):
+        with self.send_lock:
+            protocol.send_frame(self.open_socket, self.COMMAND_NEED, seq=frame.seq)
+
+    # handles a single frame sent by the server
+    # @param frame the frame
+    def _handle_frame(self, frame):
+        command = frame.opcode
+
+        if command in protocol.ANSWER_OPCODES:
+            # hand the answer to the request waiting for it
+            if self.requests.complete(frame) is None:
+                self.log.warning('Recieved answer to unknown request ' + repr(frame))
+        elif command == self.COMMAND_MODIFYFILE and frame.flags & protocol.FLAG_DELTA:
+            self.log.debug('Recieved Modify Command ' + repr(frame))
+            # the server sends the whole file if the delta does not fit
+            if self.parent.fs.writeFile(frame.path, '', patch=frame.payload):
+                self._send_ok(frame)
+            else:
+                self._send_error(frame, 'Delta does not fit')
+        elif command == self.COMMAND_HAVE:
+            self.log.debug('Recieved Have Command ' + repr(frame))
+            try:
+                opcode, digest = protocol.decode_have(frame.payload)
+            except protocol.Protocol_Error, err:
+                self._send_error(frame, str(err))
+                return
+            # the content is only sent if no local file has it
+            if self.parent.fs.copyContent(frame.path, digest, opcode == self.COMMAND_CREATE):
+                self._send_ok(frame)
+            else:
+                self._send_need(frame)
+        elif command == self.COMMAND_BATCH:
+            self.log.debug('Recieved Batch Command ' + repr(frame))
+            try:
+                entries = protocol.decode_batch(frame.payload)
+            except protocol.Protocol_Error, err:
+                self._send_error(frame, str(err))
+                return
+            self._send_ok(frame)
+            for entry in entries:
+                self._apply(entry)
+        elif command == self.COMMAND_CLOSE:
+            try:
+                self._send_ok(frame)
+                self.open_socket.close()
+                self._stop = True
+            except Exception, err:
+                self.log.error(str(err))
+                self.parent.gui.changeStatus()
+        else:
+            self._send_ok(frame)
+            self._apply(frame)
 
-            if data[0] == self.COMMAND_ACK:  # If a OK command was recieved
-                # Fire the 'ok' Event
-                self.ok.set()
-            elif data[0] == 'ALREADY_LOCKED':
-                self.error.set('ALREADY_LOCKED')
-            elif data[0] == self.COMMAND_CREATE:  # if a create command was recieved (when other clients changed the folder)
-                self.log.debug('Recieved Create Command' + str(data))
-                self.open_socket.send('OK\n')
-
-                file_size = int(data[1])
-                file_path = url2pathname(data[2])
-                #self.log.debug(self.parent.fs.ignoreModify)
-                # read data from the socket
-                if not file_size == 0:
-                    content = ''
-                    while file_size > len(content):
-                        data = self.open_socket.recv(1024)
-                        if not data:
-                            break
-                        content += data
-
-                    self.open_socket.send('OK\n')
-                    self.parent.fs.createFile(file_path, content)
-                else:
-                    self.parent.fs.createFile(file_path, '')
-
-
-            elif data[0] == self.COMMAND_DELETEFILE:
-                self.log.debug('Recieved Delete Command' + str(data))
-
-                file_path = url2pathname(data[1])
-                self.open_socket.send('OK\n')
-
-                self.parent.fs.deleteFile(file_path)
-
-            elif data[0] == self.COMMAND_MODIFYFILE:
-                self.log.debug('Recieved Modify Command' + str(data))
-                self.open_socket.send('OK\n')
-
-                file_size = int(data[1])
-                file_path = url2pathname(data[2])
-
-                # read data from the socket
-                if not file_size == 0:
-                    content = ''
-                    while file_size > len(content):
-                        data = self.open_socket.recv(1024)
-                        if not data:
-                            break
-                        content += data
-                    self.open_socket.send('OK\n')
-                    self.parent.fs.writeFile(file_path, content)
-
-            elif data[0] == self.COMMAND_LOCKFILE:
-                self.log.debug('Recieved Lock Command' + str(data))
-
-                file_path = url2pathname(data[1])
-                self.open_socket.send('OK\n')
+    # applies a command of the server to the box
+    # @param frame the frame
+    def _apply(self, frame):
+        command = frame.opcode
+        file_path = frame.path
 
-                self.parent.fs.lockFile(file_path)
+        if command == self.COMMAND_CREATE:  # if a create command was recieved (when other clients changed the folder)
+            self.log.debug('Recieved Create Command ' + repr(frame))
+            self.parent.fs.createFile(file_path, frame.payload, frame.payload_file)
 
-            elif data[0] == self.COMMAND_UNLOCKFILE:
-                self.log.debug('Recieved Unlock Command' + str(data))
+        elif command == self.COMMAND_DELETEFILE:
+            self.log.debug('Recieved Delete Command ' + repr(frame))
 
-                file_path = url2pathname(data[1])
-                self.open_socket.send('OK\n')
+            self.parent.fs.deleteFile(file_path)
 
-                self.parent.fs.unlockFile(file_path)
-            elif data[0] == self.COMMAND_CREATE_DIR:
-                self.log.debug('Recieved COMMAND_CREATE_DIR' + str(data))
+        elif command == self.COMMAND_MODIFYFILE:
+            self.log.debug('Recieved Modify Command ' + repr(frame))
+            self.parent.fs.writeFile(file_path, frame.payload, frame.payload_file)
 
-                file_path = url2pathname(data[1])
-                self.open_socket.send('OK\n')
+        elif command == self.COMMAND_LOCKFILE:
+            self.log.debug('Recieved Lock Command ' + repr(frame))
 
-                self.parent.fs.createDir(file_path)
-            elif data[0] == self.COMMAND_DELETE_DIR:
-                self.log.debug('Recieved COMMAND_DELETE_DIR' + str(data))
+            self.parent.fs.lockFile(file_path)
 
-                file_path = url2pathname(data[1])
-                self.open_socket.send('OK\n')
+        elif command == self.COMMAND_UNLOCKFILE:
+            self.log.debug('Recieved Unlock Command ' + repr(frame))
 
-                self.parent.fs.deleteDir(file_path)
-            elif data[0] == self.COMMAND_MOVE:
-                self.log.debug('Recieved COMMAND_MOVE' + str(data))
+            self.parent.fs.unlockFile(file_path)
+        elif command == self.COMMAND_CREATE_DIR:
+            self.log.debug('Recieved COMMAND_CREATE_DIR ' + repr(frame))
 
-                src_path = url2pathname(data[1])
-                dest_path = url2pathname(data[2])
+            self.parent.fs.createDir(file_path)
+        elif command == self.COMMAND_DELETE_DIR:
+            self.log.debug('Recieved COMMAND_DELETE_DIR ' + repr(frame))
 
-                self.open_socket.send('OK\n')
+            self.parent.fs.deleteDir(file_path)
+        elif command == self.COMMAND_MOVE:
+            self.log.debug('Recieved COMMAND_MOVE ' + repr(frame))
 
-                self.parent.fs.moveFileDir(src_path, dest_path)
+            src_path = file_path
+            dest_path = protocol.decode_path(frame.payload)
 
-            elif data[0] == 'CLOSE\n':
-                try:
-                    self.open_socket.send('OK\n')
-                    self.open_socket.close()
-                except Exception, err:
-                    self.log.error(str(err))
-                    self.parent.gui.changeStatus()
-            else:
-                self.log.debug('Command recieved' + str(data))
+            self.parent.fs.moveFileDir(src_path, dest_path)
+        else:
+            self.log.debug('Command recieved ' + repr(frame))
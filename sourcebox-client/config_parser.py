@@ -19,10 +19,45 @@ class Config_Parser(object):
 
 		self.boxPath = self.config.get('main', 'path')
 		self.clientName = self.config.get('main', 'name')
+		# when written files are on disk: 'none', 'fsync' (every file) or
+		# 'group' (many files together every group_commit_ms milliseconds)
+		self.durability = self._get('main', 'durability', 'group')
+		self.groupCommitMs = self._getint('main', 'group_commit_ms', 50)
+		# a changed file is synced when there was no event for it for
+		# event_quiet_ms, but at the latest event_max_latency_ms after the first
+		self.eventQuietMs = self._getint('main', 'event_quiet_ms', 500)
+		self.eventMaxLatencyMs = self._getint('main', 'event_max_latency_ms', 5000)
+		# number of processes hashing the files of the box at startup (0: one per CPU)
+		self.hashWorkers = self._getint('main', 'hash_workers', 0) or None
+		# the paths that are not synced, one gitignore-style pattern per line
+		# (see ignore_rules.py)
+		self.ignore = self._get('main', 'ignore', '.DS_Store')
 
 		self.serverHostname = self.config.get('server', 'host')
 		self.serverIP = self.config.get('server', 'ip')
 		self.serverPort = int(self.config.get('server', 'port'))
+		# maximum number of requests in flight (optional)
+		self.window = self._getint('server', 'window', 32)
+		# compress file contents if the server supports it (optional)
+		self.compression = self._getboolean('server', 'compression', True)
+
+	## reads an optional option
+	def _get(self, section, option, default):
+		if self.config.has_option(section, option):
+			return self.config.get(section, option)
+		return default
+
+	## reads an optional integer option
+	def _getint(self, section, option, default):
+		if self.config.has_option(section, option):
+			return self.config.getint(section, option)
+		return default
+
+	## reads an optional boolean option
+	def _getboolean(self, section, option, default):
+		if self.config.has_option(section, option):
+			return self.config.getboolean(section, option)
+		return default
 
 	def writeConfig(self, path, name, ip):
 		self.config.set('main', 'path', path)
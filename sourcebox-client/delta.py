@@ -0,0 +1,228 @@
+#
+# Delta
+# rsync-style delta encoding of file contents
+#
+# The receiver's version of a file (the basis) is described by a signature:
+# a weak rolling checksum (adler32) and a strong checksum (md5) per block.
+# The sender slides a window over its new version, rolls the weak checksum
+# one byte at a time and looks it up in the signature. Matching blocks are
+# sent as copy instructions, everything else as literal data. For a small
+# edit in a large file the delta is a few bytes plus the changed lines.
+#
+# Delta format (network byte order):
+#   'SBD1', block size (4B), md5 of the basis (16B), md5 of the result (16B),
+#   length of the result (8B), followed by instructions:
+#     COPY     1 (1B), first block (4B), number of blocks (4B)
+#     LITERAL  2 (1B), length (4B), data
+#
+# This module is used by both the client and the server. The copies in
+# sourcebox-client and sourcebox-server have to be kept identical.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import hashlib
+import struct
+import zlib
+
+# files larger than this are always sent completely
+MAX_SIZE = 64 * 1024 * 1024
+
+# smallest and largest block size
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 64 * 1024
+
+# modulus of adler32
+_ADLER = 65521
+
+_MAGIC = 'SBD1'
+_HEADER = struct.Struct('!4sI16s16sQ')
+_COPY = struct.Struct('!BII')
+_LITERAL = struct.Struct('!BI')
+_OP_COPY = 1
+_OP_LITERAL = 2
+
+
+# Raised if a delta does not fit the basis or is corrupt
+class Delta_Error(ValueError):
+    pass
+
+
+# Checksums of the blocks of a file version
+class Signature(object):
+
+    # Constructor
+    # @param block_size the block size
+    # @param length the length of the file
+    # @param digest the md5 digest of the whole file
+    # @param blocks list of (weak, strong) checksums, one per block
+    def __init__(self, block_size, length, digest, blocks):
+        self.block_size = block_size
+        self.length = length
+        self.digest = digest
+        self.blocks = blocks
+
+
+# chooses the block size for a file (about the square root of its length)
+# @param length the length of the file
+def block_size_for(length):
+    size = int(length ** 0.5) & ~1023
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+
+# weak checksum of a block
+def _weak(block):
+    return zlib.adler32(block) & 0xffffffff
+
+
+# rolls the weak checksum one byte forward
+# @param weak the checksum of the old window
+# @param out the byte leaving the window
+# @param new the byte entering the window
+# @param size the size of the window
+def _roll(weak, out, new, size):
+    a = weak & 0xffff
+    b = weak >> 16
+    a = (a - out + new) % _ADLER
+    b = (b - size * out + a - 1) % _ADLER
+    return (b << 16) | a
+
+
+# computes the signature of a file version
+# @param data the content
+# @param block_size the block size (chosen from the length if None)
+# @returns a Signature
+def signature(data, block_size=None):
+    if block_size is None:
+        block_size = block_size_for(len(data))
+    blocks = []
+    for offset in xrange(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        blocks.append((_weak(block), hashlib.md5(block).digest()))
+    return Signature(block_size, len(data), hashlib.md5(data).digest(), blocks)
+
+
+# computes the delta that turns the version described by a signature into data
+# @param sig the Signature of the basis
+# @param data the new content
+# @returns the encoded delta
+def compute(sig, data):
+    size = sig.block_size
+    length = len(data)
+    values = bytearray(data)
+
+    # weak checksum -> indexes of the full size blocks
+    table = {}
+    full_blocks = sig.length // size
+    for index in xrange(full_blocks):
+        table.setdefault(sig.blocks[index][0], []).append(index)
+
+    out = []
+    copy_start = copy_count = 0
+    literal_start = 0
+    pos = 0
+    weak = None
+    while pos + size <= length:
+        if weak is None:
+            weak = _weak(data[pos:pos + size])
+        index = None
+        candidates = table.get(weak)
+        if candidates is not None:
+            strong = hashlib.md5(data[pos:pos + size]).digest()
+            for candidate in candidates:
+                if sig.blocks[candidate][1] == strong:
+                    index = candidate
+                    break
+
+        if index is None:
+            # no match, slide the window by one byte
+            if pos + size < length:
+                weak = _roll(weak, values[pos], values[pos + size], size)
+            pos += 1
+            continue
+
+        if literal_start < pos:
+            if copy_count:
+                out.append(_COPY.pack(_OP_COPY, copy_start, copy_count))
+                copy_count = 0
+            _append_literal(out, data[literal_start:pos])
+        if copy_count and copy_start + copy_count == index:
+            copy_count += 1
+        else:
+            if copy_count:
+                out.append(_COPY.pack(_OP_COPY, copy_start, copy_count))
+            copy_start, copy_count = index, 1
+        pos += size
+        literal_start = pos
+        weak = None
+
+    # the last block of the basis may be shorter than the block size
+    tail = sig.length - full_blocks * size
+    tail_start = length - tail
+    if (tail and tail_start >= literal_start and
+            hashlib.md5(data[tail_start:]).digest() == sig.blocks[-1][1]):
+        if literal_start < tail_start:
+            if copy_count:
+                out.append(_COPY.pack(_OP_COPY, copy_start, copy_count))
+                copy_count = 0
+            _append_literal(out, data[literal_start:tail_start])
+        if copy_count and copy_start + copy_count == full_blocks:
+            copy_count += 1
+        else:
+            if copy_count:
+                out.append(_COPY.pack(_OP_COPY, copy_start, copy_count))
+            copy_start, copy_count = full_blocks, 1
+        literal_start = length
+
+    if copy_count:
+        out.append(_COPY.pack(_OP_COPY, copy_start, copy_count))
+    if literal_start < length:
+        _append_literal(out, data[literal_start:])
+
+    header = _HEADER.pack(_MAGIC, size, sig.digest, hashlib.md5(data).digest(), length)
+    return header + ''.join(out)
+
+
+# appends literal instructions
+def _append_literal(out, literal):
+    out.append(_LITERAL.pack(_OP_LITERAL, len(literal)))
+    out.append(literal)
+
+
+# applies a delta to the basis
+# @param basis the content the delta was computed against
+# @param patch the encoded delta
+# @returns the new content
+# @throws Delta_Error if the basis does not match or the delta is corrupt
+def apply(basis, patch):
+    if len(patch) < _HEADER.size:
+        raise Delta_Error('Delta too short')
+    magic, size, basis_digest, digest, length = _HEADER.unpack_from(patch)
+    if magic != _MAGIC:
+        raise Delta_Error('Not a delta')
+    if hashlib.md5(basis).digest() != basis_digest:
+        raise Delta_Error('Delta does not fit the local version')
+
+    pieces = []
+    pos = _HEADER.size
+    try:
+        while pos < len(patch):
+            op = ord(patch[pos])
+            if op == _OP_COPY:
+                op, first, count = _COPY.unpack_from(patch, pos)
+                pos += _COPY.size
+                pieces.append(basis[first * size:(first + count) * size])
+            elif op == _OP_LITERAL:
+                op, literal_length = _LITERAL.unpack_from(patch, pos)
+                pos += _LITERAL.size
+                pieces.append(patch[pos:pos + literal_length])
+                pos += literal_length
+            else:
+                raise Delta_Error('Unknown instruction ' + str(op))
+    except struct.error, err:
+        raise Delta_Error('Corrupt delta: ' + str(err))
+
+    data = ''.join(pieces)
+    if len(data) != length or hashlib.md5(data).digest() != digest:
+        raise Delta_Error('Delta result does not match')
+    return data
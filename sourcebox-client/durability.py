@@ -0,0 +1,161 @@
+#
+# Durability
+# atomic file writes with a selectable durability
+#
+# A file is never written in place: the new content goes to a temporary
+# file, which is renamed over the old one, so a crash leaves either the old
+# or the new content, never a truncated file. When the new content is on
+# disk depends on the mode:
+#
+#   none   no fsync, the operating system writes the file when it likes
+#   fsync  the temporary file is fsynced before the rename and the directory
+#          after it, the write returns when the file is on disk
+#   group  after the rename, the file and its directory are fsynced by one
+#          thread together with the other files written in the same
+#          interval; a crash loses at most the writes of the last interval
+#
+# The writer only does the fsyncs, the caller creates and renames the
+# temporary file (see write_temp, prepare and committed).
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import logging
+import os
+import tempfile
+import threading
+import time
+
+MODE_NONE = 'none'
+MODE_FSYNC = 'fsync'
+MODE_GROUP = 'group'
+MODES = (MODE_NONE, MODE_FSYNC, MODE_GROUP)
+
+
+class Durable_Writer(object):
+
+    # Constructor
+    # @param mode MODE_NONE, MODE_FSYNC or MODE_GROUP
+    # @param interval seconds between two group fsyncs
+    # @throws ValueError for an unknown mode
+    def __init__(self, mode=MODE_GROUP, interval=0.05):
+        if mode not in MODES:
+            raise ValueError('Unknown durability mode ' + repr(mode))
+        self.log = logging.getLogger(__name__)
+        self.mode = mode
+        self.interval = interval
+        self.fsyncs = 0
+        self.groups = 0
+        # files renamed since the last group fsync
+        self._pending = set()
+        # number of committed writes, and how many of them are on disk
+        self._written = 0
+        self._synced = 0
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = None
+        if mode == MODE_GROUP:
+            self._thread = threading.Thread(target=self._group_loop, name='Group fsync')
+            self._thread.daemon = True
+            self._thread.start()
+
+    # writes a content into a new temporary file (pass it to prepare before
+    # renaming it)
+    # @param content the content
+    # @param directory the directory of the temporary file (on the same
+    #        filesystem as the final path)
+    # @param prefix the prefix of the name of the temporary file
+    # @returns the path of the temporary file
+    def write_temp(self, content, directory, prefix='.sb-'):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temp = tempfile.mkstemp(prefix=prefix, dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(content)
+        except (IOError, OSError):
+            os.remove(temp)
+            raise
+        return temp
+
+    # makes a temporary file durable before it is renamed
+    # @param temp the temporary file
+    def prepare(self, temp):
+        if self.mode == MODE_FSYNC:
+            self._fsync(temp)
+
+    # makes a rename durable
+    # @param path the new path of the file
+    def committed(self, path):
+        if self.mode == MODE_FSYNC:
+            self._fsync(os.path.dirname(os.path.abspath(path)))
+        elif self.mode == MODE_GROUP:
+            with self._condition:
+                self._pending.add(os.path.abspath(path))
+                self._written += 1
+                self._condition.notify_all()
+
+    # waits until everything committed so far is on disk
+    def sync(self):
+        if self.mode != MODE_GROUP:
+            return
+        with self._condition:
+            target = self._written
+            while self._synced < target and self._thread.is_alive():
+                self._condition.wait(self.interval)
+
+    # writes the pending files and stops the group fsync thread
+    def close(self):
+        self.sync()
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    # returns the counters of the writer
+    # @returns a dictionary with mode, fsyncs and groups
+    def stats(self):
+        with self._condition:
+            return {'mode': self.mode, 'fsyncs': self.fsyncs, 'groups': self.groups,
+                    'pending': len(self._pending)}
+
+    # fsyncs a file or a directory
+    def _fsync(self, path):
+        try:
+            handle = os.open(path, os.O_RDONLY)
+        except OSError, err:
+            # e.g. directories on Windows, or the file is gone already
+            self.log.debug('Could not open ' + path + ' for fsync: ' + str(err))
+            return
+        try:
+            os.fsync(handle)
+            self.fsyncs += 1
+        except OSError, err:
+            self.log.debug('Could not fsync ' + path + ': ' + str(err))
+        finally:
+            os.close(handle)
+
+    # the group fsync thread: fsyncs the pending files and their directories
+    # once per interval
+    def _group_loop(self):
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+            # collect the writes of one interval
+            time.sleep(self.interval)
+            with self._condition:
+                paths = self._pending
+                self._pending = set()
+                written = self._written
+            for path in paths:
+                self._fsync(path)
+            for directory in set(os.path.dirname(path) for path in paths):
+                self._fsync(directory)
+            with self._condition:
+                self._synced = written
+                self.groups += 1
+                self._condition.notify_all()
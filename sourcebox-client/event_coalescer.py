@@ -0,0 +1,154 @@
+#
+# Event_Coalescer
+# collects the file system events of a file until it settled
+#
+# Editors write a file in several steps or save it every second, and every
+# step is an event. The events of a file are collected and merged into one:
+#
+#   create + modify    -> create
+#   modify + modify    -> modify
+#   delete + create    -> modify (the file was replaced)
+#   create + delete    -> nothing
+#   modify + delete    -> delete
+#
+# The merged event is handed on when there was no event for the file for
+# quiet_time seconds, but at the latest max_latency seconds after its first
+# event, so a file that is written all the time is still synced.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import logging
+import os
+import threading
+import time
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+
+# (pending event, new event) -> merged event (None: nothing left to do)
+_MERGE = {
+    (CREATED, CREATED): CREATED,
+    (CREATED, MODIFIED): CREATED,
+    (CREATED, DELETED): None,
+    (MODIFIED, CREATED): MODIFIED,
+    (MODIFIED, MODIFIED): MODIFIED,
+    (MODIFIED, DELETED): DELETED,
+    (DELETED, CREATED): MODIFIED,
+    (DELETED, MODIFIED): MODIFIED,
+    (DELETED, DELETED): DELETED,
+}
+
+
+class Event_Coalescer(object):
+
+    # Constructor
+    # @param emit called as emit(event, path) with the merged event of a file
+    # @param quiet_time seconds without events after which a file settled
+    # @param max_latency seconds after the first event the event is emitted at the latest
+    def __init__(self, emit, quiet_time=0.5, max_latency=5.0):
+        self.log = logging.getLogger("client")
+        self.emit = emit
+        self.quiet_time = quiet_time
+        self.max_latency = max(quiet_time, max_latency)
+        # path -> [event, time of the first event, time of the last event]
+        self._pending = {}
+        self._condition = threading.Condition()
+        # held while events are emitted, so flush keeps the order
+        self._emit_lock = threading.RLock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run_loop, name='Event coalescer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # adds an event of a file
+    # @param event CREATED, MODIFIED or DELETED
+    # @param path the path of the file
+    # @returns the event that was pending for the file before (None if none)
+    def add(self, event, path):
+        now = time.time()
+        with self._condition:
+            entry = self._pending.get(path)
+            if entry is None:
+                self._pending[path] = [event, now, now]
+                self._condition.notify()
+                return None
+            merged = _MERGE[(entry[0], event)]
+            if merged is None:
+                del self._pending[path]
+            else:
+                self._pending[path] = [merged, entry[1], now]
+            return entry[0]
+
+    # returns the pending event of a file
+    # @param path the path of the file
+    # @returns CREATED, MODIFIED, DELETED or None
+    def pending(self, path):
+        with self._condition:
+            entry = self._pending.get(path)
+        return entry and entry[0]
+
+    # forgets the pending events of a file or of everything in a directory
+    # (e.g. because the directory was deleted)
+    # @param path the path
+    # @returns the number of forgotten events
+    def discard(self, path):
+        with self._condition:
+            return len(self._pop_under(path))
+
+    # emits the pending events of a file or of everything in a directory now
+    # (e.g. before it is moved)
+    # @param path the path
+    def flush(self, path):
+        with self._emit_lock:
+            with self._condition:
+                entries = self._pop_under(path)
+            self._emit(entries)
+
+    # stops emitting, pending events are dropped
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    # removes the entries of a path and everything under it (the condition has to be held)
+    # @returns a list of (path, entry)
+    def _pop_under(self, path):
+        prefix = path + os.sep
+        return [(key, self._pending.pop(key)) for key in self._pending.keys()
+                if key == path or key.startswith(prefix)]
+
+    # emits events, the oldest first
+    # @param entries a list of (path, entry)
+    def _emit(self, entries):
+        entries.sort(key=lambda (path, entry): entry[1])
+        for path, (event, first, last) in entries:
+            try:
+                self.emit(event, path)
+            except Exception, err:
+                self.log.error('Could not handle %s event of %s: %s', event, path, err)
+
+    # the time the pending event of a file is emitted
+    def _settled(self, entry):
+        return min(entry[2] + self.quiet_time, entry[1] + self.max_latency)
+
+    # the thread: emits the events of the files that settled
+    def _run_loop(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.time()
+                    deadlines = [self._settled(entry) for entry in self._pending.itervalues()]
+                    if deadlines and min(deadlines) <= now:
+                        break
+                    self._condition.wait(min(deadlines) - now if deadlines else None)
+                if self._closed:
+                    return
+            with self._emit_lock:
+                with self._condition:
+                    now = time.time()
+                    due = [(path, self._pending.pop(path)) for path, entry in self._pending.items()
+                           if self._settled(entry) <= now]
+                self._emit(due)
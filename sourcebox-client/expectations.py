@@ -0,0 +1,109 @@
+#
+# Expectation_Table
+# the file system events the client causes itself
+#
+# When the client writes, deletes or moves a file for the server, the
+# observer reports it like a change of the user. Before doing it, the client
+# expects the events it will cause: the path, the kinds of events and, for
+# written files, the size and mtime of what was written. An event is only
+# suppressed if it matches an expectation, so a user changing the file right
+# after the client wrote it is still synced. Expectations expire after ttl
+# seconds (an event that never came) and are swept away.
+#
+# The kinds are the events of event_coalescer plus MOVED.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import threading
+import time
+
+MOVED = 'moved'
+
+
+class Expectation(object):
+
+    # Constructor
+    # @param kinds the kinds of events
+    # @param signature (size, mtime) of the written file (None: any)
+    # @param tree True if the events of everything under the path are expected, too
+    # @param deadline the time the expectation expires
+    def __init__(self, kinds, signature, tree, deadline):
+        self.kinds = frozenset(kinds)
+        self.signature = signature
+        self.tree = tree
+        self.deadline = deadline
+
+
+class Expectation_Table(object):
+
+    # Constructor
+    # @param ttl seconds an expectation is kept
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        # path -> Expectation
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.time() + ttl
+
+    # expects events of a path
+    # @param path the path
+    # @param kinds the kinds of events
+    # @param signature (size, mtime) of the written file (see signature)
+    # @param tree True if the events of everything under the path are expected, too
+    def expect(self, path, kinds, signature=None, tree=False):
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            self._entries[path] = Expectation(kinds, signature, tree, now + self.ttl)
+
+    # checks if an event was expected (and forgets an expectation that is
+    # used up: without a signature it matches only one event)
+    # @param path the path of the event
+    # @param kind the kind of the event
+    # @param signature (size, mtime) of the file now (None if it is not known)
+    # @returns True if the event was caused by the client
+    def match(self, path, kind, signature=None):
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            entry = self._entries.get(path)
+            if entry is not None and kind in entry.kinds and entry.deadline > now:
+                if entry.signature is None:
+                    if not entry.tree:
+                        del self._entries[path]
+                    return True
+                return entry.signature == signature
+            # everything in a deleted or moved directory
+            parent = os.path.dirname(path)
+            while parent:
+                entry = self._entries.get(parent)
+                if entry is not None and entry.tree and kind in entry.kinds and entry.deadline > now:
+                    return True
+                parent = os.path.dirname(parent)
+        return False
+
+    # number of expectations
+    def __len__(self):
+        return len(self._entries)
+
+    # removes the expired expectations (the lock has to be held)
+    def _sweep(self, now):
+        if now < self._next_sweep:
+            return
+        for path, entry in self._entries.items():
+            if entry.deadline <= now:
+                del self._entries[path]
+        self._next_sweep = now + self.ttl
+
+
+# returns the signature of a file
+# @param path the path of the file
+# @returns (size, mtime) or None if there is no such file
+def signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
@@ -7,6 +7,22 @@ from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 import shutil
 import sys
+import tempfile
+import time
+import chunking
+import delta
+import durability
+import event_coalescer
+import expectations
+import ignore_rules
+import protocol
+import scanner
+import state_store
+
+# permissions of newly created files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 # @package Filesystem_Controller
 # Handles file-system-events
 # @author Emu
@@ -18,29 +34,66 @@ class Filesystem_Controller(FileSystemEventHandler):
     os_type = sys.platform
     # Variables
     lockTime = 20					# auto unlock after seconds: demo 20 seconds, final 5 min
-    ignoreCreate = []
-        # list of paths whose fs-create-events shall be ignored
-    ignoreDelete = []
-        # list of paths whose fs-delete-events shall be ignored
-    ignoreMove = []					# list of paths whose fs-move-events shall be ignored
-    ignoreModify = []
-        # list of paths whose fs-modify-events shall be ignored
     locked_files = []				# list of locked files
-
-    # Files in the selective_sync_list are completely ignored by the sourceBox
-    selective_sync_list = ['.DS_Store']
+    chunkRounds = 3					# rounds of missing chunks before a large file is sent as a whole
 
     # Constuctor
     # @param client object of parent class
     # @param boxPath path to the directory that will be observed
+    # @param durabilityMode when written files are on disk: 'none', 'fsync' or 'group' (see durability.py)
+    # @param groupInterval seconds between two fsyncs in 'group' mode
+    # @param quietTime seconds without events after which a file is synced
+    # @param maxLatency seconds after its first event a file is synced at the latest
+    # @param hashWorkers number of processes hashing the box at startup (None: one per CPU)
+    # @param ignore the paths that are not synced, gitignore-style patterns (see ignore_rules.py)
     # @author Emanuel Regnath
-    def __init__(self, client, boxPath):
+    def __init__(self, client, boxPath, durabilityMode='group', groupInterval=0.05,
+                 quietTime=0.5, maxLatency=5.0, hashWorkers=None, ignore='.DS_Store'):
         # catch logging object from sourceBox_client
         self.log = logging.getLogger("client")
 
         self.boxPath = os.path.abspath(
             boxPath)						# absolute path of the observed directory (where fs-events will be detected)
         self.client = client										# object pointer to the parent class (client)
+        # directory for incoming file contents (outside the box, so the
+        # observer does not see the partial files)
+        self.spoolPath = os.path.join(
+            os.path.dirname(self.boxPath), '.sourcebox-spool')
+        # hashes the files of the box at startup (see scanner.py); its pool
+        # of processes is forked before the threads below are started
+        self.scanner = scanner.Scanner(hashWorkers, self._scanProgress)
+        self.scanner.start()
+        # files are replaced atomically, fsynced depending on the mode
+        self.writer = durability.Durable_Writer(durabilityMode, groupInterval)
+        # what was synced before the client was stopped (outside the box, so
+        # the observer does not see it, see state_store.py)
+        statePath = os.path.join(os.path.dirname(self.boxPath), '.sourcebox-state.db')
+        # without a state of an earlier run, every file in the box could be new
+        self.knownBox = os.path.exists(statePath)
+        self.state = state_store.State_Store(statePath)
+        # changes made while the client was not running, sent after the
+        # initial sync (a list of (event, path relative to boxPath))
+        self.offlineChanges = []
+        # delta signatures of the last version synced with the server
+        # (path relative to boxPath -> delta.Signature)
+        self.signatures = {}
+        # sha256 digests of the last version synced with the server
+        # (path relative to boxPath -> hex digest)
+        self.digests = dict((path, state.rev) for path, state in self.state.items()
+                            if state.rev is not None)
+        # sha256 digests of the current contents, valid as long as size and
+        # mtime do not change (path relative to boxPath -> (size, mtime, hex digest))
+        self.hashCache = {}
+        # chunks of the current contents of large files, valid as long as size
+        # and mtime do not change (path relative to boxPath -> (size, mtime, chunks))
+        self.chunkCache = {}
+        # the paths that are completely ignored by the sourceBox
+        self.rules = ignore_rules.Ignore_Rules(ignore)
+        # the events of a file are merged until it settled (see event_coalescer.py)
+        self.events = event_coalescer.Event_Coalescer(self._emitEvent, quietTime, maxLatency)
+        # the events caused by the client itself (paths relative to boxPath,
+        # see expectations.py)
+        self.expected = expectations.Expectation_Table()
         self.observer = Observer()									# create observer
         self.observer.schedule(self, boxPath, recursive=True)
                                # attach path to observer (recursive: also
@@ -53,6 +106,10 @@ class Filesystem_Controller(FileSystemEventHandler):
     def __del__(self):
         self.log.info('Deleted Filesystem_Controller')				# self.log
         self.observer.stop()										# stop observing
+        self.events.close()											# pending events are found again at the next start
+        self.writer.close()											# written files to disk
+        self.scanner.close()
+        self.state.close()
 
     # FS Control Methods (call from extern classes)
     #==========================================================================
@@ -68,10 +125,9 @@ class Filesystem_Controller(FileSystemEventHandler):
             self.locked_files.append(
                     relpath)						# new entry in locked_files
 
-            # self.ignoreModify.append(
-                 #   path)							# ignore modify-event raised by chmod
             path = os.path.join(
                     self.boxPath, path)                 # expand to absolute path
+            self._expectChmod(relpath)						# ignore modify-event raised by chmod
             os.chmod(path, 0o000)
                          # set file permissions: no read, no write, no exec
             print "File locked ", path 								# self.log
@@ -94,7 +150,7 @@ class Filesystem_Controller(FileSystemEventHandler):
                 relpath)                       # remove file from locked list
             path = os.path.join(
                 self.boxPath, path)                 # expand to absolute path
-            #self.ignoreModify.append(path)							# ignore modify-event triggered by chmod
+            self._expectChmod(relpath)								# ignore modify-event triggered by chmod
             os.chmod(
                 path, 0o666)									# set file permissions: read and write
             self.log.debug("File unlocked: " +  str(path))
@@ -124,54 +180,43 @@ class Filesystem_Controller(FileSystemEventHandler):
     # overwrites a file
     # @param path path of the file relative to boxPath
     # @param content content of the file
+    # @param content_file a spool file holding the content (instead of content)
+    # @param patch a delta against the current content (instead of content)
     # @author Emanuel Regnath
-    def writeFile(self, path, content):
+    # @returns False if the patch does not fit the current content
+    def writeFile(self, path, content, content_file=None, patch=None):
+        relpath = path
         path = os.path.join(self.boxPath, path)                     # expand to absolute path
-        self.ignoreModify.append(path)								# ignore modify-event triggered by .write
-        if os.access(path, os.W_OK):
-            with open(path, 'w') as open_file:
-                # write content to file
-                open_file.write(content)							
-        else:
-            # get fileMod
-            fileMod = os.stat(path).st_mode & 0777					
-            # set file permissions: read and write
-            os.chmod(path, 0o666)
-            # write content to file								 
-            with open(path, 'w') as open_file:
-                open_file.write(content)							
-                os.chmod(path, fileMod)
+        if content_file is not None:
+            self._replaceFile(path, content_file)
+            self._rememberVersion(relpath)
+            return True
+        if patch is not None:
+            try:
+                content = delta.apply(self.readFile(relpath), patch)
+            except (IOError, OSError, delta.Delta_Error), err:
+                self.log.warning("could not apply delta to %s because %s", path, err)
+                return False
+        self._writeContent(path, content)
+        self._rememberVersion(relpath, content)
+        return True
 
     # created File
     # @param path path of the file relative to boxPath
+    # @param content content of the file
+    # @param content_file a spool file holding the content (instead of content)
     # @author Emanuel Regnath
-    def createFile(self, path, content):
+    def createFile(self, path, content, content_file=None):
+        relpath = path
         path = os.path.join(
             self.boxPath, path)                     # expand to absolute path
-        self.ignoreCreate.append(path)
-                                 # ignore create-event triggered by .close
-        self.ignoreModify.append(path)
+        if content_file is not None:
+            self._replaceFile(path, content_file)
+            self._rememberVersion(relpath)
+            return
         self.log.debug(path)
-        if os.path.exists(path):
-            # NOTE We need a copy of the write_file command that does not produce a ignoreModify. Unless we have duplicate ignoreModify entries.
-            # expand to absolute path
-            path = os.path.join(self.boxPath, path)                     
-            if os.access(path, os.W_OK):
-                # write content to file
-                with open(path, 'w') as open_file:
-                    open_file.write(content)                          
-            else:
-                # get fileMod
-                fileMod = os.stat(path).st_mode & 0777                  
-                # set file permissions: read and write
-                os.chmod(path, 0o666)                                       
-                # write content to file
-                with open(path, 'w') as open_file:
-                    open_file.write(content)                        
-                    os.chmod(path, fileMod)
-        else:
-            with open(path, 'w+') as open_file:
-                open_file.write(content)
+        self._writeContent(path, content)
+        self._rememberVersion(relpath, content)
 
     # create Directory
     # @param path path of the directory relative to boxPath
@@ -179,8 +224,8 @@ class Filesystem_Controller(FileSystemEventHandler):
     def createDir(self, path):
         # expand to absolute path
         path = os.path.join(self.boxPath, path)
-        # ignore create-event triggered by os.makedirs             
-        self.ignoreCreate.append(path)	
+        # ignore create-event triggered by os.makedirs
+        self.expected.expect(os.path.relpath(path, self.boxPath), (event_coalescer.CREATED,))
         # create directory			
         os.makedirs(path)										
 
@@ -190,8 +235,9 @@ class Filesystem_Controller(FileSystemEventHandler):
     def deleteFile(self, path):
         path = os.path.join(
             self.boxPath, path)                     # expand to absolute path
-        self.ignoreDelete.append(
-            path)								# ignore delete-event triggered by os.remove
+        self.expected.expect(os.path.relpath(path, self.boxPath),
+                             (event_coalescer.DELETED,))	# ignore delete-event triggered by os.remove
+        self._forgetVersions(os.path.relpath(path, self.boxPath))
         try:
             os.remove(path)												# delete file
         except OSError, err:
@@ -204,8 +250,9 @@ class Filesystem_Controller(FileSystemEventHandler):
         # expand to absolute path
         path = os.path.join(self.boxPath, path)                     
 
-        # ignore delete-event triggered by os.removedirs
-        self.ignoreDelete.append(path)								
+        # ignore the delete-events triggered by shutil.rmtree
+        self.expected.expect(os.path.relpath(path, self.boxPath), (event_coalescer.DELETED,), tree=True)
+        self._forgetVersions(os.path.relpath(path, self.boxPath))
         try:
             # delete directory
             shutil.rmtree(path)										
@@ -221,13 +268,195 @@ class Filesystem_Controller(FileSystemEventHandler):
             self.boxPath, srcPath)               # expand to absolute path
         dstPath = os.path.join(
             self.boxPath, dstPath)               # expand to absolute path
-        self.ignoreMove.append(
-            srcPath)								# ignore move-event triggered by os.renames
+        self.expected.expect(os.path.relpath(srcPath, self.boxPath), (expectations.MOVED,),
+                             tree=os.path.isdir(srcPath))	# ignore move-event triggered by os.renames
         # TODO: test if dest is in lokal folder?
         try:
             os.renames(srcPath, dstPath)								# move file or directory
         except (IOError, OSError), err:
             self.log.error(str(err))
+        self._moveVersions(os.path.relpath(srcPath, self.boxPath),
+                             os.path.relpath(dstPath, self.boxPath))
+    # writes a content that a local file has already (announced by the server with HAVE)
+    # @param path path of the file relative to boxPath
+    # @param digest the hex digest of the content
+    # @param create True to create the file, False to overwrite it
+    # @returns False if no local file has the content
+    def copyContent(self, path, digest, create):
+        for relpath, known in self.digests.items():
+            if known != digest:
+                continue
+            try:
+                content_file = self._spoolCopy(os.path.join(self.boxPath, relpath))
+            except (IOError, OSError), err:
+                self.log.debug("could not copy %s because %s", relpath, err)
+                continue
+            # the local file may have been changed since it was synced
+            if protocol.hash_file(content_file) != digest:
+                os.remove(content_file)
+                continue
+            self.log.debug("copying %s to %s", relpath, path)
+            if create:
+                self.createFile(path, '', content_file)
+            else:
+                self.writeFile(path, '', content_file)
+            return True
+        return False
+
+    # lists the box for the initial sync and finds the changes made while the
+    # client was not running (only files whose size, mtime or inode changed
+    # are hashed)
+    # @returns a list of protocol.Manifest_Entry
+    def manifest(self):
+        entries = []
+        changes = []
+        found = set()
+        # the files hashed now, recorded together
+        hashed = []
+        started = time.time()
+        scan = self.scanner
+        for entry in scan.scan(self.boxPath, self.rules.ignored, self._knownDigest):
+            if entry.is_dir:
+                entries.append(protocol.Manifest_Entry(entry.path, is_dir=True))
+                continue
+            relpath, stat, digest = entry.path, entry.stat, entry.digest
+            if entry.hashed:
+                hashed.append((relpath, stat, digest))
+                self.hashCache[relpath] = (stat.st_size, stat.st_mtime, digest)
+            rev = self.digests.get(relpath)
+            entries.append(protocol.Manifest_Entry(
+                relpath, False, stat.st_size, stat.st_mtime, digest, rev))
+            found.add(relpath)
+            if rev is not None and rev != digest:
+                changes.append((event_coalescer.MODIFIED, relpath))
+            elif rev is None and self.knownBox:
+                changes.append((event_coalescer.CREATED, relpath))
+        self.log.info('Scanned %d files in %.2fs, hashed %d (%d bytes)', scan.files,
+                      time.time() - started, len(hashed), scan.size)
+        # later scans (after a reconnect) find almost every digest known, the
+        # processes are not needed any more
+        scan.close()
+        # files deleted since they were synced
+        for relpath, rev in self.digests.items():
+            if relpath not in found and not self.rules.ignored(relpath):
+                entries.append(protocol.Manifest_Entry(relpath, rev=rev, deleted=True))
+                changes.append((event_coalescer.DELETED, relpath))
+        self.state.hashed(hashed)
+        self.offlineChanges = changes
+        return entries
+
+    # sends the changes made while the client was not running (after the
+    # server sent what changed in the meantime)
+    def syncOfflineChanges(self):
+        changes = self.offlineChanges
+        self.offlineChanges = []
+        if changes:
+            self.log.info('%d files were changed while the client was not running', len(changes))
+        for event, relpath in changes:
+            self.events.add(event, relpath)
+
+    # logs the progress of the scan of the box
+    # @param files number of files scanned so far
+    # @param size bytes hashed so far
+    def _scanProgress(self, files, size):
+        self.log.debug('Scanning the box: %d files, %d bytes hashed', files, size)
+
+    # returns the digest of the current content of a file if it did not
+    # change since it was hashed last
+    # @param relpath path of the file relative to boxPath
+    # @param stat the os.stat result of the file
+    # @returns the hex digest or None
+    def _knownDigest(self, relpath, stat):
+        cached = self.hashCache.get(relpath)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+            return cached[2]
+        state = self.state.get(relpath)
+        if state is not None and state.matches(stat):
+            self.hashCache[relpath] = (stat.st_size, stat.st_mtime, state.digest)
+            return state.digest
+        return None
+
+    # returns the digest of the current content of a file (hashes it only if
+    # it changed since it was hashed last)
+    # @param relpath path of the file relative to boxPath
+    # @param stat the os.stat result of the file
+    # @returns the hex digest
+    def _currentDigest(self, relpath, stat):
+        digest = self._knownDigest(relpath, stat)
+        if digest is None:
+            digest = protocol.hash_file(os.path.join(self.boxPath, relpath))
+            self.state.hashed([(relpath, stat, digest)])
+            self.hashCache[relpath] = (stat.st_size, stat.st_mtime, digest)
+        return digest
+
+    # returns the chunks of the current content of a file (cuts it only if it
+    # changed since it was cut last)
+    # @param relpath path of the file relative to boxPath
+    # @param stat the os.stat result of the file
+    # @returns a list of (offset, size, hex digest), see chunking.py
+    def _currentChunks(self, relpath, stat):
+        cached = self.chunkCache.get(relpath)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+            return cached[2]
+        chunks = chunking.chunk_file(os.path.join(self.boxPath, relpath))
+        self.chunkCache[relpath] = (stat.st_size, stat.st_mtime, chunks)
+        return chunks
+
+    # copies a file to a new spool file
+    # @param path absolute path of the file
+    # @returns the path of the spool file
+    def _spoolCopy(self, path):
+        if not os.path.isdir(self.spoolPath):
+            os.makedirs(self.spoolPath)
+        handle, content_file = tempfile.mkstemp(prefix='.sb-', dir=self.spoolPath)
+        os.close(handle)
+        try:
+            shutil.copyfile(path, content_file)
+        except (IOError, OSError):
+            os.remove(content_file)
+            raise
+        return content_file
+
+    # writes a content to a spool file and moves it to path (replaces the
+    # file atomically)
+    # @param path absolute path of the file
+    # @param content the content
+    def _writeContent(self, path, content):
+        try:
+            content_file = self.writer.write_temp(content, self.spoolPath)
+        except (IOError, OSError), err:
+            self.log.error("could not write file %s because %s", path, err)
+            return
+        self._replaceFile(path, content_file)
+
+    # moves a spool file to path (replaces the file atomically)
+    # @param path absolute path of the file
+    # @param content_file the spool file
+    def _replaceFile(self, path, content_file):
+        # keep the permissions of the existing file (e.g. locked)
+        if os.path.exists(path):
+            fileMod = os.stat(path).st_mode & 0777
+        else:
+            fileMod = 0666 & ~UMASK
+        try:
+            os.chmod(content_file, fileMod)
+            self.writer.prepare(content_file)
+            # ignore the events triggered by the rename (the file keeps size and mtime)
+            self.expected.expect(os.path.relpath(path, self.boxPath),
+                                 (event_coalescer.CREATED, event_coalescer.MODIFIED),
+                                 expectations.signature(content_file))
+            try:
+                os.rename(content_file, path)
+            except OSError:
+                # Windows does not replace existing files
+                os.remove(path)
+                os.rename(content_file, path)
+            self.writer.committed(path)
+        except (IOError, OSError), err:
+            self.log.error("could not write file %s because %s", path, err)
+            if os.path.exists(content_file):
+                os.remove(content_file)
+
     # returns Size of a file in byte
     # @param path path of the file
     # @author Emanuel Regnath
@@ -249,24 +478,19 @@ class Filesystem_Controller(FileSystemEventHandler):
         # reduce to path relative to boxPath
         src_relpath = os.path.relpath(src_path, self.boxPath) 	
 
-        if self._path_contains_selective_sync(src_path):
-            self.log.debug(src_path + ' in selective_sync_list -> ignored.')
-        elif src_path in self.ignoreCreate:
-            self.ignoreCreate.remove(src_path)
+        if self.rules.ignored(src_relpath, event.is_directory):
+            self.log.debug(src_relpath + ' matches the ignore rules -> ignored.')
+        elif self.expected.match(src_relpath, event_coalescer.CREATED,
+                                 expectations.signature(src_path)):
+            self.log.debug('Ignored create event of ' + src_relpath)
         else:
             # if event was triggered by a directory
             if event.is_directory == True:							
                 self.log.info("Directory created: %s", src_path)
-                self.client.comm.send_create_dir(src_relpath)
+                self.client.comm.send_create_dir(src_relpath, wait=False)
             else:
                 self.log.info("File created: %s", src_path)		
-                try:
-                    # ERROR: src_path only filename
-                    with open(src_path) as open_file:
-                        content = open_file.read()						
-                        self.client.comm.send_create_file(src_relpath, len(content), content)
-                except IOError, err:
-                    self.log.error(str(err))
+                self.events.add(event_coalescer.CREATED, src_relpath)
 
     # triggered if a file or directory was deleted
     # @param event object representing the file system event
@@ -275,18 +499,19 @@ class Filesystem_Controller(FileSystemEventHandler):
         src_path = event.src_path									# abslolute path
         src_relpath = os.path.relpath(
             src_path, self.boxPath) 		# reduce to path relative to boxPath
-        if self._path_contains_selective_sync(src_path):
-            self.log.debug(src_path + ' in selective_sync_list -> ignored.')
-        elif src_path in self.ignoreDelete:
-            self.ignoreDelete.remove(src_path)
+        if self.rules.ignored(src_relpath, event.is_directory):
+            self.log.debug(src_relpath + ' matches the ignore rules -> ignored.')
+        elif self.expected.match(src_relpath, event_coalescer.DELETED):
+            self.log.debug('Ignored delete event of ' + src_relpath)
         else:
             if event.is_directory == True:							# if event was triggered by a directory
                 self.log.info("Directory deleted: %s", src_path)			# self.log
-                self.client.comm.send_delete_dir(src_relpath)
+                # deleting the directory deletes everything in it
+                self.events.discard(src_relpath)
+                self.client.comm.send_delete_dir(src_relpath, wait=False)
             else:
                 self.log.info("File deleted: %s", src_path)				# self.log
-                self.client.comm.send_delete_file(
-                    src_relpath)		# send delete_file to server
+                self.events.add(event_coalescer.DELETED, src_relpath)
 
     # triggered if a file or directory was modified
     # @param event object representing the file system event
@@ -298,11 +523,11 @@ class Filesystem_Controller(FileSystemEventHandler):
         # reduce to path relative to boxPath							
         src_relpath = os.path.relpath(src_path, self.boxPath) 	
 
-        if self._path_contains_selective_sync(src_path):
-            self.log.debug(src_path + ' in selective_sync_list -> ignored.')
-        elif src_path in self.ignoreModify:
-            self.ignoreModify.remove(src_path)
-            self.log.debug('Ignore Modify after MODIFY Event: ' + str(self.ignoreModify))
+        if self.rules.ignored(src_relpath, event.is_directory):
+            self.log.debug(src_relpath + ' matches the ignore rules -> ignored.')
+        elif self.expected.match(src_relpath, event_coalescer.MODIFIED,
+                                 expectations.signature(src_path)):
+            self.log.debug('Ignored modify event of ' + src_relpath)
         elif src_relpath in self.locked_files:
             pass
         else:
@@ -311,6 +536,10 @@ class Filesystem_Controller(FileSystemEventHandler):
                 # push changes to SVN
             else:
                 self.log.info("File modified: %s", src_relpath)				# self.log
+                # the first modification locks the file, the next ones are
+                # merged with it (a new file is not on the server yet)
+                if self.events.add(event_coalescer.MODIFIED, src_relpath) is not None:
+                    return
                 # lock file:
                 self.client.comm.send_lock_file(src_relpath)
                 self.setLockTimer(
@@ -320,11 +549,6 @@ class Filesystem_Controller(FileSystemEventHandler):
                 self.client.gui.locked_files.set('\n'.join(self.client.gui.locked_files_path))
                 self.client.gui.root.update_idletasks()
 
-                # push changes to SVN:
-                content = self.readFile(src_path)					# read file content
-                self.client.comm.send_modify_file(					# send modify_file to server
-                    src_relpath, len(content), content)
-
 
     # triggered if a file or directory was moved or renamed
     # @param event object representing the file system event
@@ -334,36 +558,259 @@ class Filesystem_Controller(FileSystemEventHandler):
             event.src_path, self.boxPath)  # reduce to path relative to boxPath
         dest_path = os.path.relpath(
             event.dest_path, self.boxPath)  # reduce to path relative to boxPath
-        if self._path_contains_selective_sync(src_path):
-            self.log.debug(src_path + ' in selective_sync_list -> ignored.')
-        elif src_path in self.ignoreMove:
-            self.ignoreMove.remove(src_path)
+        src_ignored = self.rules.ignored(src_path, event.is_directory)
+        dest_ignored = self.rules.ignored(dest_path, event.is_directory)
+        if src_ignored and dest_ignored:
+            self.log.debug(src_path + ' matches the ignore rules -> ignored.')
+        elif self.expected.match(src_path, expectations.MOVED):
+            self.log.debug('Ignored move event of ' + src_path)
+        elif not event.is_directory and self.events.pending(src_path) == event_coalescer.CREATED:
+            # the server does not know the file yet (e.g. the temporary file
+            # of an editor), it is sent where it is now
+            self.log.info("File moved from %s to %s", src_path, dest_path)
+            self.events.discard(src_path)
+            if dest_ignored:
+                self.log.debug(dest_path + ' matches the ignore rules -> ignored.')
+            elif dest_path in self.digests:
+                self.events.add(event_coalescer.MODIFIED, dest_path)
+            else:
+                self.events.add(event_coalescer.CREATED, dest_path)
+        elif src_ignored:
+            # the server does not know it, it is new where it is now
+            self.log.info("Moved from an ignored path to %s", dest_path)
+            self._sendTree(dest_path, event.is_directory)
+        elif dest_ignored:
+            # not synced any more, for the server it is gone
+            self.log.info("Moved %s to an ignored path", src_path)
+            self.events.flush(src_path)
+            self._forgetVersions(src_path)
+            if event.is_directory:
+                self.client.comm.send_delete_dir(src_path, wait=False)
+            else:
+                self.client.comm.send_delete_file(src_path, wait=False)
         else:
+            # what happened before the move reaches the server first
+            self.events.flush(src_path)
+            self.events.flush(dest_path)
+            self._moveVersions(src_path, dest_path)
             if event.is_directory == True:							# if event was triggered by a directory
                 self.log.info("Directory moved from %s to %s",
                               src_path, dest_path)							# self.log
-                self.client.comm.send_move(src_path, dest_path)
+                self.client.comm.send_move(src_path, dest_path, wait=False)
             else:
                 self.log.info("File moved from %s to %s",
                               src_path, dest_path)
-                self.client.comm.send_move(src_path, dest_path)
+                self.client.comm.send_move(src_path, dest_path, wait=False)
                 if src_path == None:
                     # same as create
                     pass
 
     # Internal Methods (don't touch!)
     #==========================================================================
+    # sends the merged event of a file that settled (called by self.events)
+    # @param event event_coalescer.CREATED, MODIFIED or DELETED
+    # @param relpath path of the file relative to boxPath
+    def _emitEvent(self, event, relpath):
+        path = os.path.join(self.boxPath, relpath)
+        try:
+            if event == event_coalescer.DELETED:
+                if os.path.exists(path):
+                    # the server sent the file again meanwhile
+                    return
+            else:
+                # hashed once, the digest is passed on
+                digest = self._currentDigest(relpath, os.stat(path))
+                if digest == self.digests.get(relpath):
+                    # the server has this content already (e.g. it sent it meanwhile)
+                    return
+            if event == event_coalescer.CREATED:
+                self._sendCreation(relpath, digest)
+            elif event == event_coalescer.MODIFIED:
+                self._sendModification(relpath, digest)
+            else:
+                self._forgetVersions(relpath)
+                self.client.comm.send_delete_file(
+                    relpath, wait=False)		# send delete_file to server
+        except (IOError, OSError), err:
+            self.log.error("could not sync %s because %s", relpath, err)
+
+    # sends a new file to the server, not at all if the server has the
+    # content already
+    # @param relpath path of the file relative to boxPath
+    # @param digest the digest of the current content
+    def _sendCreation(self, relpath, digest):
+        path = os.path.join(self.boxPath, relpath)
+        # the server may have the content of a large file already
+        size = os.path.getsize(path)
+        if size >= protocol.HAVE_THRESHOLD:
+            if self.client.comm.send_have(relpath, protocol.OP_CREATE_FILE, digest, size):
+                self._rememberVersion(relpath, digest=digest)
+                return
+            # very large files are sent in chunks the server does not have yet
+            if (size >= protocol.CHUNKED_THRESHOLD and
+                    self._sendChunked(relpath, protocol.OP_CREATE_FILE)):
+                self._rememberVersion(relpath, digest=digest)
+                return
+        # the content is streamed from the file
+        self.client.comm.send_create_file(relpath, size, wait=False, source=path)
+        self._rememberVersion(relpath, digest=digest)
+
+    # sends a modified file to the server, not at all if the server has the
+    # content already, as a delta if the server has the previous version
+    # @param relpath path of the file relative to boxPath
+    # @param digest the digest of the current content
+    def _sendModification(self, relpath, digest):
+        size = self.getSize(relpath)
+        if size >= protocol.HAVE_THRESHOLD:
+            if self.client.comm.send_have(relpath, protocol.OP_MODIFY, digest, size):
+                self._rememberVersion(relpath, digest=digest)
+                return
+            if size >= protocol.CHUNKED_THRESHOLD and self._sendChunked(relpath, protocol.OP_MODIFY):
+                self._rememberVersion(relpath, digest=digest)
+                return
+        if size > delta.MAX_SIZE:
+            self.signatures.pop(relpath, None)
+            self.digests.pop(relpath, None)
+            if self.client.comm.send_modify_file(					# send modify_file to server (streamed from the file)
+                    relpath, size, source=os.path.join(self.boxPath, relpath)):
+                self._rememberVersion(relpath, digest=digest)
+            return
+
+        content = self.readFile(relpath)
+        signature = self.signatures.get(relpath)
+        if signature is not None:
+            patch = delta.compute(signature, content)
+            # a delta that is not much smaller than the file is not worth it
+            if (len(patch) < len(content) // 2 and
+                    self.client.comm.send_modify_delta(relpath, patch)):
+                self._rememberVersion(relpath, content, digest)
+                return
+        if self.client.comm.send_modify_file(relpath, len(content), content):
+            self._rememberVersion(relpath, content, digest)
+        else:
+            self.signatures.pop(relpath, None)
+            self.digests.pop(relpath, None)
+
+    # sends a large file in chunks: the chunk list first, then the chunks the
+    # server does not have, then the list again until the server has all
+    # (an interrupted transfer goes on with the chunks that are missing)
+    # @param relpath path of the file relative to boxPath
+    # @param command protocol.OP_CREATE_FILE or protocol.OP_MODIFY
+    # @returns True if the server created or modified the file
+    def _sendChunked(self, relpath, command):
+        path = os.path.join(self.boxPath, relpath)
+        try:
+            stat = os.stat(path)
+            chunks = self._currentChunks(relpath, stat)
+            digests = [digest for offset, size, digest in chunks]
+            for attempt in range(self.chunkRounds):
+                missing = self.client.comm.send_chunks(relpath, command, stat.st_size, digests)
+                if missing is None:
+                    return False
+                if not missing:
+                    return True
+                self.log.info('Sending %d of %d chunks of %s', len(missing), len(chunks), relpath)
+                with open(path, 'rb') as open_file:
+                    for index in missing:
+                        offset, size, digest = chunks[index]
+                        open_file.seek(offset)
+                        content = open_file.read(size)
+                        if protocol.hash_content(content) != digest:
+                            # changed meanwhile, the next event sends it again
+                            self.chunkCache.pop(relpath, None)
+                            return False
+                        if not self.client.comm.send_chunk(relpath, content):
+                            return False
+        except (IOError, OSError, IndexError), err:
+            self.log.warning('Could not send %s in chunks: %s', relpath, err)
+        return False
+
+    # remembers the signature and the digest of the version synced with the server
+    # @param relpath path of the file relative to boxPath
+    # @param content the content (read from the file if None)
+    # @param digest the digest of the content (computed if None)
+    def _rememberVersion(self, relpath, content=None, digest=None):
+        try:
+            if content is None:
+                size = self.getSize(relpath)
+            else:
+                size = len(content)
+            if digest is None and content is None:
+                self.digests[relpath] = protocol.hash_file(os.path.join(self.boxPath, relpath))
+            elif digest is None:
+                self.digests[relpath] = protocol.hash_content(content)
+            else:
+                self.digests[relpath] = digest
+            # the file has the content that was synced
+            self.state.synced(relpath, self.digests[relpath],
+                              os.stat(os.path.join(self.boxPath, relpath)))
+            if size > delta.MAX_SIZE:
+                self.signatures.pop(relpath, None)
+                return
+            if content is None:
+                content = self.readFile(relpath)
+        except (IOError, OSError):
+            self.signatures.pop(relpath, None)
+            self.digests.pop(relpath, None)
+            return
+        self.signatures[relpath] = delta.signature(content)
+
+    # forgets the versions of a file or of everything in a directory
+    # @param relpath path relative to boxPath
+    def _forgetVersions(self, relpath):
+        prefix = relpath + os.sep
+        for versions in (self.signatures, self.digests, self.hashCache, self.chunkCache):
+            for key in versions.keys():
+                if key == relpath or key.startswith(prefix):
+                    del versions[key]
+        self.state.remove(relpath)
+
+    # moves the versions of a file or of everything in a directory
+    # @param src_relpath old path relative to boxPath
+    # @param dest_relpath new path relative to boxPath
+    def _moveVersions(self, src_relpath, dest_relpath):
+        prefix = src_relpath + os.sep
+        for versions in (self.signatures, self.digests, self.hashCache, self.chunkCache):
+            for key in versions.keys():
+                if key == src_relpath:
+                    versions[dest_relpath] = versions.pop(key)
+                elif key.startswith(prefix):
+                    versions[dest_relpath + key[len(src_relpath):]] = versions.pop(key)
+        self.state.move(src_relpath, dest_relpath)
+
+    # expects the modify-event triggered by changing the permissions of a file
+    # (the content, size and mtime stay the same)
+    # @param relpath path of the file relative to boxPath
+    def _expectChmod(self, relpath):
+        self.expected.expect(relpath, (event_coalescer.MODIFIED,),
+                             expectations.signature(os.path.join(self.boxPath, relpath)))
+
+    # sends a file or a directory with everything in it that is not ignored
+    # as new (e.g. moved into the box from an ignored path)
+    # @param relpath path relative to boxPath
+    # @param isDir True for a directory
+    def _sendTree(self, relpath, isDir):
+        if not isDir:
+            self.events.add(event_coalescer.CREATED, relpath)
+            return
+        self.client.comm.send_create_dir(relpath, wait=False)
+        for root, dirs, files in os.walk(os.path.join(self.boxPath, relpath)):
+            relroot = os.path.relpath(root, self.boxPath)
+            for name in list(dirs):
+                path = os.path.join(relroot, name)
+                if self.rules.ignored(path, True):
+                    dirs.remove(name)
+                else:
+                    self.client.comm.send_create_dir(path, wait=False)
+            for name in files:
+                path = os.path.join(relroot, name)
+                if not self.rules.ignored(path):
+                    self.events.add(event_coalescer.CREATED, path)
+
     # wait a certain time (new thread) until path is auto-unlocked
     # @param path path of the file relative to boxPath
     # @param time time to wait in seconds
     # @author Emanuel Regnath
-
-    def _path_contains_selective_sync(self, path):
-        for entry in self.selective_sync_list:
-            if entry in path:
-                return True
-        return False
-
     def setLockTimer(self, path, time):
         # start new thread with timer
         Timer(time, self.handleLockTimerEvent, (path,)).start()               
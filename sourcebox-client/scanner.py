@@ -0,0 +1,308 @@
+#
+# Scanner
+# walks the box and hashes its files in a pool of processes
+#
+# On the first sync every file of the box has to be hashed. The scanner walks
+# the tree with scandir (os.scandir, else the scandir module), so listing a
+# directory does not stat every entry twice; without it, it uses os.walk and
+# one stat per file. It hands the files to hash to a pool of processes in
+# batches: small files together, a big file alone. Every process reads in
+# protocol.CHUNK_SIZE blocks, and only a bounded number of batches is in
+# flight, so neither the files nor the walk running ahead of the hashing use
+# up the memory.
+#
+# The pool has to be started (start) before the caller starts any threads: a
+# process forked while another thread holds a lock (e.g. of logging) would
+# wait for it forever. Without a pool the files are hashed in this process.
+#
+# The entries are yielded as they are found and hashed, a progress callback
+# is called now and then. Files whose digest the caller still knows (see
+# known) are not hashed, and the pool is only used if there are at least
+# PARALLEL_THRESHOLD files to hash.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import collections
+import logging
+import multiprocessing
+import os
+import time
+
+import protocol
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# a pool of processes hashes the files only if at least this many have to be hashed
+PARALLEL_THRESHOLD = 64
+# files are hashed in batches of at most this many bytes or files (a bigger file alone)
+BATCH_BYTES = 8 * 1024 * 1024
+BATCH_FILES = 64
+# batches in flight per process
+WINDOW_PER_WORKER = 2
+# seconds between two calls of the progress callback
+PROGRESS_INTERVAL = 0.5
+
+
+class Scan_Entry(object):
+
+    # Constructor
+    # @param path the path relative to the scanned directory
+    # @param is_dir True for a directory
+    # @param stat the os.stat result (None for a directory)
+    # @param digest the hex sha256 digest of the content (None for a directory)
+    # @param hashed True if the file was hashed now (False if the digest was known)
+    def __init__(self, path, is_dir, stat=None, digest=None, hashed=False):
+        self.path = path
+        self.is_dir = is_dir
+        self.stat = stat
+        self.digest = digest
+        self.hashed = hashed
+
+    def __repr__(self):
+        return '<Scan_Entry %s %s>' % (self.path, 'dir' if self.is_dir else self.digest)
+
+
+class Scanner(object):
+
+    # Constructor
+    # @param workers number of processes hashing files (None: one per CPU,
+    #        1: no pool, the files are hashed in this process)
+    # @param progress called as progress(files, size) with the number of files
+    #        and the bytes hashed so far
+    def __init__(self, workers=None, progress=None):
+        self.log = logging.getLogger("client")
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.files = 0
+        self.size = 0
+        self._reported = 0
+        self._pool = None
+
+    # starts the pool of processes (before any other thread is started)
+    def start(self):
+        if self.workers > 1 and self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers)
+
+    # stops the pool of processes, the files are hashed in this process from now on
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    # walks a directory and hashes its files
+    # @param root the directory
+    # @param skip called as skip(path, is_dir) with the relative path of every
+    #        entry, True leaves out the entry (and everything under it)
+    # @param known called as known(path, stat) with the relative path and the
+    #        os.stat result of every file, returns the digest if it is still
+    #        known (None: the file is hashed)
+    # @returns a generator of Scan_Entry, the files in no particular order
+    def scan(self, root, skip=None, known=None):
+        self.files = 0
+        self.size = 0
+        self._reported = 0
+        # files to hash before the pool is used (Scan_Entry)
+        waiting = []
+        pool = self._pool
+        parallel = False
+        # batches in flight, the oldest first: (entries, AsyncResult)
+        flight = collections.deque()
+        batch = []
+        batch_size = 0
+        try:
+            for entry in self._walk(root, skip):
+                if entry.is_dir:
+                    yield entry
+                    continue
+                entry.digest = known(entry.path, entry.stat) if known is not None else None
+                if entry.digest is not None:
+                    self.files += 1
+                    self._report()
+                    yield entry
+                    continue
+
+                if pool is None:
+                    for done in self._collect([entry], _hash_batch(
+                            [os.path.join(root, entry.path)])):
+                        yield done
+                    continue
+                if not parallel:
+                    waiting.append(entry)
+                    if len(waiting) < PARALLEL_THRESHOLD:
+                        continue
+                    parallel = True
+                    self.log.debug('Hashing files in %d processes', self.workers)
+                    queued, waiting = waiting, []
+                else:
+                    queued = [entry]
+                for entry in queued:
+                    if batch and (batch_size + entry.stat.st_size > BATCH_BYTES or
+                                  len(batch) >= BATCH_FILES):
+                        flight.append(self._submit(pool, root, batch))
+                        batch, batch_size = [], 0
+                    batch.append(entry)
+                    batch_size += entry.stat.st_size
+                while len(flight) >= self.workers * WINDOW_PER_WORKER:
+                    for done in self._collect(*flight.popleft()):
+                        yield done
+
+            if batch:
+                flight.append(self._submit(pool, root, batch))
+            while flight:
+                for done in self._collect(*flight.popleft()):
+                    yield done
+            # too few files for a pool
+            for done in self._collect(waiting, _hash_batch(
+                    [os.path.join(root, entry.path) for entry in waiting])):
+                yield done
+            self._report(True)
+        finally:
+            if flight:
+                # the generator was closed early: the batches in flight are
+                # dropped, the pool cannot be used any more
+                pool.terminate()
+                pool.join()
+                self._pool = None
+
+    # hands a batch of files to the pool
+    # @returns (entries, AsyncResult)
+    def _submit(self, pool, root, entries):
+        return entries, pool.apply_async(
+            _hash_batch, ([os.path.join(root, entry.path) for entry in entries],))
+
+    # the hashed entries of a batch (a file that could not be read is left out)
+    # @param entries the Scan_Entry of the files
+    # @param results the result of _hash_batch or an AsyncResult of it
+    def _collect(self, entries, results):
+        if hasattr(results, 'get'):
+            results = results.get()
+        for entry, (digest, error) in zip(entries, results):
+            if digest is None:
+                self.log.warning("could not hash %s because %s", entry.path, error)
+                continue
+            entry.digest = digest
+            entry.hashed = True
+            self.files += 1
+            self.size += entry.stat.st_size
+            self._report()
+            yield entry
+
+    # calls the progress callback, at most every PROGRESS_INTERVAL seconds
+    # @param final True to call it in any case
+    def _report(self, final=False):
+        if self.progress is None:
+            return
+        now = time.time()
+        if final or now - self._reported >= PROGRESS_INTERVAL:
+            self._reported = now
+            self.progress(self.files, self.size)
+
+    # walks a directory, the directories before what is in them
+    # @returns a generator of Scan_Entry (files without digest)
+    def _walk(self, root, skip):
+        if _scandir is None:
+            for entry in self._os_walk(root, skip):
+                yield entry
+            return
+        stack = ['']
+        while stack:
+            relroot = stack.pop()
+            directory = os.path.join(root, relroot)
+            try:
+                listing = _list_dir(directory)
+            except OSError, err:
+                self.log.warning("could not list %s because %s", directory, err)
+                continue
+            for name, is_dir, is_link, stat in listing:
+                path = os.path.join(directory, name)
+                relpath = os.path.join(relroot, name)
+                if skip is not None and skip(relpath, is_dir):
+                    continue
+                if is_dir:
+                    yield Scan_Entry(relpath, True)
+                    # like os.walk, links to directories are not followed
+                    if not is_link:
+                        stack.append(relpath)
+                    continue
+                try:
+                    if stat is None:
+                        stat = os.stat(path)
+                except OSError, err:
+                    self.log.warning("could not list %s because %s", path, err)
+                    continue
+                yield Scan_Entry(relpath, False, stat)
+
+    # walks a directory with os.walk (without scandir), one stat per file
+    # @returns a generator of Scan_Entry (files without digest)
+    def _os_walk(self, root, skip):
+        for directory, dirs, files in os.walk(root, onerror=self._walk_error):
+            relroot = os.path.relpath(directory, root)
+            if relroot == os.curdir:
+                relroot = ''
+            kept = []
+            for name in dirs:
+                relpath = os.path.join(relroot, name)
+                if skip is not None and skip(relpath, True):
+                    continue
+                kept.append(name)
+                yield Scan_Entry(relpath, True)
+            # os.walk only goes into the directories that are kept (and, like
+            # the scandir walk, not into links to directories)
+            dirs[:] = kept
+            for name in files:
+                relpath = os.path.join(relroot, name)
+                if skip is not None and skip(relpath, False):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError, err:
+                    self.log.warning("could not list %s because %s", relpath, err)
+                    continue
+                yield Scan_Entry(relpath, False, stat)
+
+    # logs a directory os.walk cannot list
+    def _walk_error(self, err):
+        self.log.warning("could not list %s because %s", err.filename, err)
+
+
+# lists a directory with scandir
+# @param directory the directory
+# @returns a list of (name, is_dir, is_link, os.stat result of a file or None)
+# @throws OSError if the directory cannot be listed
+def _list_dir(directory):
+    listing = []
+    for entry in _scandir(directory):
+        try:
+            is_dir = entry.is_dir()
+            listing.append((entry.name, is_dir, entry.is_symlink(),
+                            None if is_dir else entry.stat()))
+        except OSError:
+            # vanished meanwhile, or a broken link: stat tells
+            listing.append((entry.name, False, False, None))
+    return listing
+
+
+# hashes files (in a process of the pool)
+# @param paths the paths of the files
+# @returns a list of (hex digest, None) or (None, error message)
+def _hash_batch(paths):
+    results = []
+    for path in paths:
+        try:
+            results.append((protocol.hash_file(path), None))
+        except (IOError, OSError), err:
+            results.append((None, str(err)))
+    return results
@@ -44,11 +44,14 @@ class ClientBox(object):
 
             self.log.debug("Creating Filesystem Controller...")
             self.fs = filesystem_controller.Filesystem_Controller(
-                self, config.boxPath)
+                self, config.boxPath, config.durability, config.groupCommitMs / 1000.0,
+                config.eventQuietMs / 1000.0, config.eventMaxLatencyMs / 1000.0,
+                config.hashWorkers, config.ignore)
 
             self.log.debug("Creating Communication Controller...")
             self.comm = client_communication_controller.Client_Communication_Controller(
-                self, config.serverIP, config.serverPort, config.clientName)
+                self, config.serverIP, config.serverPort, config.clientName, config.window,
+                config.compression)
 
             self.log.info('Client is running')
         except Exception, e:
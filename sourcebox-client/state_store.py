@@ -0,0 +1,145 @@
+#
+# State_Store
+# what the client knows about the files of its box, across restarts
+#
+# For every file the store keeps the size, mtime and inode it had when it
+# was hashed last, the digest of that content and the digest of the version
+# last synced with the server (the revision the server had then). At startup
+# a file whose size, mtime and inode did not change is not hashed again, and
+# comparing the digests shows what was changed, created or deleted while the
+# client was not running.
+#
+# The store is an sqlite database with a dictionary in front of it, every
+# call writes one transaction (the files hashed at startup are written
+# together).
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import sqlite3
+import threading
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    digest TEXT,
+    rev TEXT
+)'''
+
+
+class File_State(object):
+
+    # Constructor
+    # @param size the size when the file was hashed last
+    # @param mtime the mtime when the file was hashed last
+    # @param inode the inode when the file was hashed last
+    # @param digest the hex digest of the content then (None if unknown)
+    # @param rev the hex digest of the version last synced with the server (None if never)
+    def __init__(self, size=None, mtime=None, inode=None, digest=None, rev=None):
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.digest = digest
+        self.rev = rev
+
+    def __repr__(self):
+        return '<File_State %s bytes, digest %s, rev %s>' % (self.size, self.digest, self.rev)
+
+    # checks if a file still has the content that was hashed
+    # @param stat the os.stat result of the file
+    def matches(self, stat):
+        return (self.digest is not None and self.size == stat.st_size and
+                self.mtime == stat.st_mtime and self.inode == stat.st_ino)
+
+
+class State_Store(object):
+
+    # Constructor
+    # @param db_path the sqlite database
+    def __init__(self, db_path):
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute(_SCHEMA)
+        # path -> File_State
+        self._files = {}
+        for row in self._db.execute('SELECT path, size, mtime, inode, digest, rev FROM files'):
+            self._files[row[0]] = File_State(*row[1:])
+
+    # returns the state of a file
+    # @param path the path relative to the box
+    # @returns a File_State or None
+    def get(self, path):
+        return self._files.get(path)
+
+    # returns the states of all files
+    # @returns a list of (path, File_State)
+    def items(self):
+        return self._files.items()
+
+    # records the contents of files (in one transaction)
+    # @param entries (path relative to the box, os.stat result of the file
+    #        when it was hashed, hex digest of the content)
+    def hashed(self, entries):
+        with self._lock:
+            states = []
+            for path, stat, digest in entries:
+                state = self._files.get(path) or File_State()
+                states.append((path, File_State(stat.st_size, stat.st_mtime, stat.st_ino,
+                                                digest, state.rev)))
+            self._store(states, [])
+
+    # records the version of a file synced with the server
+    # @param path the path relative to the box
+    # @param rev the hex digest of the version
+    # @param stat the os.stat result of the file (which has that content now)
+    def synced(self, path, rev, stat):
+        self._store([(path, File_State(stat.st_size, stat.st_mtime, stat.st_ino, rev, rev))], [])
+
+    # forgets the files at a path or in a directory
+    # @param path the path relative to the box
+    def remove(self, path):
+        with self._lock:
+            self._store([], self._under(path))
+
+    # moves the files at a path or in a directory
+    # @param old_path old path relative to the box
+    # @param new_path new path relative to the box
+    def move(self, old_path, new_path):
+        with self._lock:
+            moved = self._under(old_path)
+            self._store([(new_path + key[len(old_path):], self._files[key]) for key in moved], moved)
+
+    # closes the database
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # the paths of a file or of everything in a directory
+    def _under(self, path):
+        prefix = path + os.sep
+        return [key for key in self._files.keys() if key == path or key.startswith(prefix)]
+
+    # writes states and removes paths in one transaction
+    # @param entries (path, File_State) to write
+    # @param removed the paths to remove
+    def _store(self, entries, removed):
+        if not entries and not removed:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM files WHERE path = ?',
+                                     [(path,) for path in removed])
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    [(path, state.size, state.mtime, state.inode, state.digest, state.rev)
+                     for path, state in entries])
+            for path in removed:
+                self._files.pop(path, None)
+            for path, state in entries:
+                self._files[path] = state
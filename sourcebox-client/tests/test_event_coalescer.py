@@ -0,0 +1,105 @@
+#
+# tests of the event coalescer: merge rules, flush, discard and latency
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import threading
+import time
+import unittest
+
+import event_coalescer
+from event_coalescer import CREATED, MODIFIED, DELETED
+
+
+class Event_Coalescer_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.emitted = threading.Event()
+        self.coalescer = None
+
+    def tearDown(self):
+        if self.coalescer is not None:
+            self.coalescer.close()
+
+    def _emit(self, event, path):
+        self.events.append((event, path))
+        self.emitted.set()
+
+    # a coalescer that only emits on flush
+    def _idle(self):
+        self.coalescer = event_coalescer.Event_Coalescer(self._emit, 60, 60)
+        return self.coalescer
+
+    def test_merge_rules(self):
+        coalescer = self._idle()
+        cases = [
+            ([CREATED, MODIFIED], CREATED),
+            ([MODIFIED, MODIFIED], MODIFIED),
+            ([DELETED, CREATED], MODIFIED),
+            ([CREATED, DELETED], None),
+            ([MODIFIED, DELETED], DELETED),
+            ([CREATED, DELETED, CREATED], CREATED),
+            ([MODIFIED, DELETED, CREATED, MODIFIED], MODIFIED),
+        ]
+        for events, merged in cases:
+            for event in events:
+                coalescer.add(event, 'a')
+            self.assertEqual(coalescer.pending('a'), merged, events)
+            self.events = []
+            coalescer.flush('a')
+            self.assertEqual(self.events, [(merged, 'a')] if merged else [], events)
+
+    def test_add_returns_previous_event(self):
+        coalescer = self._idle()
+        self.assertEqual(coalescer.add(CREATED, 'a'), None)
+        self.assertEqual(coalescer.add(MODIFIED, 'a'), CREATED)
+        self.assertEqual(coalescer.add(DELETED, 'a'), CREATED)
+        self.assertEqual(coalescer.pending('a'), None)
+
+    def test_flush_directory_oldest_first(self):
+        coalescer = self._idle()
+        for event, path in [(MODIFIED, os.path.join('d', 'b')), (CREATED, 'dd'),
+                            (CREATED, os.path.join('d', 'e', 'a'))]:
+            coalescer.add(event, path)
+            time.sleep(0.01)
+        coalescer.flush('d')
+        self.assertEqual(self.events, [(MODIFIED, os.path.join('d', 'b')),
+                                       (CREATED, os.path.join('d', 'e', 'a'))])
+        self.assertEqual(coalescer.pending('dd'), CREATED)
+
+    def test_discard_directory(self):
+        coalescer = self._idle()
+        coalescer.add(CREATED, os.path.join('d', 'a'))
+        coalescer.add(MODIFIED, os.path.join('d', 'e', 'b'))
+        coalescer.add(MODIFIED, 'dd')
+        self.assertEqual(coalescer.discard('d'), 2)
+        self.assertEqual(coalescer.pending(os.path.join('d', 'a')), None)
+        self.assertEqual(coalescer.pending('dd'), MODIFIED)
+
+    def test_emitted_after_quiet_time(self):
+        self.coalescer = event_coalescer.Event_Coalescer(self._emit, 0.2, 5)
+        started = time.time()
+        self.coalescer.add(CREATED, 'a')
+        time.sleep(0.1)
+        self.coalescer.add(MODIFIED, 'a')
+        self.assertTrue(self.emitted.wait(5))
+        self.assertTrue(time.time() - started >= 0.3)
+        self.assertEqual(self.events, [(CREATED, 'a')])
+
+    def test_emitted_at_max_latency(self):
+        self.coalescer = event_coalescer.Event_Coalescer(self._emit, 0.2, 0.5)
+        started = time.time()
+        # a file written all the time
+        while not self.emitted.is_set() and time.time() - started < 5:
+            self.coalescer.add(MODIFIED, 'a')
+            time.sleep(0.05)
+        self.assertTrue(self.emitted.is_set())
+        self.assertTrue(0.5 <= time.time() - started < 1.5)
+        self.assertEqual(self.events[0], (MODIFIED, 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
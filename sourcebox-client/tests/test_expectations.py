@@ -0,0 +1,52 @@
+#
+# tests of the expectation table: which events the client caused itself
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import time
+import unittest
+
+import expectations
+from event_coalescer import CREATED, MODIFIED, DELETED
+
+
+class Expectation_Table_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.table = expectations.Expectation_Table(30)
+
+    def test_expectation_without_signature_is_used_up(self):
+        self.table.expect('a', [DELETED])
+        self.assertFalse(self.table.match('a', CREATED))
+        self.assertTrue(self.table.match('a', DELETED))
+        self.assertFalse(self.table.match('a', DELETED))
+
+    def test_signature_tells_own_write_from_user_change(self):
+        self.table.expect('a', [CREATED, MODIFIED], (3, 100.0))
+        self.assertTrue(self.table.match('a', CREATED, (3, 100.0)))
+        self.assertTrue(self.table.match('a', MODIFIED, (3, 100.0)))
+        # the user wrote the file right after the client
+        self.assertFalse(self.table.match('a', MODIFIED, (5, 101.0)))
+
+    def test_tree_covers_everything_under_a_directory(self):
+        self.table.expect('d', [DELETED], tree=True)
+        self.assertTrue(self.table.match('d', DELETED))
+        self.assertTrue(self.table.match(os.path.join('d', 'e', 'a'), DELETED))
+        self.assertTrue(self.table.match('d', DELETED))
+        self.assertFalse(self.table.match(os.path.join('d', 'a'), MODIFIED))
+        self.assertFalse(self.table.match('dd', DELETED))
+
+    def test_expectations_expire(self):
+        table = expectations.Expectation_Table(0.1)
+        table.expect('a', [DELETED])
+        table.expect('d', [DELETED], tree=True)
+        time.sleep(0.2)
+        self.assertFalse(table.match('a', DELETED))
+        self.assertFalse(table.match(os.path.join('d', 'a'), DELETED))
+        self.assertEqual(len(table), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
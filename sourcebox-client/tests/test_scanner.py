@@ -0,0 +1,111 @@
+#
+# tests of the scanner: the walk, known and skipped files, and hashing in
+# this process or in the pool
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import scanner
+
+
+class Scanner_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scanners = []
+        self.submitted = 0
+        self._write(os.path.join('d', 'a'), 'a')
+        self._write(os.path.join('d', 'e', 'b'), 'b')
+        self._write(os.path.join('skip', 'c'), 'c')
+        self._write('f', 'f')
+
+    def tearDown(self):
+        for files_scanner in self.scanners:
+            files_scanner.close()
+        shutil.rmtree(self.directory)
+
+    def _write(self, path, content):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as data_file:
+            data_file.write(content)
+
+    # a started scanner that counts the batches handed to the pool
+    def _scanner(self, workers):
+        files_scanner = scanner.Scanner(workers)
+        files_scanner.start()
+        submit = files_scanner._submit
+
+        def counting_submit(pool, root, entries):
+            self.submitted += 1
+            return submit(pool, root, entries)
+        files_scanner._submit = counting_submit
+        self.scanners.append(files_scanner)
+        return files_scanner
+
+    # scans the directory
+    # @returns path -> digest (True for a directory)
+    def _scan(self, files_scanner, **kwargs):
+        return dict((entry.path, True if entry.is_dir else entry.digest)
+                    for entry in files_scanner.scan(self.directory, **kwargs))
+
+    def _many_files(self):
+        for number in range(scanner.PARALLEL_THRESHOLD):
+            self._write(os.path.join('many', str(number)), str(number))
+
+    def test_walk_skip_and_known(self):
+        found = self._scan(self._scanner(1), skip=lambda path, is_dir: path == 'skip',
+                           known=lambda path, stat: 'known' if path == 'f' else None)
+        self.assertEqual(found, {
+            'd': True, os.path.join('d', 'e'): True,
+            os.path.join('d', 'a'): hashlib.sha256('a').hexdigest(),
+            os.path.join('d', 'e', 'b'): hashlib.sha256('b').hexdigest(),
+            'f': 'known'})
+
+    def test_walk_without_scandir(self):
+        expected = self._scan(self._scanner(1))
+        saved = scanner._scandir
+        scanner._scandir = None
+        try:
+            self.assertEqual(self._scan(self._scanner(1)), expected)
+        finally:
+            scanner._scandir = saved
+
+    def test_few_files_are_hashed_in_this_process(self):
+        files_scanner = self._scanner(2)
+        self.assertNotEqual(files_scanner._pool, None)
+        self.assertEqual(self._scan(files_scanner), self._scan(self._scanner(1)))
+        self.assertEqual(self.submitted, 0)
+
+    def test_many_files_are_hashed_in_the_pool(self):
+        self._many_files()
+        files_scanner = self._scanner(2)
+        progress = []
+        files_scanner.progress = lambda files, size: progress.append((files, size))
+        found = self._scan(files_scanner)
+        self.assertTrue(self.submitted > 0)
+        self.assertEqual(found, self._scan(self._scanner(1)))
+        self.assertEqual(found[os.path.join('many', '7')], hashlib.sha256('7').hexdigest())
+        self.assertEqual(progress[-1][0], scanner.PARALLEL_THRESHOLD + 4)
+
+    def test_closing_scan_early_stops_the_pool(self):
+        self._many_files()
+        files_scanner = self._scanner(2)
+        scan = files_scanner.scan(self.directory, skip=lambda path, is_dir: is_dir and path != 'many')
+        self.assertTrue(scan.next().is_dir)
+        self.assertFalse(scan.next().is_dir)
+        scan.close()
+        self.assertEqual(files_scanner._pool, None)
+        # the next scan hashes in this process
+        self.assertEqual(len(self._scan(files_scanner)), scanner.PARALLEL_THRESHOLD + 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
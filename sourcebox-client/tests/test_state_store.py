@@ -0,0 +1,78 @@
+#
+# tests of the state store: hashed and synced versions, across restarts
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import state_store
+
+
+class State_Store_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = self._open()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        return state_store.State_Store(os.path.join(self.directory, 'state.db'))
+
+    # writes a file and returns its stat
+    def _write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as data_file:
+            data_file.write(content)
+        return os.stat(path)
+
+    def test_hashed_keeps_synced_version(self):
+        stat = self._write('a', 'one')
+        self.store.synced('a', 'rev1', stat)
+        self.assertEqual((self.store.get('a').digest, self.store.get('a').rev), ('rev1', 'rev1'))
+        stat = self._write('a', 'three')
+        self.store.hashed([('a', stat, 'digest2'), ('b', stat, 'digest3')])
+        self.assertEqual((self.store.get('a').digest, self.store.get('a').rev), ('digest2', 'rev1'))
+        self.assertEqual(self.store.get('b').rev, None)
+        self.assertEqual(self.store.get('c'), None)
+
+    def test_matches_only_unchanged_file(self):
+        stat = self._write('a', 'one')
+        self.store.hashed([('a', stat, 'digest1')])
+        self.assertTrue(self.store.get('a').matches(stat))
+        self.assertFalse(self.store.get('a').matches(self._write('a', 'three')))
+        self.assertFalse(state_store.File_State(stat.st_size, stat.st_mtime, stat.st_ino)
+                         .matches(stat))
+
+    def test_move_and_remove_directory(self):
+        stat = self._write('a', 'one')
+        self.store.hashed([(os.path.join('d', 'a'), stat, 'digest1'),
+                           (os.path.join('d', 'e', 'b'), stat, 'digest2'),
+                           ('dd', stat, 'digest3')])
+        self.store.move('d', 'f')
+        self.assertEqual(sorted(path for path, state in self.store.items()),
+                         ['dd', os.path.join('f', 'a'), os.path.join('f', 'e', 'b')])
+        self.assertEqual(self.store.get(os.path.join('f', 'e', 'b')).digest, 'digest2')
+        self.store.remove('f')
+        self.assertEqual([path for path, state in self.store.items()], ['dd'])
+
+    def test_state_survives_restart(self):
+        stat = self._write('a', 'one')
+        self.store.synced('a', 'rev1', stat)
+        self.store.hashed([('b', stat, 'digest2')])
+        self.store.remove('b')
+        self.store.close()
+        self.store = self._open()
+        self.assertTrue(self.store.get('a').matches(stat))
+        self.assertEqual(self.store.get('a').rev, 'rev1')
+        self.assertEqual(self.store.get('b'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
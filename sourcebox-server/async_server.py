@@ -0,0 +1,545 @@
+#
+# Async_Server
+# event loop server mode
+#
+# All client sockets are handled by one asyncore event loop: accepting,
+# the INIT handshake, reading and writing never block. Frames are decoded in
+# the loop and the commands are handed to a pool of worker threads, which do
+# the disk and RCS work. The commands of one client are executed one after
+# the other (in the order they were sent), different clients run in parallel.
+# Large file contents are written to their spool files by the workers too:
+# the loop stops reading from the client until they are written.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import asyncore
+import collections
+import errno
+import logging
+import Queue
+import socket
+import threading
+import time
+import protocol
+import server_communication_controller
+
+
+# Pool of worker threads
+class Executor(object):
+
+    # Constructor
+    # @param workers the number of worker threads
+    def __init__(self, workers):
+        self.log = logging.getLogger("server")
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for number in range(max(1, workers)):
+            worker = threading.Thread(
+                target=self._work, name='Worker ' + str(number))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    # runs a function on one of the workers
+    # @param function the function
+    # @param args the arguments
+    def submit(self, function, *args):
+        self._tasks.put((function, args))
+
+    # stops the workers after the queued tasks are done
+    def shutdown(self):
+        for worker in self._threads:
+            self._tasks.put((None, None))
+
+    # worker thread
+    def _work(self):
+        while True:
+            function, args = self._tasks.get()
+            if function is None:
+                return
+            try:
+                function(*args)
+            except Exception:
+                self.log.exception('Task ' + getattr(function, '__name__', '?') + ' failed')
+
+
+# Runs the tasks of one client one after the other on an Executor
+class Serial_Queue(object):
+
+    # Constructor
+    # @param executor the Executor
+    def __init__(self, executor):
+        self.log = logging.getLogger("server")
+        self.executor = executor
+        self._tasks = collections.deque()
+        self._running = False
+        self._lock = threading.Lock()
+
+    # queues a function
+    # @param function the function
+    # @param args the arguments
+    def submit(self, function, *args):
+        with self._lock:
+            self._tasks.append((function, args))
+            if self._running:
+                return
+            self._running = True
+        self.executor.submit(self._run_next)
+
+    # number of queued tasks
+    def depth(self):
+        return len(self._tasks)
+
+    # runs the oldest task and schedules the next one
+    def _run_next(self):
+        with self._lock:
+            function, args = self._tasks.popleft()
+        try:
+            function(*args)
+        except Exception:
+            self.log.exception('Task ' + getattr(function, '__name__', '?') + ' failed')
+        finally:
+            with self._lock:
+                if self._tasks:
+                    self.executor.submit(self._run_next)
+                else:
+                    self._running = False
+
+
+# creates a pair of connected sockets
+def _socket_pair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.socket()
+    writer.connect(listener.getsockname())
+    reader, address = listener.accept()
+    listener.close()
+    return reader, writer
+
+
+# Wakes up the event loop.
+# Other threads queue data on a connection and then wake the loop, so it
+# notices that the connection became writable.
+class Trigger(asyncore.dispatcher):
+
+    # Constructor
+    # @param channel_map the asyncore map of the loop
+    def __init__(self, channel_map):
+        reader, self._writer = _socket_pair()
+        self._writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, reader, channel_map)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    # interrupts the poll of the loop
+    def wake(self):
+        try:
+            self._writer.send('x')
+        except socket.error, err:
+            # the buffer is full, so the loop is woken up anyway
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except socket.error:
+            pass
+
+    def handle_close(self):
+        self.close()
+        self._writer.close()
+
+
+# A client socket in the event loop
+class Async_Connection(asyncore.dispatcher):
+
+    # Constructor
+    # @param server the Async_Server
+    # @param sock the accepted socket
+    def __init__(self, server, sock):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        self.log = logging.getLogger("server")
+        self.server = server
+        self.decoder = protocol.Frame_Decoder(spool_dir=server.parent.data.spool_dir)
+        # set after the INIT handshake
+        self.controller = None
+        self._out = collections.deque()
+        self._out_offset = 0
+        self._out_lock = threading.Lock()
+        self._close_when_done = False
+        # a worker is compressing the Frame_Producer at the head of _out
+        self._preparing = False
+        # a worker is decoding frames (writing a spool file), the loop does
+        # not read meanwhile
+        self._decoding = False
+        self._decode_lock = threading.Lock()
+
+    def readable(self):
+        return not self._decoding and not self._close_when_done
+
+    def writable(self):
+        if self._preparing:
+            return False
+        return bool(self._out) or self._close_when_done
+
+    def handle_read(self):
+        try:
+            if self.decoder.spools():
+                # into the buffer, the spool file is written by a worker
+                data = self.socket.recv(protocol.CHUNK_SIZE)
+                self.decoder.feed(data)
+                count = len(data)
+            else:
+                count = self.decoder.read_from(self.socket)
+            if not count:
+                self.handle_close()
+                return
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if err.errno in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        try:
+            while not self.decoder.spools():
+                frame = self.decoder.next_frame()
+                if frame is None:
+                    return
+                self._handle_frame(frame)
+        except protocol.Protocol_Error, err:
+            self.log.error('Protocol error, closing connection: ' + str(err))
+            self.handle_close()
+            return
+        self._decoding = True
+        self.server.executor.submit(self._decode_spooled)
+
+    # decodes the buffered frames on a worker (writes the spool file) and
+    # lets the loop read again
+    def _decode_spooled(self):
+        try:
+            for frame in self.decoder:
+                if not self.connected:
+                    break
+                self._handle_frame(frame)
+        except protocol.Protocol_Error, err:
+            self.log.error('Protocol error, closing connection: ' + str(err))
+            self.close_when_done()
+        except (IOError, OSError), err:
+            self.log.error('Could not spool a file, closing connection: ' + str(err))
+            self.close_when_done()
+        finally:
+            with self._decode_lock:
+                self._decoding = False
+                if not self.connected:
+                    # closed meanwhile, handle_close left the decoder to us
+                    self.decoder.close()
+            self.server.trigger.wake()
+
+    # handles a decoded frame (in the loop thread)
+    # @param frame the frame
+    def _handle_frame(self, frame):
+        if self.controller is not None:
+            self.controller.handle_frame(frame)
+        elif frame.opcode == protocol.OP_INIT:
+            flags = self.server.parent.negotiate(frame)
+            self.push(protocol.encode_frame(protocol.OP_OK, flags=flags, seq=frame.seq))
+            self.controller = Async_Communication_Controller(
+                self.server.parent, self, frame.payload, self.server.executor,
+                bool(flags & protocol.FLAG_COMPRESSED))
+            # the initial sync runs on the workers, the loop goes on
+            self.controller.strand.submit(
+                self.server.parent.login_client, self.controller,
+                bool(flags & protocol.FLAG_MANIFEST))
+        else:
+            self.log.warning('Init failed')
+            self.handle_close()
+
+    # queues data to be sent (may be called from any thread)
+    # @param data the strings (or File_Producers) to send, or functions
+    #        called once everything queued before them is sent
+    def push(self, *data):
+        with self._out_lock:
+            self._out.extend(chunk for chunk in data if chunk)
+        if threading.current_thread() is not self.server.loop_thread:
+            self.server.trigger.wake()
+
+    # closes the connection as soon as all queued data is sent
+    def close_when_done(self):
+        self._close_when_done = True
+        self.push()
+
+    # number of bytes waiting to be sent
+    def queued_bytes(self):
+        with self._out_lock:
+            queued = 0
+            for chunk in self._out:
+                if isinstance(chunk, protocol.File_Producer):
+                    queued += chunk.remaining
+                elif not callable(chunk):
+                    queued += len(chunk)
+            return queued - self._out_offset
+
+    def handle_write(self):
+        with self._out_lock:
+            # everything queued before these functions is sent
+            callbacks = []
+            while self._out and callable(self._out[0]):
+                callbacks.append(self._out.popleft())
+        for callback in callbacks:
+            callback()
+        with self._out_lock:
+            # replace a File_Producer at the head by its next chunk, unless
+            # it can send directly from the file
+            producer = None
+            while self._out and isinstance(self._out[0], protocol.File_Producer):
+                if isinstance(self._out[0], protocol.Frame_Producer) and not self._out[0].prepared():
+                    # compressing takes a while, the loop must not wait for it
+                    self._preparing = True
+                    self.server.executor.submit(self._prepare, self._out[0])
+                    return
+                if self._out[0].direct():
+                    producer = self._out[0]
+                    break
+                chunk = self._out[0].more()
+                if chunk:
+                    self._out.appendleft(chunk)
+                else:
+                    self._out.popleft()
+            if not self._out:
+                chunk = None
+            else:
+                chunk = self._out[0]
+        if callable(chunk):
+            # the next call runs it
+            return
+        if producer is not None:
+            self._send_direct(producer)
+            return
+        if chunk is None:
+            if self._close_when_done:
+                self.handle_close()
+            return
+        sent = self.send(buffer(chunk, self._out_offset))
+        with self._out_lock:
+            self._out_offset += sent
+            if self._out_offset >= len(chunk):
+                self._out.popleft()
+                self._out_offset = 0
+            done = not self._out
+        if done and self._close_when_done:
+            self.handle_close()
+
+    # sends the next part of a File_Producer at the head with sendfile
+    # @param producer the File_Producer
+    def _send_direct(self, producer):
+        try:
+            producer.send_to(self.socket)
+        except (OSError, IOError, socket.error), err:
+            if err.errno in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if not producer.remaining:
+            with self._out_lock:
+                if self._out and self._out[0] is producer:
+                    self._out.popleft()
+            producer.close()
+            if self._close_when_done and not self._out:
+                self.handle_close()
+
+    # prepares a Frame_Producer (on a worker) and wakes up the loop again
+    # @param producer the Frame_Producer
+    def _prepare(self, producer):
+        try:
+            producer.prepare()
+        finally:
+            self._preparing = False
+            self.server.trigger.wake()
+
+    def handle_close(self):
+        self.close()
+        with self._decode_lock:
+            if not self._decoding:
+                self.decoder.close()
+        with self._out_lock:
+            for chunk in self._out:
+                if isinstance(chunk, protocol.File_Producer):
+                    chunk.close()
+            self._out.clear()
+        if self.controller is not None:
+            self.controller.requests.close()
+            self.server.parent.remove_client(self.controller.computer_name)
+            self.controller = None
+
+    def handle_error(self):
+        self.log.exception('Error on the connection')
+        self.handle_close()
+
+
+# Communication controller of a client in the event loop.
+# Uses the same commands as the threaded Server_Communication_Controller, but
+# does not own a thread and never waits for the client.
+class Async_Communication_Controller(server_communication_controller.Server_Communication_Controller):
+
+    # Constructor
+    # @param parent the sourceBox server object
+    # @param channel the Async_Connection
+    # @param computer_name the computer_name of the client
+    # @param executor the Executor running the commands
+    # @param compress if True, file contents are compressed (negotiated in the INIT handshake)
+    def __init__(self, parent, channel, computer_name, executor, compress=False):
+        self.log = logging.getLogger("server")
+        self.log.info(
+            'Server Created Async_Communication_Controller for ' + computer_name)
+        self.parent = parent
+        self.connection = channel
+        self.computer_name = computer_name
+        self.decoder = channel.decoder
+        self.compress = compress
+        self.requests = protocol.Request_Tracker(self.WINDOW, self.TIMEOUT)
+        self._init_stats()
+        # the commands of this client, executed in order
+        self.strand = Serial_Queue(executor)
+        # requests waiting for a free slot in the window
+        self.outbox = collections.deque()
+        self._outbox_lock = threading.RLock()
+        self._draining = False
+
+    def __del__(self):
+        pass
+
+    # handles a frame of the client (in the loop thread)
+    # @param frame the frame
+    def handle_frame(self, frame):
+        if frame.opcode in protocol.ANSWER_OPCODES:
+            self._parse_command(frame)
+            self.drain()
+        else:
+            self.strand.submit(self._parse_command, frame)
+
+    def _send(self, opcode, path='', payload='', seq=0, source=None, flags=0):
+        if source is not None:
+            # the file is read chunk by chunk while the socket is writable
+            self.connection.push(protocol.Frame_Producer(
+                opcode, path, source, flags, seq, self.compress))
+        else:
+            if self.compress:
+                payload, flags = protocol.compress_payload(opcode, payload, flags)
+            self.connection.push(
+                protocol.encode_header(opcode, path, len(payload), flags, seq), payload)
+
+    # queues a request, it is sent as soon as the window has room
+    # (never blocks, the answer is handled by the callback)
+    def _send_request(self, opcode, path='', payload='', wait=True, source=None, flags=0, callback=None,
+                      timeout=None):
+        if self.queue_depth() >= self.OUTBOX_LIMIT:
+            self.log.error('Client ' + self.computer_name + ' does not keep up, disconnecting')
+            self.connection.close_when_done()
+            return
+        with self._outbox_lock:
+            self.outbox.append((time.time(), opcode, path, payload, source, flags, callback, timeout))
+        self.drain()
+
+    # sends queued requests while the window has room (may be called from any thread)
+    def drain(self):
+        with self._outbox_lock:
+            # callbacks of expired requests may queue requests, the loop below sends them
+            if self._draining:
+                return
+            self._draining = True
+            try:
+                while self.outbox:
+                    queued, opcode, path, payload, source, flags, callback, timeout = self.outbox[0]
+                    try:
+                        request = self.requests.register(
+                            opcode, path, self._delivery_callback(queued, callback), block=False,
+                            timeout=timeout)
+                    except IOError:
+                        # the connection is closed
+                        self.outbox.clear()
+                        return
+                    if request is None:
+                        return
+                    self.outbox.popleft()
+                    self._deliver(request, opcode, path, payload, source, flags)
+            finally:
+                self._draining = False
+
+    # _send only queues the frame: the timeout starts when the connection
+    # has written it
+    def _sent(self, request):
+        self.connection.push(request.sent)
+
+    # number of requests waiting to be sent
+    def queue_depth(self):
+        return len(self.outbox)
+
+    def stats(self):
+        stats = server_communication_controller.Server_Communication_Controller.stats(self)
+        stats['queued_bytes'] = self.connection.queued_bytes()
+        return stats
+
+    def _close_connection(self, frame):
+        self._send(self.COMMAND_OK, seq=frame.seq)
+        self.requests.close()
+        self.connection.close_when_done()
+        self.parent.remove_client(self.computer_name)
+
+    def send_close(self):
+        self._send_request(protocol.OP_CLOSE)
+        self.connection.close_when_done()
+
+
+# The listening socket and the event loop
+class Async_Server(asyncore.dispatcher):
+
+    # Constructor
+    # @param parent the sourceBox server object
+    # @param port the port to listen on
+    # @param workers the number of worker threads
+    # @param backlog the size of the listen queue
+    def __init__(self, parent, port, workers, backlog):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.log = logging.getLogger("server")
+        self.parent = parent
+        self.loop_thread = None
+        self.executor = Executor(workers)
+        self.trigger = Trigger(self.map)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(('', port))
+        self.listen(backlog)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, address = pair
+        self.log.debug('Connection from ' + str(address))
+        Async_Connection(self, sock)
+
+    # runs the event loop until the server is closed
+    def serve_forever(self):
+        self.loop_thread = threading.current_thread()
+        while self.map:
+            asyncore.loop(timeout=1.0, use_poll=True, map=self.map, count=1)
+            for comm in self.parent.active_clients.values():
+                comm.requests.expire()
+                comm.drain()
+
+    # closes all connections and stops the workers
+    def shutdown(self):
+        asyncore.close_all(self.map)
+        self.executor.shutdown()
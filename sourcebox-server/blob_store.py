@@ -0,0 +1,148 @@
+#
+# Blob_Store
+# content-addressed storage of file contents
+#
+# Every content is stored once, under its sha256 digest:
+#   <root>/<first two hex digits>/<remaining hex digits>
+# Blobs are never changed after they were added. Where the filesystem allows
+# it, a blob is a hard link to the file in the data directory, so a content
+# does not take up space twice. The data directory therefore has to replace
+# files (write a new file and rename it) instead of writing into them.
+#
+# A blob nothing uses any more is removed by sweep: it is not the content of
+# a current file (a hard link to it or a digest the caller knows) and it was
+# not added, checked out or released for max_age seconds. Old revisions are
+# kept in the ,v files, the blob of an old content only saves a client
+# sending it again, and a fan out streaming it meanwhile still finds it.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import protocol
+
+# seconds a blob nothing uses is kept
+SWEEP_AGE = 24 * 3600
+
+class Blob_Store(object):
+
+    # Constructor
+    # @param root the directory of the store
+    # @param spool_dir directory for temporary files (same filesystem as root)
+    def __init__(self, root, spool_dir):
+        self.log = logging.getLogger("server")
+        self.root = root
+        self.spool_dir = spool_dir
+        # held while a blob is added or removed
+        self._lock = threading.Lock()
+        # hex digest -> the last time the blob was added, checked out or released
+        self._used = {}
+
+    # returns the path of a blob
+    # @param digest the hex digest
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    # checks if a blob is stored
+    # @param digest the hex digest
+    def has(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    # adds the content of a file
+    # @param source the file (it must not be changed in place afterwards)
+    # @param digest the hex digest of the content if it is known already
+    #        (it is not computed again)
+    # @returns the hex digest
+    def add(self, source, digest=None):
+        if digest is None:
+            digest = protocol.hash_file(source)
+        with self._lock:
+            if not self.has(digest):
+                target = self.path(digest)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                temp = self._temp_path(os.path.dirname(target))
+                self._link_or_copy(source, temp)
+                os.rename(temp, target)
+            self._used[digest] = time.time()
+        return digest
+
+    # creates a temporary copy of a blob, e.g. to move it into the data directory
+    # @param digest the hex digest
+    # @returns the path of the copy (in spool_dir) or None if the blob is not stored
+    def checkout(self, digest):
+        with self._lock:
+            if not self.has(digest):
+                return None
+            self._used[digest] = time.time()
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        temp = self._temp_path(self.spool_dir)
+        try:
+            self._link_or_copy(self.path(digest), temp)
+        except (IOError, OSError), err:
+            self.log.error('Could not read blob ' + digest + ': ' + str(err))
+            return None
+        return temp
+
+    # records that files do not have a content any more (it was deleted or
+    # replaced), sweep keeps the blob for max_age seconds from now on
+    # @param digests the hex digests
+    def release(self, digests):
+        now = time.time()
+        with self._lock:
+            for digest in digests:
+                self._used[digest] = now
+
+    # removes the blobs nothing uses any more
+    # @param referenced the hex digests of the current files
+    # @param max_age seconds since a blob was added, checked out or released
+    # @returns (number of removed blobs, bytes)
+    def sweep(self, referenced, max_age=SWEEP_AGE):
+        deadline = time.time() - max_age
+        removed = size = 0
+        if not os.path.isdir(self.root):
+            return removed, size
+        for directory in os.listdir(self.root):
+            for name in os.listdir(os.path.join(self.root, directory)):
+                digest = directory + name
+                if digest in referenced:
+                    continue
+                path = os.path.join(self.root, directory, name)
+                with self._lock:
+                    try:
+                        stat = os.stat(path)
+                        # a hard link of a current file (or of a spool file)
+                        if stat.st_nlink > 1:
+                            continue
+                        if max(stat.st_ctime, self._used.get(digest, 0)) >= deadline:
+                            continue
+                        os.remove(path)
+                        self._used.pop(digest, None)
+                    except OSError, err:
+                        self.log.error('Could not remove blob ' + path + ': ' + str(err))
+                        continue
+                removed += 1
+                size += stat.st_size
+        return removed, size
+
+    # returns a free temporary file name in a directory
+    def _temp_path(self, directory):
+        handle, temp = tempfile.mkstemp(prefix='.sb-', dir=directory)
+        os.close(handle)
+        os.remove(temp)
+        return temp
+
+    # hard links a file or copies it, if linking is not possible
+    def _link_or_copy(self, source, target):
+        try:
+            os.link(source, target)
+        except (AttributeError, OSError):
+            # no hard links on this platform or filesystem
+            shutil.copyfile(source, target)
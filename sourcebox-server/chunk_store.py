@@ -0,0 +1,330 @@
+#
+# Chunk_Store
+# the chunks of the files that were sent in chunks
+#
+# Every chunk is stored once, under its sha256 digest:
+#   <root>/<first two hex digits>/<remaining hex digits>
+# The chunk list of the current version of every file that was sent in
+# chunks is kept in an sqlite database (and in a dictionary), so the client
+# only has to send the chunks that changed with the next version. Once the
+# file is stored, its list also records the blob of the file and the sizes
+# of the chunks: the chunks are read from the blob from then on and their
+# own copies are removed, so a large file is not stored twice. Chunks that no
+# list refers to belong to transfers that were interrupted (they go on with
+# the next CHUNKS) or to old versions; sweep removes them after a while.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import path_index
+import protocol
+
+# seconds an unused chunk is kept (an interrupted transfer goes on with it)
+SWEEP_AGE = 24 * 3600
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunk_lists (
+    path TEXT PRIMARY KEY,
+    digests TEXT,
+    blob TEXT,
+    sizes TEXT
+)'''
+
+
+class Chunk_Store(object):
+
+    # Constructor
+    # @param root the directory of the chunks
+    # @param db_path the sqlite database of the chunk lists
+    # @param blob_path returns the path of a blob (Blob_Store.path)
+    def __init__(self, root, db_path, blob_path):
+        self.log = logging.getLogger("server")
+        self.root = root
+        self.blob_path = blob_path
+        # held while the lists are changed
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute(_SCHEMA)
+            # the lists of older versions have no blob
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(chunk_lists)')]
+            if 'blob' not in columns:
+                self._db.execute('ALTER TABLE chunk_lists ADD COLUMN blob TEXT')
+                self._db.execute('ALTER TABLE chunk_lists ADD COLUMN sizes TEXT')
+        # path -> hex digests of the chunks
+        self._lists = {}
+        # path -> (hex digest of the blob, sizes of the chunks) of the stored files
+        self._blobs = {}
+        # hex digest of a chunk -> (hex digest of a blob, offset, size)
+        self._located = {}
+        for path, digests, blob, sizes in self._db.execute(
+                'SELECT path, digests, blob, sizes FROM chunk_lists'):
+            self._lists[path] = [digests[pos:pos + 64] for pos in xrange(0, len(digests), 64)]
+            if blob:
+                self._blobs[path] = (blob, [int(size) for size in sizes.split(',')])
+        self._locate()
+
+    # returns the path of a chunk
+    # @param digest the hex digest
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    # checks if a chunk is stored (on its own or in a blob)
+    # @param digest the hex digest
+    def has(self, digest):
+        return os.path.isfile(self.path(digest)) or self._in_blob(digest) is not None
+
+    # returns the chunks of a list that are not stored
+    # @param digests the hex digests
+    # @returns the indexes of the missing chunks (each digest once)
+    def missing(self, digests):
+        seen = set()
+        indexes = []
+        for index, digest in enumerate(digests):
+            if digest not in seen and not self.has(digest):
+                indexes.append(index)
+            seen.add(digest)
+        return indexes
+
+    # stores a chunk
+    # @param content the content of the chunk
+    # @returns the hex digest
+    def add(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        target = self.path(digest)
+        if os.path.isfile(target):
+            # used again, so sweep keeps it
+            os.utime(target, None)
+            return digest
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temp = tempfile.mkstemp(prefix='.sb-', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(content)
+            os.rename(temp, target)
+        except (IOError, OSError):
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return digest
+
+    # puts the chunks of a file together
+    # @param digests the hex digests of the chunks, in order
+    # @param directory the directory of the new file
+    # @returns (path of the new file (a temporary file in directory), sizes of the
+    #          chunks, hex digest of the file)
+    # @throws IOError if a chunk is missing
+    def assemble(self, digests, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temp = tempfile.mkstemp(prefix='.sb-', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                target = _Hashing_Writer(temp_file)
+                sizes = [self._copy_chunk(digest, target) for digest in digests]
+        except (IOError, OSError):
+            os.remove(temp)
+            raise
+        return temp, sizes, target.hexdigest()
+
+    # returns the chunk list of a file
+    # @param path the path relative to the sourceBox
+    # @returns the hex digests or None if the file was not sent in chunks
+    def get_list(self, path):
+        return self._lists.get(os.path.normpath(path))
+
+    # records the chunk list of the current version of a file, the chunks
+    # are read from its blob from now on
+    # @param path the path relative to the sourceBox
+    # @param digests the hex digests
+    # @param blob the hex digest of the blob of the file (None: the chunks are kept)
+    # @param sizes the sizes of the chunks (see assemble)
+    def set_list(self, path, digests, blob=None, sizes=None):
+        if blob is None:
+            sizes = None
+        self._store([(os.path.normpath(path), list(digests), blob, sizes)], [])
+        if blob is None:
+            return
+        # the copies of the chunks are not needed any more
+        for digest in set(digests):
+            try:
+                os.remove(self.path(digest))
+            except OSError, err:
+                if os.path.exists(self.path(digest)):
+                    self.log.error('Could not remove chunk ' + digest + ': ' + str(err))
+
+    # returns the blobs the chunk lists refer to
+    # @returns a set of hex digests
+    def blobs(self):
+        with self._lock:
+            return set(blob for blob, sizes in self._blobs.itervalues())
+
+    # forgets the chunk lists of a file or of everything in a directory
+    # @param path the path relative to the sourceBox
+    def remove(self, path):
+        self._store([], self._under(os.path.normpath(path)))
+
+    # moves the chunk lists of a file or of everything in a directory
+    # @param old_path old path relative to the sourceBox
+    # @param new_path new path relative to the sourceBox
+    def move(self, old_path, new_path):
+        old_path = os.path.normpath(old_path)
+        new_path = os.path.normpath(new_path)
+        with self._lock:
+            moved = self._under(old_path)
+            self._store([(new_path + key[len(old_path):], self._lists[key])
+                          + self._blobs.get(key, (None, None)) for key in moved], moved)
+
+    # removes the chunks that no list refers to and that were not used for a while
+    # @param max_age seconds since a chunk was stored or used last
+    # @returns (number of removed chunks, bytes)
+    def sweep(self, max_age):
+        with self._lock:
+            used = set()
+            for digests in self._lists.itervalues():
+                used.update(digests)
+        deadline = time.time() - max_age
+        removed = size = 0
+        if not os.path.isdir(self.root):
+            return removed, size
+        for directory in os.listdir(self.root):
+            for name in os.listdir(os.path.join(self.root, directory)):
+                if directory + name in used:
+                    continue
+                path = os.path.join(self.root, directory, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime < deadline:
+                        os.remove(path)
+                        removed += 1
+                        size += stat.st_size
+                except OSError, err:
+                    self.log.error('Could not remove chunk ' + path + ': ' + str(err))
+        return removed, size
+
+    # closes the database
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # the paths of the lists of a file or of everything in a directory (a range query on the
+    # primary key, the paths in a directory follow each other)
+    def _under(self, path):
+        low, high = path_index.prefix_range(path)
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT path FROM chunk_lists WHERE path = ? OR (path >= ? AND path < ?)',
+                (path, low, high))]
+
+    # writes lists and removes paths in one transaction
+    # @param entries (path, hex digests, hex digest of the blob or None,
+    #        sizes of the chunks or None) to write
+    # @param removed the paths to remove
+    def _store(self, entries, removed):
+        if not entries and not removed:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM chunk_lists WHERE path = ?',
+                                     [(path,) for path in removed])
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO chunk_lists VALUES (?, ?, ?, ?)',
+                    [(path, ''.join(digests), blob,
+                      ','.join(str(size) for size in sizes) if sizes else None)
+                     for path, digests, blob, sizes in entries])
+            for path in removed:
+                self._lists.pop(path, None)
+                self._blobs.pop(path, None)
+            for path, digests, blob, sizes in entries:
+                self._lists[path] = digests
+                if blob is not None:
+                    self._blobs[path] = (blob, sizes)
+                else:
+                    self._blobs.pop(path, None)
+            self._locate()
+
+    # finds the chunks of the lists in their blobs
+    def _locate(self):
+        located = {}
+        for path, (blob, sizes) in self._blobs.iteritems():
+            offset = 0
+            for digest, size in zip(self._lists[path], sizes):
+                located.setdefault(digest, (blob, offset, size))
+                offset += size
+        self._located = located
+
+    # returns where a chunk is in a blob
+    # @returns (path of the blob, offset, size) or None if no stored blob has it
+    def _in_blob(self, digest):
+        location = self._located.get(digest)
+        if location is None:
+            return None
+        blob, offset, size = location
+        path = self.blob_path(blob)
+        if not os.path.isfile(path):
+            return None
+        return path, offset, size
+
+    # copies a chunk into a file, from its own copy or from a blob
+    # @returns the size of the chunk
+    # @throws IOError if the chunk is not stored
+    def _copy_chunk(self, digest, target):
+        try:
+            chunk_file = open(self.path(digest), 'rb')
+        except IOError:
+            # read from the blob of a stored file
+            location = self._in_blob(digest)
+            if location is None:
+                raise
+        else:
+            copied = 0
+            with chunk_file:
+                chunk = chunk_file.read(protocol.CHUNK_SIZE)
+                while chunk:
+                    target.write(chunk)
+                    copied += len(chunk)
+                    chunk = chunk_file.read(protocol.CHUNK_SIZE)
+            return copied
+        path, offset, size = location
+        hashed = hashlib.sha256()
+        with open(path, 'rb') as blob_file:
+            blob_file.seek(offset)
+            left = size
+            while left > 0:
+                chunk = blob_file.read(min(left, protocol.CHUNK_SIZE))
+                if not chunk:
+                    break
+                hashed.update(chunk)
+                target.write(chunk)
+                left -= len(chunk)
+        if hashed.hexdigest() != digest:
+            raise IOError('Chunk ' + digest + ' is not where its list says')
+        return size
+
+
+# a file that computes the sha256 digest of what is written to it
+class _Hashing_Writer(object):
+
+    # Constructor
+    # @param target the file written to
+    def __init__(self, target):
+        self.target = target
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self._digest.update(data)
+        self.target.write(data)
+
+    # returns the hex digest of everything written so far
+    def hexdigest(self):
+        return self._digest.hexdigest()
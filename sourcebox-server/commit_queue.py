@@ -0,0 +1,203 @@
+#
+# Commit_Queue
+# checks in the modifications of files in the background
+#
+# Every modification of a file is added to the queue. Modifications of the
+# same file within the window are checked in as one revision, by a single
+# thread, so saving a file does not wait for RCS. The queue holds at most
+# max_depth files; if it is full, the oldest file is checked in right away
+# by the thread adding a new one. flush checks in pending files at once
+# (e.g. before a checkout or on shutdown) and waits for a check in of the
+# files that is already running.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import collections
+import logging
+import os
+import threading
+import time
+
+
+# The modifications of a file that are not checked in yet
+class Pending(object):
+
+    # Constructor
+    # @param path the path relative to the sourceBox
+    # @param user the user who modified the file last
+    # @param since the time (time.time()) of the first modification
+    def __init__(self, path, user, since):
+        self.path = path
+        self.user = user
+        self.since = since
+        self.changes = 1
+
+
+class Commit_Queue(object):
+
+    # Constructor
+    # @param commit called as commit(path, user, changes) to check in a file
+    # @param window seconds modifications of a file are collected
+    # @param max_depth the number of files that can be pending
+    def __init__(self, commit, window, max_depth):
+        self.log = logging.getLogger("server")
+        self.commit = commit
+        self.window = window
+        self.max_depth = max_depth
+        # path -> Pending, in the order of the first modification
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._running = True
+        # path -> number of check ins of the file running right now
+        self._committing = collections.Counter()
+        self.modifications = 0
+        self.commits = 0
+        self.failures = 0
+        # commits done by add because the queue was full
+        self.overflows = 0
+        self._delay_total = 0.0
+        self._delay_max = 0.0
+        self._thread = threading.Thread(target=self._commit_loop, name='Commit queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # adds a modification of a file
+    # @param path the path relative to the sourceBox
+    # @param user the user who modified the file
+    def add(self, path, user):
+        path = os.path.normpath(path)
+        overflow = None
+        with self._condition:
+            self.modifications += 1
+            pending = self._pending.get(path)
+            if pending is not None:
+                pending.user = user
+                pending.changes += 1
+                return
+            if len(self._pending) >= self.max_depth:
+                overflow = self._pending.popitem(last=False)[1]
+                self.overflows += 1
+            self._pending[path] = Pending(path, user, time.time())
+            if overflow is not None:
+                self._committing[overflow.path] += 1
+            if len(self._pending) == 1:
+                self._condition.notify_all()
+        if overflow is not None:
+            self._commit(overflow)
+
+    # checks in the pending modifications of a file, of everything in a
+    # directory or of all files at once. A check in of the files that is
+    # running already is waited for, so the files are checked in when flush
+    # returns (the caller must not hold a lock the check in needs).
+    # @param path the path relative to the sourceBox (None: all files)
+    def flush(self, path=None):
+        if path is not None:
+            path = os.path.normpath(path)
+        with self._condition:
+            while any(_under(key, path) for key in self._committing):
+                self._condition.wait()
+            taken = self._take(path)
+            for pending in taken:
+                self._committing[pending.path] += 1
+        for pending in taken:
+            self._commit(pending)
+
+    # forgets the pending modifications of a file or of everything in a
+    # directory (e.g. if it was deleted)
+    # @param path the path relative to the sourceBox
+    # @returns the dropped Pendings
+    def discard(self, path):
+        return self._take(path)
+
+    # moves the pending modifications of a file or of everything in a directory
+    # @param old_path old path relative to the sourceBox
+    # @param new_path new path relative to the sourceBox
+    def move(self, old_path, new_path):
+        old_path = os.path.normpath(old_path)
+        new_path = os.path.normpath(new_path)
+        with self._condition:
+            moved = self._take(old_path)
+            for pending in moved:
+                pending.path = new_path + pending.path[len(old_path):]
+                self._pending[pending.path] = pending
+            if moved:
+                # keep the order of the first modifications
+                for path, pending in sorted(self._pending.items(), key=lambda item: item[1].since):
+                    self._pending[path] = self._pending.pop(path)
+
+    # stops the thread and checks in everything that is pending
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self.flush()
+
+    # returns the counters of the queue
+    # @returns a dictionary with pending, modifications, commits, failures,
+    #          overflows and the average and maximum delay of a commit
+    def stats(self):
+        with self._condition:
+            done = self.commits + self.failures
+            return {'pending': len(self._pending), 'modifications': self.modifications,
+                    'commits': self.commits, 'failures': self.failures,
+                    'overflows': self.overflows,
+                    'delay_avg': self._delay_total / done if done else 0.0,
+                    'delay_max': self._delay_max}
+
+    # removes the Pendings of a file or of everything in a directory
+    def _take(self, path):
+        with self._condition:
+            if path is None:
+                taken = self._pending.values()
+                self._pending.clear()
+                return taken
+            path = os.path.normpath(path)
+            return [self._pending.pop(key) for key in self._pending.keys() if _under(key, path)]
+
+    # checks in a file (counted in _committing by the caller)
+    def _commit(self, pending):
+        try:
+            self.commit(pending.path, pending.user, pending.changes)
+            failed = False
+        except Exception, err:
+            self.log.error('Could not check in ' + pending.path + ': ' + str(err))
+            failed = True
+        delay = time.time() - pending.since
+        with self._condition:
+            if failed:
+                self.failures += 1
+            else:
+                self.commits += 1
+            self._delay_total += delay
+            self._delay_max = max(self._delay_max, delay)
+            self._committing[pending.path] -= 1
+            if self._committing[pending.path] <= 0:
+                del self._committing[pending.path]
+            self._condition.notify_all()
+
+    # the thread: checks in every file when its window is over
+    def _commit_loop(self):
+        while True:
+            with self._condition:
+                pending = None
+                while self._running:
+                    if self._pending:
+                        first = next(self._pending.itervalues())
+                        due = first.since + self.window - time.time()
+                        if due <= 0:
+                            pending = self._pending.popitem(last=False)[1]
+                            self._committing[pending.path] += 1
+                            break
+                        self._condition.wait(due)
+                    else:
+                        self._condition.wait()
+                if pending is None:
+                    return
+            self._commit(pending)
+
+
+# checks if a path is a file or in a directory (None: everything)
+def _under(key, path):
+    return path is None or key == path or key.startswith(path + os.sep)
@@ -0,0 +1,87 @@
+import ConfigParser
+
+## --------------------------------------------------------------
+## PARSE CONFIG FILE
+## --------------------------------------------------------------
+
+class Config_Parser(object):
+
+	## Constructor
+	# Every option is optional, missing options fall back to the defaults.
+	def __init__(self, config_file):
+		self.configfile = config_file
+		self.config = ConfigParser.ConfigParser()
+		# the patterns of the retention rules are case sensitive
+		self.config.optionxform = str
+		self.config.read(self.configfile)
+
+		self.port = self._getint('server', 'port', 50000)
+		# 'threaded' (one thread per client) or 'async' (event loop)
+		self.mode = self._get('server', 'mode', 'threaded')
+		# number of worker threads doing disk and RCS work in async mode
+		self.workers = self._getint('server', 'workers', 8)
+		# size of the listen queue of the server socket
+		self.backlog = self._getint('server', 'backlog', 128)
+		# compress file contents for clients that support it
+		self.compression = self._getboolean('server', 'compression', True)
+		# seconds between two reports of the delivery statistics (0: never)
+		self.report_interval = self._getint('server', 'report_interval', 60)
+		# 'native' (in-process) or 'subprocess' (calls ci, co, rcs and rlog)
+		self.rcs = self._get('server', 'rcs', 'native')
+		# seconds a lock lasts unless the client locks the file again
+		self.lock_time = self._getint('server', 'lock_time', 30)
+		# megabytes of file contents the server keeps in memory (0: none)
+		self.cache_size = self._getint('server', 'cache_size', 64)
+		# seconds the modifications of a file are collected into one revision
+		self.commit_window = self._getint('server', 'commit_window', 10)
+		# files with modifications that are not checked in yet (if there are
+		# more, the oldest is checked in at once)
+		self.commit_depth = self._getint('server', 'commit_depth', 1000)
+		# when written files are on disk: 'none', 'fsync' (every file) or
+		# 'group' (many files together every group_commit_ms milliseconds)
+		self.durability = self._get('server', 'durability', 'group')
+		self.group_commit_ms = self._getint('server', 'group_commit_ms', 50)
+		# the directories the files are stored in (comma separated, e.g. one
+		# per disk), and how many files per second are moved there from the
+		# data directory of older versions (0: no limit)
+		self.storage_roots = [root.strip() for root in
+			self._get('server', 'storage_roots', './storage').split(',') if root.strip()]
+		self.migrate_rate = self._getint('server', 'migrate_rate', 100)
+		# which old revisions are kept: pattern -> 'keep_last keep_daily
+		# max_age' in the section [retention], the first match wins
+		# (see retention.py)
+		self.retention = self._items('retention')
+		# seconds between two passes of the retention job (0: never) and
+		# the kilobytes per second it writes at most (0: no limit)
+		self.retention_interval = self._getint('server', 'retention_interval', 3600)
+		self.retention_rate = self._getint('server', 'retention_rate', 1024)
+		# seconds between two sweeps removing the blobs and chunks no file
+		# uses any more (0: never)
+		self.sweep_interval = self._getint('server', 'sweep_interval', 3600)
+		# the paths that are not synced, one gitignore-style pattern per line
+		# (see ignore_rules.py)
+		self.ignore = self._get('server', 'ignore', '.DS_Store')
+
+	## reads an optional option
+	def _get(self, section, option, default):
+		if self.config.has_option(section, option):
+			return self.config.get(section, option)
+		return default
+
+	## reads all options of an optional section, in order
+	def _items(self, section):
+		if self.config.has_section(section):
+			return self.config.items(section)
+		return []
+
+	## reads an optional integer option
+	def _getint(self, section, option, default):
+		if self.config.has_option(section, option):
+			return self.config.getint(section, option)
+		return default
+
+	## reads an optional boolean option
+	def _getboolean(self, section, option, default):
+		if self.config.has_option(section, option):
+			return self.config.getboolean(section, option)
+		return default
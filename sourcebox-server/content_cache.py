@@ -0,0 +1,105 @@
+#
+# Content_Cache
+# file contents in memory, at most a number of bytes
+#
+# The least recently used contents are dropped first. Contents larger than
+# max_entry are not cached (they are streamed from disk anyway). The owner
+# has to invalidate a path (or put the new content) after the file changed.
+#
+# A content read from disk on a miss may be outdated by the time it is put:
+# the reader passes the generation from before the read, and put drops the
+# content if anything was invalidated or put since.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import collections
+import os
+import threading
+
+import path_index
+
+
+class Content_Cache(object):
+
+    # Constructor
+    # @param max_bytes the size of all cached contents together (0: no cache)
+    # @param max_entry the size of the largest content that is cached
+    def __init__(self, max_bytes, max_entry):
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # path -> content, least recently used first
+        self._entries = collections.OrderedDict()
+        # the paths of the entries, sorted
+        self._paths = path_index.Path_Index()
+        self._lock = threading.Lock()
+        # counts the changes (invalidate and put without a generation)
+        self._generation = 0
+
+    # returns the generation to pass to put for a content read from disk now
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    # returns a cached content
+    # @param path the path relative to the sourceBox
+    # @returns the content or None
+    def get(self, path):
+        path = os.path.normpath(path)
+        with self._lock:
+            content = self._entries.pop(path, None)
+            if content is None:
+                self.misses += 1
+                return None
+            self._entries[path] = content
+            self.hits += 1
+            return content
+
+    # caches a content
+    # @param path the path relative to the sourceBox
+    # @param content the content
+    # @param generation the generation before the content was read (None:
+    #        the content was just written, it replaces any other)
+    def put(self, path, content, generation=None):
+        path = os.path.normpath(path)
+        with self._lock:
+            if generation is None:
+                self._generation += 1
+            elif generation != self._generation:
+                # read before a change, maybe of this file
+                return
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old)
+                self._paths.discard(path)
+            if len(content) > self.max_entry or len(content) > self.max_bytes:
+                return
+            self._entries[path] = content
+            self._paths.add(path)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                key, old = self._entries.popitem(last=False)
+                self._paths.discard(key)
+                self.size -= len(old)
+                self.evictions += 1
+
+    # drops the content of a file or of everything in a directory
+    # @param path the path relative to the sourceBox
+    def invalidate(self, path):
+        path = os.path.normpath(path)
+        with self._lock:
+            self._generation += 1
+            for key in self._paths.under(path):
+                self._paths.discard(key)
+                self.size -= len(self._entries.pop(key))
+
+    # returns the counters of the cache
+    # @returns a dictionary with entries, size, hits, misses and evictions
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
@@ -1,7 +1,24 @@
 import rcslib
+import native_rcs
+import delta
+import protocol
+import blob_store
+import revision_index
+import content_cache
+import commit_queue
+import durability
+import storage_layout
+import chunk_store
+import path_index
+import retention
+import errno
 import os
 import logging
+import mmap
 import shutil
+import tempfile
+import threading
+import time
 
 # @package Data_Controller
 # handles the communication with the backend
@@ -15,39 +32,411 @@ class Data_Controller(object):
 
     # Creates a new instance of the data controller
     # @param data_dir The directory where the data is being stored
+    # @param rcs_engine 'native' (in-process) or 'subprocess' (the RCS tools)
+    # @param cache_size bytes of file contents kept in memory (0: none)
+    # @param commit_window seconds modifications of a file are collected into one revision
+    # @param commit_depth the number of files with modifications that are not checked in yet
+    # @param durability_mode when written files are on disk: 'none', 'fsync' or 'group' (see durability.py)
+    # @param group_interval seconds between two fsyncs in 'group' mode
+    # @param storage_roots the directories the files are stored in (None: 'storage' next to data_dir)
+    # @param migrate_rate files per second moved from data_dir into the storage roots (0: no limit)
+    # @param retention_rules the retention.Retention_Rules of the old revisions (None: keep everything)
+    # @param retention_interval seconds between two passes of the retention job
+    # @param retention_rate bytes per second the retention job writes at most (0: no limit)
+    # @param sweep_interval seconds between two sweeps of the blobs and chunks (0: never)
     #
-    def __init__(self, data_dir):
-        self.rcs = rcslib.RCS()
-        self.data_dir = './data'
+    def __init__(self, data_dir, rcs_engine='native', cache_size=64 * 1024 * 1024,
+                 commit_window=10, commit_depth=1000, durability_mode='group', group_interval=0.05,
+                 storage_roots=None, migrate_rate=100, retention_rules=None,
+                 retention_interval=3600, retention_rate=1024 * 1024, sweep_interval=3600):
+        if rcs_engine == 'native':
+            self.rcs = native_rcs.Native_RCS()
+        elif rcs_engine == 'subprocess':
+            self.rcs = rcslib.RCS()
+        else:
+            raise ValueError('Unknown RCS engine ' + repr(rcs_engine))
+        # the flat layout of older versions, its files are moved into the
+        # storage roots while the server runs
+        self.data_dir = os.path.normpath(data_dir)
+        base_dir = os.path.dirname(os.path.abspath(self.data_dir))
+        # files are replaced atomically, fsynced depending on the mode
+        self.writer = durability.Durable_Writer(durability_mode, group_interval)
+        # incoming file contents are spooled here
+        self.spool_dir = os.path.join(base_dir, '.spool')
+        # every content is also stored under its digest (see blob_store.py)
+        self.blobs = blob_store.Blob_Store(os.path.join(base_dir, 'blobs'), self.spool_dir)
+        # where every file is stored (see storage_layout.py)
+        self.layout = storage_layout.Storage_Layout(
+            storage_roots or [os.path.join(base_dir, 'storage')],
+            os.path.join(base_dir, 'locations.db'))
+        # the chunks of large files sent in chunks (see chunk_store.py)
+        self.chunks = chunk_store.Chunk_Store(
+            os.path.join(base_dir, 'chunks'), os.path.join(base_dir, 'chunks.db'), self.blobs.path)
+        # digests of the current versions (path relative to data_dir -> hex digest)
+        self.digests = {}
+        # the paths of the digests, sorted
+        self._digest_paths = path_index.Path_Index()
+        # contents of small files, e.g. for the initial sync of many clients
+        # (larger files are streamed from the blob store)
+        self.cache = content_cache.Content_Cache(cache_size, protocol.HAVE_THRESHOLD)
         # catch logging object
         self.log = logging.getLogger("server")
+        adopted = self.layout.adopt(self.data_dir)
+        if adopted:
+            self.log.info('Added %d entries of %s to the storage layout' % (adopted, self.data_dir))
+        swept, swept_size = self.chunks.sweep(chunk_store.SWEEP_AGE)
+        if swept:
+            self.log.info('Removed %d unused chunks (%d bytes)' % (swept, swept_size))
+        # head, lock holder etc. of every file (see revision_index.py)
+        self.index = revision_index.Revision_Index(os.path.join(base_dir, 'revisions.db'), self.data_dir)
+        self.index.rebuild(self._rcs_files())
+        # RCS operations of more than one step (see _commit_revision), and
+        # everything writing a file (the migration must not move it meanwhile)
+        self._rcs_lock = threading.RLock()
+        # modifications are checked in in the background
+        self.commits = commit_queue.Commit_Queue(self._commit_revision, commit_window, commit_depth)
+        # the files of data_dir are moved in the background
+        self._stop = threading.Event()
+        self._migration = None
+        if os.path.isdir(self.data_dir):
+            self._migration = threading.Thread(
+                target=self._migrate, args=(migrate_rate,), name='Storage migration')
+            self._migration.daemon = True
+            self._migration.start()
+        # the last time a client made the server read or write a file
+        self._last_access = 0.0
+        # old revisions are removed in the background (see retention.py)
+        self.retention = None
+        if retention_rules is not None and retention_rules.rules and retention_interval > 0:
+            self.retention = retention.Retention_Job(
+                retention_rules, self._file_paths, self.compact_history, self.idle_time,
+                retention_interval, retention_rate)
+        # and the blobs and chunks nothing uses any more
+        self._sweeper = None
+        if sweep_interval > 0:
+            self._sweeper = threading.Thread(
+                target=self._sweep_loop, args=(sweep_interval,), name='Blob sweep')
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+        self.log.info('Created Data_Controller in ' + ', '.join(self.layout.roots))
+
+    # Checks in the pending modifications and closes the revision index
+    #
+    def close(self):
+        if self.retention is not None:
+            self.retention.close()
+        self._stop.set()
+        if self._migration is not None:
+            self._migration.join()
+        if self._sweeper is not None:
+            self._sweeper.join()
+        self.commits.close()
+        self.index.close()
+        self.layout.close()
+        self.chunks.close()
+        self.writer.close()
+
+    # Moves the files of data_dir into the storage roots (the migration thread)
+    # @param rate files per second at most
+    #
+    def _migrate(self, rate):
+        moved = self.layout.migrate(self.data_dir, self._rcs_lock, rate, self._stop)
+        self.log.info('Moved %d files of %s into the storage roots' % (moved, self.data_dir))
+
+    # Removes the blobs and chunks no current file uses and nobody used for
+    # a while
+    #
+    def sweep(self):
+        removed, size = self.blobs.sweep(set(self.digests.values()) | self.chunks.blobs())
+        if removed:
+            self.log.info('Removed %d unused blobs (%d bytes)' % (removed, size))
+        removed, size = self.chunks.sweep(chunk_store.SWEEP_AGE)
+        if removed:
+            self.log.info('Removed %d unused chunks (%d bytes)' % (removed, size))
+
+    # Sweeps the blobs and chunks every interval (the sweep thread)
+    # @param interval seconds between two sweeps
+    #
+    def _sweep_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sweep()
+            except (IOError, OSError), err:
+                self.log.error('Could not sweep the blobs and chunks: ' + str(err))
+
+    # Returns the seconds since a client made the server read or write a file
+    #
+    def idle_time(self):
+        return time.time() - self._last_access
+
+    # Returns the paths of all files
+    # @returns a list of paths relative to the sourceBox
+    #
+    def _file_paths(self):
+        return [file_path for file_path, path in self.layout.files()]
+
+    # Removes the revisions of a file a retention policy does not keep
+    # @param file_path path relative to the sourceBox
+    # @param policy the retention.Retention_Policy
+    # @returns (revisions removed, bytes reclaimed, bytes written)
+    # @throws IOError, OSError if the RCS file cannot be read or written
+    #
+    def compact_history(self, file_path, policy):
+        with self._rcs_lock:
+            path = self.get_path(file_path)
+            if path is None or not os.path.isfile(self._namev(path)):
+                return 0, 0, 0
+            namev = self._namev(path)
+            rcs = native_rcs.read_metadata(namev)
+            revisions = retention.trunk(rcs)
+            if revisions is None:
+                # branches are not handled
+                return 0, 0, 0
+            locked = set(rev for user, rev in rcs.locks)
+            expired = [rev for rev in policy.expired(revisions, time.time()) if rev not in locked]
+            if not expired:
+                return 0, 0, 0
+            size = os.path.getsize(namev)
+            self.rcs.outdate(path, expired)
+            written = os.path.getsize(namev)
+            self._update_index(file_path)
+        self.log.debug('Removed %d revisions of %s' % (len(expired), file_path))
+        return len(expired), size - written, written
+
+    # Returns the path of a file in the backend
+    # @param file_path path relative to the sourceBox
+    # @returns the path or None if there is no such file
+    #
+    def get_path(self, file_path):
+        return self.layout.locate(file_path)
+
+    # Returns the RCS file of a file in the backend
+    # @param path the path of the file in the backend
+    #
+    def _namev(self, path):
+        namev = path + ',v'
+        if not os.path.isfile(namev):
+            rcs_namev = os.path.join(os.path.dirname(path), 'RCS', os.path.basename(namev))
+            if os.path.isfile(rcs_namev):
+                return rcs_namev
+        return namev
+
+    # Returns the RCS files of all files
+    # @returns path relative to the sourceBox -> RCS file
+    #
+    def _rcs_files(self):
+        found = {}
+        for file_path, path in self.layout.files():
+            namev = self._namev(path)
+            if os.path.isfile(namev):
+                found[file_path] = namev
+        return found
+
+    # Removes files and their RCS files from the backend
+    # @param paths the paths of the files in the backend
+    #
+    def _remove_files(self, paths):
+        for path in paths:
+            self.rcs._remove(path)
+            try:
+                os.remove(self._namev(path))
+            except OSError:
+                self.log.error(
+                    'It seems that the file to be deleted is already gone. This is BAD!')
+
+    # Moves a spool file into place
+    # (a spool file on another filesystem is copied to the spool directory of
+    # the destination first, the rename must not turn into a copy into the
+    # live file)
+    # @param spool_file the spool file
+    # @param path the destination
+    #
+    def _move_into_place(self, spool_file, path):
+        if not self._same_filesystem(spool_file, path):
+            spool_file = self._respool(spool_file, path)
+        self.writer.prepare(spool_file)
+        try:
+            os.rename(spool_file, path)
+        except OSError:
+            if os.name != 'nt':
+                os.remove(spool_file)
+                raise
+            # on Windows, if the destination exists
+            try:
+                shutil.move(spool_file, path)
+            except (OSError, IOError):
+                os.remove(spool_file)
+                raise
+        self.writer.committed(path)
+
+    # Tells whether a file can be renamed to a path
+    # @param spool_file the file
+    # @param path the destination (its directory exists)
+    #
+    def _same_filesystem(self, spool_file, path):
+        try:
+            return os.stat(spool_file).st_dev == os.stat(os.path.dirname(path)).st_dev
+        except OSError:
+            return True
+
+    # Copies a spool file to the spool directory on the filesystem of a path
+    # @param spool_file the spool file (removed)
+    # @param path the destination
+    # @returns the new spool file
+    #
+    def _respool(self, spool_file, path):
+        directory = self._spool_dir(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            handle, temp = tempfile.mkstemp(prefix='.sb-', dir=directory)
+            os.close(handle)
+        except OSError:
+            os.remove(spool_file)
+            raise
+        try:
+            shutil.copyfile(spool_file, temp)
+        except (OSError, IOError):
+            os.remove(temp)
+            raise
+        finally:
+            os.remove(spool_file)
+        return temp
+
+    # Replaces a file by a new one with the content
+    # (the old file may be a blob, it must not be changed in place)
+    # @param path the path
+    # @param content the content
+    #
+    def _write_file(self, path, content):
+        spool_file = self.writer.write_temp(content, self._spool_dir(path))
+        self._move_into_place(spool_file, path)
+
+    # Returns the spool directory on the filesystem of a path (the spool
+    # file is renamed into place)
+    # @param path the path of a file in the backend
+    #
+    def _spool_dir(self, path):
+        for root in self.layout.roots:
+            if path.startswith(os.path.join(root, '')):
+                return os.path.join(root, '.spool')
+        return self.spool_dir
+
+    # Maps an open file into memory (read-only), so it can be inspected
+    # without copying it onto the heap
+    # @param open_file the file
+    # @returns an mmap or, if the file cannot be mapped (e.g. it is empty), its content
+    #
+    def _map_file(self, open_file):
+        try:
+            return mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error, EnvironmentError):
+            return open_file.read()
 
-        self.log.info('Created Data_Controller in dir ' + self.data_dir)
+    # Adds the current version of a file to the blob store
+    # @param file_path path relative to the sourceBox
+    # @param digest the hex digest of the content if it is known already
+    # @returns the hex digest or None
+    #
+    def _store_blob(self, file_path, digest=None):
+        old_digest = self.digests.pop(file_path, None)
+        path = self.get_path(file_path)
+        known, digest = digest, None
+        if path is not None:
+            try:
+                digest = self.blobs.add(path, known)
+            except (IOError, OSError), err:
+                self.log.error('Could not store blob of ' + file_path + ': ' + str(err))
+        if digest is not None:
+            self.digests[file_path] = digest
+            self._digest_paths.add(file_path)
+        else:
+            self._digest_paths.discard(file_path)
+        if old_digest is not None and old_digest != digest:
+            self.blobs.release([old_digest])
+        return digest
+
+    # Returns the digest of the current version of a file
+    # @param file_path path relative to the sourceBox
+    # @returns the hex digest or None
+    #
+    def get_digest(self, file_path):
+        digest = self.digests.get(file_path)
+        path = self.get_path(file_path)
+        if digest is None and path is not None and os.path.isfile(path):
+            digest = self._store_blob(file_path)
+        return digest
+
+    # Creates a temporary copy of a stored content
+    # @param digest the hex digest
+    # @returns the path of the copy (to be passed as content_file) or None if the content is unknown
+    #
+    def checkout_blob(self, digest):
+        return self.blobs.checkout(digest)
 
     # Reads a file
     # @param file_path name of the file
     #
     def read_file(self, file_path):
-        path = os.path.join(self.data_dir, file_path)
-        self.log.debug('reading file ' + path)
-        with open(path, 'r') as open_file:
-            content = open_file.read()
+        content = self.cache.get(file_path)
+        if content is None:
+            self._last_access = time.time()
+            # a change while the file is read keeps the content out of the cache
+            generation = self.cache.generation()
+            path = self.get_path(file_path)
+            if path is None:
+                raise IOError(errno.ENOENT, 'No such file', file_path)
+            self.log.debug('reading file ' + path)
+            with open(path, 'rb') as open_file:
+                content = open_file.read()
+            self.cache.put(file_path, content, generation)
         return content
 
+    # Reads the RCS metadata of a file into the revision index
+    # @param file_path path relative to the sourceBox
+    #
+    def _update_index(self, file_path):
+        try:
+            self.index.update(file_path, self._namev(self.get_path(file_path)))
+        except (IOError, OSError), err:
+            self.log.error('Could not index ' + file_path + ': ' + str(err))
+
+    # Returns the head, lock holder, number of revisions and last author of a file
+    # @param file_path name of the file
+    # @returns a revision_index.Revision_Info or None if the file is not tracked
+    #
+    def get_revision_info(self, file_path):
+        return self.index.get(file_path)
+
     # Checks if a file is locked
     # @param file_path name of the file
     #
     def is_locked(self, file_path):
-        path = os.path.join(self.data_dir, file_path)
-        return self.rcs.islocked(path)
+        return self.get_lock_holder(file_path) is not None
+
+    # Returns the user holding the lock on a file
+    # @param file_path name of the file
+    # @returns the user or None if the file is not locked
+    #
+    def get_lock_holder(self, file_path):
+        info = self.index.get(file_path)
+        return info.locker if info is not None else None
 
     # Locks a file
     # @param file_path name of the file
     #
     def lock_file(self, file_path, user):
-        path = os.path.join(self.data_dir, file_path)
+        self._last_access = time.time()
         try:
-            self.rcs.checkout(path, user, True)
+            with self._rcs_lock:
+                path = self.get_path(file_path)
+                if path is None:
+                    raise IOError(errno.ENOENT, 'No such file', file_path)
+                # only the lock record of the ,v file changes, the work file
+                # (and modifications that are not checked in) stay as they are
+                self.rcs.lock(path, user)
+                self._update_index(file_path)
             return True
         except (OSError, IOError), err:
             self.log.error('Could not lock file because ' + str(err))
@@ -57,39 +446,83 @@ class Data_Controller(object):
     # @param file_path name of the file
     #
     def unlock_file(self, file_path, user):
-        path = os.path.join(self.data_dir, file_path)
+        self._last_access = time.time()
+        self.cache.invalidate(file_path)
         try:
-            self.rcs.checkin(path, user, 'Unlocked file ' + path)
+            with self._rcs_lock:
+                path = self.get_path(file_path)
+                if path is None:
+                    raise IOError(errno.ENOENT, 'No such file', file_path)
+                self.rcs.checkin(path, user, 'Unlocked file ' + file_path)
+                # the checkin included the pending modifications (they stay
+                # pending if it failed)
+                self.commits.discard(file_path)
+                self._update_index(file_path)
             return True
         except IOError, err:
             self.log.error('Could not unlock file because ' + str(err))
             return False
 
+    # Checks in the modifications of a file as one revision (called by the
+    # commit queue). A lock on the file is kept.
+    # @param file_path path relative to the sourceBox
+    # @param user the user who modified the file last
+    # @param changes the number of modifications
+    #
+    def _commit_revision(self, file_path, user, changes):
+        with self._rcs_lock:
+            path = self.get_path(file_path)
+            if path is None or not os.path.isfile(path):
+                return
+            locker = self.get_lock_holder(file_path)
+            if locker is None and self.rcs.isvalid(path):
+                # ci needs a lock on the head
+                self.rcs.lock(path, user)
+            self.rcs.checkin(path, user, 'Saved %d change%s' % (changes, 's' if changes != 1 else ''))
+            if locker is not None:
+                self.rcs.lock(path, locker)
+            self._update_index(file_path)
+
     # Deletes a file
     # @param file_path path relative to the sourceBox
     #
     def delete_file(self, file_path, user):
-        try:
-            path = os.path.join(self.data_dir, file_path)
-            self.rcs._remove(path)
-            os.remove(path + ',v')
-        except OSError:
-            self.log.error(
-                'It seems that the file to be deleted is already gone. This is BAD!')
+        self._last_access = time.time()
+        self._move_digests(file_path, None)
+        self.commits.discard(file_path)
+        self.index.remove(file_path)
+        self.chunks.remove(file_path)
+        with self._rcs_lock:
+            paths = self.layout.remove(file_path)
+            if not paths:
+                self.log.error(
+                    'It seems that the file to be deleted is already gone. This is BAD!')
+            self._remove_files(paths)
+            self.cache.invalidate(file_path)
 
     # Creates a new file
     # @param file_path name of the file
     # @param content the content
-    def create_file(self, file_path, user, content=''):
+    # @param content_file a spool file holding the content (instead of content)
+    # @param digest the hex digest of the content of content_file if it is known
+    def create_file(self, file_path, user, content='', content_file=None, digest=None):
+        self._last_access = time.time()
         try:
-            path = os.path.join(self.data_dir, file_path)
-            new_file = open(path, 'w+')
-            new_file.write(content)
-            new_file.close
-            self.rcs.checkin(path, user, 'Created file ' + path)
-            # self.rcs.lock(path, user)
+            self.chunks.remove(file_path)
+            with self._rcs_lock:
+                path = self.layout.place(file_path)
+                if content_file is not None:
+                    self._move_into_place(content_file, path)
+                else:
+                    self._write_file(path, content)
+                    digest = protocol.hash_content(content)
+                self.cache.invalidate(file_path)
+                self.rcs.checkin(path, user, 'Created file ' + file_path)
+                self._update_index(file_path)
+                # self.rcs.lock(path, user)
+                self._store_blob(file_path, digest)
             return True
-        except IOError, err:
+        except (IOError, OSError), err:
             self.log.error('Could not create file!')
             self.log.error(str(err))
             return False
@@ -97,26 +530,80 @@ class Data_Controller(object):
     # Saves a file
     # @param file_name name of the file
     # @param content the content to be stored in the file
+    # @param content_file a spool file holding the content (instead of content)
+    # @param patch a delta against the current version (instead of content)
+    # @param digest the hex digest of the content of content_file if it is known
     #
-    def modify_file(self, file_name, content, user):
-        path = os.path.join(self.data_dir, file_name)
+    def modify_file(self, file_name, content, user, content_file=None, patch=None, digest=None):
+        self._last_access = time.time()
+        self.chunks.remove(file_name)
         try:
-            with open(path, 'w') as current_file:
-                current_file.write(content)
+            with self._rcs_lock:
+                path = self.layout.place(file_name)
+                if content_file is not None:
+                    self._move_into_place(content_file, path)
+                    self.cache.invalidate(file_name)
+                else:
+                    if patch is not None:
+                        with open(path, 'rb') as current_file:
+                            basis = self._map_file(current_file)
+                            try:
+                                content = delta.apply(basis, patch)
+                            finally:
+                                if isinstance(basis, mmap.mmap):
+                                    basis.close()
+                    self._write_file(path, content)
+                    digest = protocol.hash_content(content)
+                    # the other clients get the new content next
+                    self.cache.put(file_name, content)
+                self._store_blob(file_name, digest)
+            self.commits.add(file_name, user)
             return True
-        except IOError, err:
+        except (IOError, OSError), err:
             self.log.error('Could not modify file because ' + str(err))
             return False
+        except delta.Delta_Error, err:
+            self.log.warning('Rejected delta for ' + file_name + ': ' + str(err))
+            return False
 
-    # Show changes of the file
+    # Applies the operations of a batch one after the other
+    # @param entries the operations (Frames)
+    # @param user the user
+    # @returns the list of operations that were applied
+    #
+    def apply_batch(self, entries, user):
+        applied = []
+        for entry in entries:
+            if entry.opcode == protocol.OP_CREATE_FILE:
+                done = self.create_file(entry.path, user, entry.payload)
+            elif entry.opcode == protocol.OP_REMOVE:
+                done = self.delete_file(entry.path, user) is not False
+            elif entry.opcode == protocol.OP_MOVE:
+                done = self.move(entry.path, protocol.decode_path(entry.payload))
+            elif entry.opcode == protocol.OP_CREATE_DIR:
+                done = self.create_dir(entry.path)
+            else:
+                done = self.delete_dir(entry.path)
+            if done:
+                applied.append(entry)
+            else:
+                self.log.error('Could not apply ' + entry.name() + ' ' + entry.path)
+        return applied
+
+    # Show changes of the file (the full log still comes from the RCS file,
+    # get_revision_info is enough for a summary)
     # @param file_path name of the file
     #
     def show_changes(self, file_path):
-        path = os.path.join(self.data_dir, file_path)
-        return self.rcs.log(path)
+        return self.rcs.log(self.get_path(file_path))
 
     def list_dir(self):
-        return os.listdir(self.data_dir)
+        return [path for path, is_dir in self.layout.walk() if os.sep not in path]
+
+    # Lists everything in the backend, parents before their contents
+    # @returns a list of (path relative to the sourceBox root, is_dir)
+    def walk(self):
+        return self.layout.walk()
 
     def move_file(self, oldpath, name, newpath, user):
         # return true if successfully moved
@@ -125,45 +612,65 @@ class Data_Controller(object):
     # creates a dir
     # @param path path relative to the sourceBox root
     def create_dir(self, path):
-        path = os.path.join(self.data_dir, path)
-        try:
-            os.makedirs(path)
-        except OSError, err:
-            self.log.error(str(err))
+        self.layout.add_dir(path)
         return True
 
     # deletes a dir
     # @param path path relative to the sourceBox root
     def delete_dir(self, path):
-        path = os.path.join(self.data_dir, path)
-        try:
-            shutil.rmtree(path)
-        except OSError, err:
-            self.log.error(str(err))
+        self._last_access = time.time()
+        self._move_digests(path, None)
+        self.commits.discard(path)
+        self.index.remove(path)
+        self.chunks.remove(path)
+        with self._rcs_lock:
+            self._remove_files(self.layout.remove(path))
+            self.cache.invalidate(path)
+            # what is left of the directory in data_dir
+            path = os.path.join(self.data_dir, path)
+            if os.path.isdir(path):
+                try:
+                    shutil.rmtree(path)
+                except OSError, err:
+                    self.log.error(str(err))
         return True
 
     def move(self, old_file_path, new_file_path):
-        old_file_path = os.path.join(self.data_dir, old_file_path)
-        new_file_path = os.path.join(self.data_dir, new_file_path)
-        if os.path.isdir(old_file_path):
-            try:
-                shutil.move(old_file_path, new_file_path)
-            except (OSError, IOError), err:
-                self.log.error(str(err))
-        else:
-            try:
-                shutil.move(old_file_path, new_file_path)
-                shutil.move(old_file_path + ',v' , new_file_path + ',v' )
-            except (OSError, IOError), err:
-                self.log.error(str(err))
-
+        self._move_digests(old_file_path, new_file_path)
+        self.commits.move(old_file_path, new_file_path)
+        self.index.move(old_file_path, new_file_path)
+        self.chunks.move(old_file_path, new_file_path)
+        # the files stay where they are
+        with self._rcs_lock:
+            self._remove_files(self.layout.move(old_file_path, new_file_path))
+            self.cache.invalidate(old_file_path)
+            self.cache.invalidate(new_file_path)
         return True
 
+    # moves the digests of a file or of everything in a directory
+    # @param old_path old path relative to the sourceBox root
+    # @param new_path new path (None: forget the digests, the blobs are released)
+    def _move_digests(self, old_path, new_path):
+        released = []
+        moved = []
+        for file_path in self._digest_paths.under(old_path):
+            self._digest_paths.discard(file_path)
+            digest = self.digests.pop(file_path)
+            if new_path is not None:
+                moved.append((new_path + file_path[len(old_path):], digest))
+            else:
+                released.append(digest)
+        for file_path, digest in moved:
+            self.digests[file_path] = digest
+            self._digest_paths.add(file_path)
+        self.blobs.release(released)
+
     # gets the size of a file
     # @param path the path relative to the source box root
     # @param file_name the file name
     def get_file_size(self, file_path):
-        if os.path.exists(os.path.join(self.data_dir, file_path)):
-            return os.path.getsize(os.path.join(self.data_dir, file_path))
+        path = self.get_path(file_path)
+        if path is not None and os.path.exists(path):
+            return os.path.getsize(path)
         else:
             return False
@@ -0,0 +1,183 @@
+#
+# Ignore_Rules
+# which paths of a box are not synced (client and server)
+#
+# The rules are written like a .gitignore, one pattern per line:
+#
+#   *.pyc           every file or directory named like this, at any depth
+#   build/          only directories (and everything in them)
+#   /TODO           only at the top of the box (a pattern with a / in it is
+#                   always relative to the top)
+#   doc/**/*.tmp    ** stands for any number of directories
+#   !keep.pyc       a negation: synced again even if an earlier rule matched
+#
+# The last matching rule decides, blank lines and lines starting with # are
+# left out (\# and \! for a pattern starting with # or !). Like git, a path
+# in an ignored directory is ignored, a negation cannot bring it back.
+#
+# The patterns are compiled into one regular expression per run of rules of
+# the same kind (ignoring or negating), so a path is matched against few
+# expressions however many rules there are. Whether a directory is ignored
+# is cached, the files of a directory share the result.
+#
+# The client and the server use the same rules: the client does not send an
+# ignored path, the server neither stores nor forwards one.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import re
+
+# directories whose result is cached (the cache is cleared when it is full)
+CACHE_SIZE = 10000
+
+
+class Ignore_Rules(object):
+
+    # Constructor
+    # @param patterns the patterns, one per line (a list or a string)
+    # @throws ValueError if a pattern is invalid
+    def __init__(self, patterns=()):
+        if isinstance(patterns, basestring):
+            patterns = patterns.splitlines()
+        self.patterns = []
+        rules = []
+        for line in patterns:
+            rule = _parse(line)
+            if rule is not None:
+                self.patterns.append(line.strip())
+                rules.append(rule)
+        # runs of rules of the same kind, the last run first:
+        # (negate, expression for directories, expression for files or None)
+        self._runs = []
+        start = 0
+        for end in range(1, len(rules) + 1):
+            if end == len(rules) or rules[end][0] != rules[start][0]:
+                run = rules[start:end]
+                self._runs.insert(0, (
+                    run[0][0],
+                    _join([expression for negate, dir_only, expression in run]),
+                    _join([expression for negate, dir_only, expression in run if not dir_only])))
+                start = end
+        # directory -> True if it is ignored (a plain dictionary is safe
+        # enough between threads, a result is at worst computed twice)
+        self._dirs = {}
+
+    # checks if a path is ignored
+    # @param path the path relative to the box (os.sep or / separated)
+    # @param is_dir True if the path is a directory
+    # @returns True if the path is not synced
+    def ignored(self, path, is_dir=False):
+        if not self._runs:
+            return False
+        path = path.replace(os.sep, '/').strip('/')
+        if not path or path == '.':
+            return False
+        parent = path.rpartition('/')[0]
+        if parent and self._dir_ignored(parent):
+            return True
+        return self._match(path, is_dir)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __repr__(self):
+        return '<Ignore_Rules %s>' % ', '.join(self.patterns)
+
+    # checks if a directory or one of its parents is ignored (cached)
+    def _dir_ignored(self, directory):
+        ignored = self._dirs.get(directory)
+        if ignored is None:
+            parent = directory.rpartition('/')[0]
+            ignored = bool(parent and self._dir_ignored(parent)) or self._match(directory, True)
+            if len(self._dirs) >= CACHE_SIZE:
+                self._dirs = {}
+            self._dirs[directory] = ignored
+        return ignored
+
+    # matches a path against the rules (not its parents), the last match decides
+    def _match(self, path, is_dir):
+        for negate, dirs, files in self._runs:
+            expression = dirs if is_dir else files
+            if expression is not None and expression.match(path):
+                return not negate
+        return False
+
+
+# parses a line of the rules
+# @returns (negate, dir_only, regular expression) or None for a blank line or a comment
+# @throws ValueError if the pattern is invalid
+def _parse(line):
+    pattern = line.strip()
+    if not pattern or pattern.startswith('#'):
+        return None
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\#') or pattern.startswith('\\!'):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        raise ValueError('Invalid ignore pattern: ' + line.strip())
+    if '/' in pattern:
+        # relative to the top of the box
+        expression = _translate(pattern.lstrip('/'))
+    else:
+        expression = '(?:.*/)?' + _translate(pattern)
+    return negate, dir_only, expression
+
+
+# joins expressions into one compiled expression matching a whole path
+# @returns the compiled expression or None if there are none
+def _join(expressions):
+    if not expressions:
+        return None
+    return re.compile('(?:' + '|'.join(expressions) + r')\Z', re.DOTALL)
+
+
+# translates a glob into a regular expression (no groups)
+# @throws ValueError if a [ is not closed
+def _translate(pattern):
+    result = []
+    i, n = 0, len(pattern)
+    while i < n:
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            if pattern[i:i + 1] == '*':
+                # ** only stands for directories as a whole path component
+                start = i - 1
+                while i < n and pattern[i] == '*':
+                    i += 1
+                at_start = start == 0 or pattern[start - 1] == '/'
+                if at_start and pattern[i:i + 1] == '/':
+                    result.append('(?:.*/)?')
+                    i += 1
+                elif at_start and i == n:
+                    result.append('.*')
+                else:
+                    result.append('[^/]*')
+            else:
+                result.append('[^/]*')
+        elif char == '?':
+            result.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', i + 1 if pattern[i:i + 1] in ('!', '^', ']') else i)
+            if end < 0:
+                raise ValueError('Invalid ignore pattern: ' + pattern)
+            chars = pattern[i:end]
+            i = end + 1
+            negate = chars[:1] in ('!', '^')
+            if negate:
+                chars = chars[1:]
+            chars = chars.replace('\\', '\\\\')
+            # a negated class does not match a / either
+            result.append('[^/' + chars + ']' if negate else '[' + chars + ']')
+        elif char == '\\' and i < n:
+            result.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            result.append(re.escape(char))
+    return ''.join(result)
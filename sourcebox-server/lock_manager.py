@@ -0,0 +1,194 @@
+#
+# Lock_Manager
+# the table of file locks (leases) of the server
+#
+# A client locks a file for a lease time. Locking it again renews the lease,
+# unlocking releases it. Leases that are not renewed expire: a single
+# scheduler thread waits for the next expiry and calls on_expire, so no
+# timer thread is needed per lock. The table is the state of the locks,
+# RCS locks only keep them across restarts.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import heapq
+import logging
+import os
+import threading
+import time
+
+import path_index
+
+
+# A lock on a file
+class Lease(object):
+
+    # Constructor
+    # @param path the path relative to the sourceBox
+    # @param owner the computer name of the client holding the lock
+    # @param expires the time (time.time()) the lease expires
+    def __init__(self, path, owner, expires):
+        self.path = path
+        self.owner = owner
+        self.expires = expires
+        # how often the owner renewed the lease
+        self.renewals = 0
+
+    def __repr__(self):
+        return '<Lease %r by %s, %.1fs left>' % (self.path, self.owner, self.expires - time.time())
+
+
+class Lock_Manager(object):
+
+    # Constructor
+    # @param lease_time seconds a lock lasts without renewal
+    # @param on_expire called as on_expire(lease) on the scheduler thread for every lease that expired
+    def __init__(self, lease_time, on_expire=None):
+        self.log = logging.getLogger("server")
+        self.lease_time = lease_time
+        self.on_expire = on_expire
+        # path -> Lease
+        self._leases = {}
+        # the paths of the leases, sorted
+        self._paths = path_index.Path_Index()
+        # (expires, path) of every lease, entries of renewed or released leases are skipped
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._running = True
+        self._scheduler = threading.Thread(target=self._expire_loop, name='Lock scheduler')
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    # Locks a file or renews the lock of the owner
+    # @param path the path relative to the sourceBox
+    # @param owner the computer name of the client
+    # @param lease_time seconds until the lease expires (None: the default)
+    # @returns the Lease (renewals is 0 for a new lock) or None if another client holds the lock
+    def acquire(self, path, owner, lease_time=None):
+        path = os.path.normpath(path)
+        expires = time.time() + (lease_time if lease_time is not None else self.lease_time)
+        with self._condition:
+            lease = self._leases.get(path)
+            if lease is not None and lease.owner != owner:
+                return None
+            if lease is None:
+                lease = self._leases[path] = Lease(path, owner, expires)
+                self._paths.add(path)
+            else:
+                lease.expires = expires
+                lease.renewals += 1
+            self._push(lease)
+            return lease
+
+    # Renews the lock of the owner
+    # @param path the path relative to the sourceBox
+    # @param owner the computer name of the client
+    # @returns True if the owner holds the lock
+    def renew(self, path, owner):
+        path = os.path.normpath(path)
+        with self._condition:
+            lease = self._leases.get(path)
+            if lease is None or lease.owner != owner:
+                return False
+            lease.expires = time.time() + self.lease_time
+            lease.renewals += 1
+            self._push(lease)
+            return True
+
+    # Releases the lock of the owner
+    # @param path the path relative to the sourceBox
+    # @param owner the computer name of the client
+    # @returns the released Lease or None if the owner does not hold the lock
+    def release(self, path, owner):
+        path = os.path.normpath(path)
+        with self._condition:
+            lease = self._leases.get(path)
+            if lease is None or lease.owner != owner:
+                return None
+            del self._leases[path]
+            self._paths.discard(path)
+            return lease
+
+    # Returns the client holding the lock on a file
+    # @param path the path relative to the sourceBox
+    # @returns the computer name or None if the file is not locked
+    def holder(self, path):
+        lease = self._leases.get(os.path.normpath(path))
+        return lease.owner if lease is not None else None
+
+    # Drops the locks of a file or of everything in a directory (e.g. if it was deleted)
+    # @param path the path relative to the sourceBox
+    # @returns the dropped Leases
+    def forget(self, path):
+        with self._condition:
+            forgotten = []
+            for key in self._paths.under(os.path.normpath(path)):
+                self._paths.discard(key)
+                forgotten.append(self._leases.pop(key))
+            return forgotten
+
+    # Moves the locks of a file or of everything in a directory
+    # @param old_path old path relative to the sourceBox
+    # @param new_path new path relative to the sourceBox
+    def move(self, old_path, new_path):
+        old_path = os.path.normpath(old_path)
+        new_path = os.path.normpath(new_path)
+        with self._condition:
+            moved = [self._leases.pop(key) for key in self._paths.under(old_path)]
+            for lease in moved:
+                self._paths.discard(lease.path)
+            for lease in moved:
+                lease.path = new_path + lease.path[len(old_path):]
+                self._leases[lease.path] = lease
+                self._paths.add(lease.path)
+                self._push(lease)
+
+    # Returns all locks
+    # @returns a list of Leases
+    def leases(self):
+        with self._condition:
+            return self._leases.values()
+
+    # Stops the scheduler (the leases are kept)
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._scheduler.join()
+
+    # schedules the expiry of a lease (the lock must be held)
+    def _push(self, lease):
+        heapq.heappush(self._schedule, (lease.expires, lease.path))
+        if self._schedule[0][1] == lease.path:
+            self._condition.notify()
+
+    # the scheduler: waits for the next expiry and releases the expired leases
+    def _expire_loop(self):
+        while True:
+            expired = []
+            with self._condition:
+                while self._running:
+                    now = time.time()
+                    while self._schedule and self._schedule[0][0] <= now:
+                        expires, path = heapq.heappop(self._schedule)
+                        lease = self._leases.get(path)
+                        # skip entries of leases that were renewed, moved or released
+                        if lease is not None and lease.expires == expires:
+                            del self._leases[path]
+                            self._paths.discard(path)
+                            expired.append(lease)
+                    if expired:
+                        break
+                    if self._schedule:
+                        self._condition.wait(self._schedule[0][0] - now)
+                    else:
+                        self._condition.wait()
+                if not self._running:
+                    return
+            for lease in expired:
+                self.log.info('Lock of ' + lease.path + ' by ' + lease.owner + ' expired')
+                if self.on_expire is not None:
+                    try:
+                        self.on_expire(lease)
+                    except Exception, err:
+                        self.log.error('Could not expire the lock of ' + lease.path + ': ' + str(err))
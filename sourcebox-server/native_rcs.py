@@ -0,0 +1,649 @@
+#
+# Native_RCS
+# RCS engine that reads and writes the ,v files itself
+#
+# rcslib.RCS forks a shell and an RCS binary (ci, co, rcs, rlog) for every
+# operation. This engine has the same API but does the work in-process:
+# it parses the ,v file (see rcsfile(5)), prepends new revisions as
+# reverse deltas and keeps the locks in the admin section. The files it
+# writes can still be used with the RCS tools and vice versa.
+#
+# Differences to the RCS tools:
+#   - keywords ($Id$ etc.) are never expanded, new files are created with
+#     keyword substitution 'b' so the tools do not expand them either
+#   - only revisions on the trunk can be checked in (branches are read)
+#   - locks are recorded under the user passed in. Like with the RCS tools,
+#     which record the login of the server process, a lock can be taken
+#     over by another user
+#   - the otherflags arguments are ignored
+#
+# The working file and the ,v file are replaced by rename, never written
+# in place (the working file may be a hard link to a blob).
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import difflib
+import logging
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+
+import rcslib
+
+# revision of a new file
+FIRST_REVISION = '1.1'
+
+_DATE_FORMAT = '%Y.%m.%d.%H.%M.%S'
+_REVISION = re.compile(r'^\d+(\.\d+)*$')
+_COMMAND = re.compile(r'^([ad])(\d+) (\d+)$')
+# a token of a ,v file: ';' or ':', the start of a string or a word
+_TOKEN = re.compile(r'\s*(?:([;:])|(@)|([^\s;:@]+))')
+# a delta with the phrases written by RCS (more phrases may follow)
+_DELTA = re.compile(r'\s*(\d+(?:\.\d+)*)\s+date\s+([\d.]+)\s*;\s*author\s+([^\s;:@]+)\s*;'
+                    r'\s*state\s*([^\s;:@]*)\s*;\s*branches((?:\s+[\d.]+)*)\s*;\s*next\s*([\d.]*)\s*;')
+_DELTA_END = re.compile(r'\s*(?:\d|desc\s)')
+# the keyword ending the delta section and the size the metadata is read in
+_DESC = re.compile(r'\sdesc\s')
+_METADATA_CHUNK = 64 * 1024
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+# A revision in the delta section of a ,v file
+class Delta(object):
+
+    def __init__(self, rev, date, author, state='Exp', branches=None, next=None):
+        self.rev = rev
+        self.date = date
+        self.author = author
+        self.state = state
+        self.branches = branches or []
+        self.next = next
+        # log message and text (the full text of the head, a reverse delta
+        # otherwise), both unescaped, None until the deltatext is read
+        self.log = None
+        self.text = None
+
+
+# The contents of a ,v file
+class RCS_File(object):
+
+    def __init__(self):
+        self.head = None
+        self.branch = None
+        self.access = []
+        self.symbols = []
+        # list of (user, revision)
+        self.locks = []
+        self.strict = True
+        self.comment = None
+        self.expand = None
+        self.deltas = []
+        self.desc = ''
+        # the Deltas whose text was read, in the order of the file (the
+        # head first), and the unparsed rest of the file after them
+        self.texts = []
+        self.rest = ''
+
+    # returns the Delta of a revision
+    # @throws IOError if there is no such revision
+    def delta(self, rev):
+        for entry in self.deltas:
+            if entry.rev == rev:
+                return entry
+        raise IOError('Revision ' + rev + ' does not exist')
+
+    # returns the user holding the lock on a revision or None
+    def locker(self, rev):
+        for user, locked in self.locks:
+            if locked == rev:
+                return user
+        return None
+
+
+# splits a ,v file into tokens: words, ';', ':' and @strings@
+class _Scanner(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    # returns the next token, strings as ('@', unescaped string), None at the end
+    def next(self):
+        match = _TOKEN.match(self.data, self.pos)
+        if match is None:
+            self.pos = len(self.data)
+            return None
+        if match.group(2) is None:
+            self.pos = match.end()
+            return match.group(1) or match.group(3)
+        start = pos = match.end()
+        data = self.data
+        while True:
+            pos = data.find('@', pos)
+            if pos < 0:
+                raise IOError('Unterminated string in RCS file')
+            if data[pos + 1:pos + 2] != '@':
+                break
+            pos += 2
+        self.pos = pos + 1
+        return ('@', data[start:pos].replace('@@', '@'))
+
+    # returns the next token without consuming it
+    def peek(self):
+        pos = self.pos
+        token = self.next()
+        self.pos = pos
+        return token
+
+    # reads the values of a phrase up to its ';'
+    # @returns the list of values (strings unescaped, ':' kept)
+    def phrase(self):
+        values = []
+        token = self.next()
+        while token != ';':
+            if token is None:
+                raise IOError('Unterminated phrase in RCS file')
+            values.append(token[1] if isinstance(token, tuple) else token)
+            token = self.next()
+        return values
+
+    # reads a string
+    def string(self):
+        token = self.next()
+        if not isinstance(token, tuple):
+            raise IOError('Expected a string in RCS file, got %r' % (token,))
+        return token[1]
+
+
+# parses a ,v file
+# Only the first deltatexts are parsed if texts is given, the rest is kept
+# as it is (rewriting the file does not have to parse it).
+# @param data the content of the file
+# @param texts number of deltatexts to read (0: only the metadata, the
+#              head comes first; None: all)
+# @param desc if False, stop before the description (data may end there)
+# @returns an RCS_File
+# @throws IOError if the file is corrupt
+def parse_file(data, texts=None, desc=True):
+    scanner = _Scanner(data)
+    rcs = RCS_File()
+
+    # admin section, up to the first revision
+    while True:
+        token = scanner.peek()
+        if token is None or token == 'desc' or (isinstance(token, str) and _REVISION.match(token)):
+            break
+        keyword = scanner.next()
+        values = scanner.phrase()
+        if keyword == 'head':
+            rcs.head = values[0] if values else None
+        elif keyword == 'branch':
+            rcs.branch = values[0] if values else None
+        elif keyword == 'access':
+            rcs.access = values
+        elif keyword == 'symbols':
+            rcs.symbols = _pairs(values)
+        elif keyword == 'locks':
+            rcs.locks = _pairs(values)
+            if scanner.peek() == 'strict':
+                scanner.next()
+                scanner.phrase()
+                rcs.strict = True
+            else:
+                rcs.strict = False
+        elif keyword == 'comment':
+            rcs.comment = values[0] if values else None
+        elif keyword == 'expand':
+            rcs.expand = values[0] if values else None
+
+    # delta section
+    while True:
+        match = _DELTA.match(data, scanner.pos)
+        if match is not None:
+            # the usual layout, in one go
+            rev, date, author, state, branches, next = match.groups()
+            entry = Delta(rev, date, author, state or None, branches.split(), next or None)
+            scanner.pos = match.end()
+            if _DELTA_END.match(data, scanner.pos):
+                rcs.deltas.append(entry)
+                continue
+        else:
+            token = scanner.next()
+            if token == 'desc' or token is None:
+                break
+            entry = Delta(token, None, None)
+        while True:
+            keyword = scanner.peek()
+            if keyword == 'desc' or (isinstance(keyword, str) and _REVISION.match(keyword)):
+                break
+            scanner.next()
+            values = scanner.phrase()
+            if keyword == 'date':
+                entry.date = values[0]
+            elif keyword == 'author':
+                entry.author = values[0]
+            elif keyword == 'state':
+                entry.state = values[0] if values else None
+            elif keyword == 'branches':
+                entry.branches = values
+            elif keyword == 'next':
+                entry.next = values[0] if values else None
+        rcs.deltas.append(entry)
+    if token is None:
+        raise IOError('RCS file has no description')
+    if not desc:
+        return rcs
+    rcs.desc = scanner.string()
+
+    # deltatext section
+    deltas = dict((entry.rev, entry) for entry in rcs.deltas)
+    rest = scanner.pos
+    while texts is None or len(rcs.texts) < texts:
+        token = scanner.next()
+        if token is None:
+            break
+        entry = deltas.get(token)
+        if entry is None:
+            raise IOError('Text of unknown revision ' + str(token))
+        while True:
+            keyword = scanner.next()
+            if keyword == 'log':
+                entry.log = scanner.string()
+            elif keyword == 'text':
+                entry.text = scanner.string()
+                break
+            elif keyword is None:
+                raise IOError('Revision ' + entry.rev + ' has no text')
+            else:
+                scanner.phrase()
+        rcs.texts.append(entry)
+        rest = scanner.pos
+    rcs.rest = data[rest:]
+    return rcs
+
+
+# reads the admin and delta sections of a ,v file (without reading the texts)
+# @param namev the ,v file
+# @returns an RCS_File without description and texts
+# @throws IOError if the file cannot be read or is corrupt
+def read_metadata(namev):
+    chunks = []
+    tail = ''
+    with open(namev, 'rb') as rcs_file:
+        while True:
+            chunk = rcs_file.read(_METADATA_CHUNK)
+            chunks.append(chunk)
+            # the keyword may be split between two chunks
+            if not chunk or _DESC.search(tail + chunk):
+                break
+            tail = chunk[-8:]
+    return parse_file(''.join(chunks), 0, desc=False)
+
+
+# turns [a, ':', b, c, ':', d] into [(a, b), (c, d)]
+def _pairs(values):
+    pairs = []
+    for index in xrange(0, len(values) - 2, 3):
+        pairs.append((values[index], values[index + 2]))
+    return pairs
+
+
+# escapes a string for a ,v file
+def _string(value):
+    return '@' + value.replace('@', '@@') + '@'
+
+
+# formats a ,v file
+# @param rcs the RCS_File
+# @returns the content of the file
+def format_file(rcs):
+    out = ['head\t%s;\n' % (rcs.head or '')]
+    if rcs.branch:
+        out.append('branch\t%s;\n' % rcs.branch)
+    out.append('access%s;\n' % ''.join('\n\t' + user for user in rcs.access))
+    out.append('symbols%s;\n' % ''.join('\n\t%s:%s' % pair for pair in rcs.symbols))
+    out.append('locks%s;' % ''.join('\n\t%s:%s' % pair for pair in rcs.locks))
+    out.append(' strict;\n' if rcs.strict else '\n')
+    if rcs.comment is not None:
+        out.append('comment\t%s;\n' % _string(rcs.comment))
+    if rcs.expand is not None:
+        out.append('expand\t%s;\n' % _string(rcs.expand))
+    out.append('\n')
+    for entry in rcs.deltas:
+        out.append('\n%s\ndate\t%s;\tauthor %s;\tstate %s;\nbranches%s;\nnext\t%s;\n' % (
+            entry.rev, entry.date, entry.author, entry.state or '',
+            ''.join('\n\t' + branch for branch in entry.branches), entry.next or ''))
+    out.append('\n\ndesc\n%s' % _string(rcs.desc))
+    for entry in rcs.texts:
+        out.append('\n\n\n%s\nlog\n%s\ntext\n%s' % (
+            entry.rev, _string(entry.log or ''), _string(entry.text or '')))
+    out.append(rcs.rest or '\n')
+    return ''.join(out)
+
+
+# splits a text into lines like RCS: only at \n (a lone \r, e.g. of old Mac
+# text or binary data, is part of the line)
+# @param text the text
+# @returns the lines, each with its \n (the last one without if the text
+#          does not end with one)
+def _lines(text):
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+# applies an RCS diff script (to get an older revision from a newer one)
+# @param text the newer text
+# @param script the script
+# @returns the older text
+# @throws IOError if the script is corrupt
+def apply_diff(text, script):
+    source = _lines(text)
+    commands = _lines(script)
+    out = []
+    pos = 0
+    index = 0
+    while index < len(commands):
+        match = _COMMAND.match(commands[index].rstrip('\n'))
+        if match is None:
+            raise IOError('Corrupt RCS diff: %r' % commands[index])
+        line, count = int(match.group(2)), int(match.group(3))
+        index += 1
+        if match.group(1) == 'd':
+            out.extend(source[pos:line - 1])
+            pos = line - 1 + count
+        else:
+            out.extend(source[pos:line])
+            pos = max(pos, line)
+            out.extend(commands[index:index + count])
+            index += count
+    out.extend(source[pos:])
+    return ''.join(out)
+
+
+# computes the RCS diff script that turns one text into another
+# @param text the newer text (the script is applied to it)
+# @param older the older text
+# @returns the script
+def compute_diff(text, older):
+    source = _lines(text)
+    target = _lines(older)
+    out = []
+    matcher = difflib.SequenceMatcher(None, source, target)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ('delete', 'replace'):
+            out.append('d%d %d\n' % (i1 + 1, i2 - i1))
+        if tag in ('insert', 'replace'):
+            out.append('a%d %d\n' % (i2, j2 - j1))
+            out.extend(target[j1:j2])
+    return ''.join(out)
+
+
+# returns the revision following a trunk revision (1.9 -> 1.10)
+def next_revision(rev):
+    parts = rev.split('.')
+    parts[-1] = str(int(parts[-1]) + 1)
+    return '.'.join(parts)
+
+
+class Native_RCS(rcslib.RCS):
+
+    # Constructor
+    def __init__(self):
+        rcslib.RCS.__init__(self)
+        self.logger = logging.getLogger("server")
+        # serializes the changes of ,v files
+        self._lock = threading.RLock()
+
+    # --- Informational methods about a single file/revision ---
+
+    # returns the full log text (like rlog) for NAME_REV
+    def log(self, name_rev, otherflags=''):
+        name, rev = self.checkfile(name_rev)
+        rcs = self._read(name)
+        lines = ['', 'RCS file: ' + self.rcsname(name), 'Working file: ' + self.realname(name)]
+        lines.extend(self._header(rcs))
+        lines.append('total revisions: %d;\tselected revisions: %d' % (len(rcs.deltas), len(rcs.deltas)))
+        lines.append('description:')
+        lines.append(rcs.desc.rstrip('\n'))
+        for entry in rcs.deltas:
+            if rev and entry.rev != rev:
+                continue
+            lines.append('-' * 28)
+            locker = rcs.locker(entry.rev)
+            if locker is None:
+                lines.append('revision ' + entry.rev)
+            else:
+                lines.append('revision %s\tlocked by: %s;' % (entry.rev, locker))
+            lines.append('date: %s;  author: %s;  state: %s;' % (
+                _display_date(entry.date), entry.author, entry.state))
+            lines.append((entry.log or '').rstrip('\n'))
+        lines.append('=' * 77)
+        return '\n'.join(lines)
+
+    # returns a dictionary of info (like rlog -h) for NAME_REV
+    def info(self, name_rev):
+        name, rev = self.checkfile(name_rev)
+        rcs = self._read(name, 0)
+        info = {'RCS file': self.rcsname(name), 'Working file': self.realname(name)}
+        for line in self._header(rcs):
+            if not line.startswith('\t'):
+                key, value = line.split(':', 1)
+                info[key] = value.strip()
+        info['total revisions'] = str(len(rcs.deltas))
+        return info
+
+    # lines of the rlog header from 'head' to 'keyword substitution'
+    def _header(self, rcs):
+        lines = ['head: ' + (rcs.head or ''), 'branch: ' + (rcs.branch or '')]
+        lines.append('locks:' + (' strict' if rcs.strict else ''))
+        lines.extend('\t%s: %s' % pair for pair in rcs.locks)
+        lines.append('access list:')
+        lines.extend('\t' + user for user in rcs.access)
+        lines.append('symbolic names:')
+        lines.extend('\t%s: %s' % pair for pair in rcs.symbols)
+        lines.append('keyword substitution: ' + (rcs.expand or 'kv'))
+        return lines
+
+    # --- Methods that change files ---
+
+    # sets a lock on NAME_REV
+    def lock(self, name_rev, user):
+        name, rev = self.checkfile(name_rev)
+        with self._lock:
+            rcs = self._read(name, 0)
+            self._set_lock(rcs, rev or rcs.head, user)
+            self._write(name, rcs)
+
+    # clears the lock on NAME_REV
+    def unlock(self, name_rev, user):
+        name, rev = self.checkfile(name_rev)
+        with self._lock:
+            rcs = self._read(name, 0)
+            rev = rev or rcs.head
+            if rcs.locker(rev) is None:
+                raise IOError('Revision %s of %s is not locked' % (rev, name))
+            rcs.locks = [lock for lock in rcs.locks if lock[1] != rev]
+            self._write(name, rcs)
+
+    # checks out NAME_REV to its work file, locked if WITHLOCK is set
+    def checkout(self, name_rev, user, withlock=0, otherflags=""):
+        name, rev = self.checkfile(name_rev)
+        with self._lock:
+            rcs = self._read_head(name)
+            if rev and rev != rcs.head:
+                rcs = self._read(name)
+            rev = rev or rcs.head
+            text = self._text(rcs, rev)
+            mode = os.stat(self.rcsname(name)).st_mode & 0777 & ~_WRITE_BITS
+            if withlock:
+                self._set_lock(rcs, rev, user)
+                self._write(name, rcs)
+                mode |= stat.S_IWUSR
+            _replace(self.realname(name), text, mode)
+
+    # checks in NAME_REV from its work file (and keeps it unlocked, like ci -u)
+    def checkin(self, name_rev, user, message=None, otherflags=""):
+        name, rev = self._unmangle(name_rev)
+        if not message:
+            message = "<none>"
+        if message[-1] != '\n':
+            message = message + '\n'
+        with open(name, 'rb') as work_file:
+            text = work_file.read()
+        date = time.strftime(_DATE_FORMAT, time.gmtime())
+
+        with self._lock:
+            if not self.isvalid(name):
+                rcs = RCS_File()
+                rcs.expand = 'b'
+                rcs.desc = message
+                entry = Delta(rev or FIRST_REVISION, date, user)
+                entry.log = 'Initial revision\n'
+                entry.text = text
+                rcs.head = entry.rev
+                rcs.deltas.append(entry)
+                rcs.texts.append(entry)
+                # like ci: in the RCS directory next to the work file, if there is one
+                namev = os.path.join(os.path.dirname(name), 'RCS', os.path.basename(name) + ',v')
+                if not os.path.isdir(os.path.dirname(namev)):
+                    namev = name + ',v'
+                mode = os.stat(name).st_mode & 0777
+            else:
+                rcs = self._read_head(name)
+                head = rcs.delta(rcs.head)
+                if rcs.strict and rcs.locker(rcs.head) is None:
+                    raise IOError('No lock set on revision %s of %s' % (rcs.head, name))
+                rcs.locks = [lock for lock in rcs.locks if lock[1] != rcs.head]
+                if head.text != text:
+                    entry = Delta(rev or next_revision(rcs.head), date, user, next=rcs.head)
+                    entry.log = message
+                    entry.text = text
+                    head.text = compute_diff(text, head.text)
+                    rcs.deltas.insert(0, entry)
+                    rcs.texts.insert(0, entry)
+                    rcs.head = entry.rev
+                else:
+                    self.logger.debug(name + ' is unchanged, keeping revision ' + rcs.head)
+                namev = self.rcsname(name)
+                mode = os.stat(namev).st_mode & 0777
+            _replace(namev, format_file(rcs), mode & ~_WRITE_BITS)
+        # the work file stays, read-only (ci -u)
+        os.chmod(name, os.stat(name).st_mode & 0777 & ~_WRITE_BITS)
+
+    # removes revisions of NAME_REV (like rcs -o), the remaining revisions
+    # get new diffs against each other
+    # @param revs the revisions to remove (on the trunk, not the head, not locked)
+    def outdate(self, name_rev, revs):
+        name, rev = self.checkfile(name_rev)
+        revs = set(revs)
+        with self._lock:
+            rcs = self._read(name)
+            if rcs.head in revs:
+                raise IOError('Cannot remove the head revision %s of %s' % (rcs.head, name))
+            for user, locked in rcs.locks:
+                if locked in revs:
+                    raise IOError('Revision %s of %s is locked by %s' % (locked, name, user))
+            # the full text of every revision on the trunk, newest first
+            trunk = []
+            entry = rcs.delta(rcs.head)
+            text = entry.text
+            while True:
+                if entry.branches:
+                    raise IOError('Revision %s of %s has branches' % (entry.rev, name))
+                trunk.append((entry, text))
+                if entry.next is None:
+                    break
+                entry = rcs.delta(entry.next)
+                text = apply_diff(text, entry.text)
+            if len(trunk) != len(rcs.deltas):
+                raise IOError(name + ' has revisions that are not on the trunk')
+            kept = [(entry, text) for entry, text in trunk if entry.rev not in revs]
+            for index, (entry, text) in enumerate(kept):
+                entry.next = kept[index + 1][0].rev if index + 1 < len(kept) else None
+                if index > 0:
+                    entry.text = compute_diff(kept[index - 1][1], text)
+            rcs.deltas = [entry for entry, text in kept]
+            rcs.texts = list(rcs.deltas)
+            rcs.symbols = [pair for pair in rcs.symbols if pair[1] not in revs]
+            self._write(name, rcs)
+
+    # --- Exported support methods ---
+
+    # tests whether NAME_REV (which must have a version file) is locked
+    def islocked(self, name_rev):
+        name, rev = self.checkfile(name_rev)
+        if self._read(name, 0).locks:
+            return True
+        return None
+
+    # --- Internal methods ---
+
+    # reads the ,v file of NAME
+    # @param texts number of deltatexts to read (see parse_file)
+    def _read(self, name, texts=None):
+        with open(self.rcsname(name), 'rb') as rcs_file:
+            return parse_file(rcs_file.read(), texts)
+
+    # reads the ,v file of NAME up to the text of the head
+    def _read_head(self, name):
+        rcs = self._read(name, 1)
+        if not rcs.texts or rcs.texts[0].rev != rcs.head:
+            # not written by RCS, the head text is somewhere else
+            rcs = self._read(name)
+        return rcs
+
+    # replaces the ,v file of NAME (keeping its permissions)
+    def _write(self, name, rcs):
+        namev = self.rcsname(name)
+        mode = os.stat(namev).st_mode & 0777
+        _replace(namev, format_file(rcs), mode & ~_WRITE_BITS)
+
+    # returns the text of a revision on the trunk
+    def _text(self, rcs, rev):
+        entry = rcs.delta(rcs.head)
+        text = entry.text
+        while entry.rev != rev:
+            if entry.next is None:
+                raise IOError('Revision ' + rev + ' is not on the trunk')
+            entry = rcs.delta(entry.next)
+            text = apply_diff(text, entry.text)
+        return text
+
+    # locks a revision for a user
+    def _set_lock(self, rcs, rev, user):
+        rcs.delta(rev)
+        locker = rcs.locker(rev)
+        if locker is not None and locker != user:
+            self.logger.debug('%s takes over the lock of %s on revision %s' % (user, locker, rev))
+        rcs.locks = [lock for lock in rcs.locks if lock[1] != rev]
+        rcs.locks.insert(0, (user, rev))
+
+
+# writes a file into a temporary file next to it and renames it into place
+def _replace(path, content, mode):
+    handle, temp = tempfile.mkstemp(prefix=',', suffix=',', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(content)
+        os.chmod(temp, mode)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+# formats a date of a ,v file like rlog
+def _display_date(date):
+    parts = date.split('.')
+    if len(parts[0]) == 2:
+        parts[0] = '19' + parts[0]
+    return '%s/%s/%s %s:%s:%s' % tuple(parts)
@@ -0,0 +1,62 @@
+#
+# Path_Index
+# the sorted keys of a map of paths, to find everything in a directory
+#
+# The paths in a directory d follow each other in sorted order: they are
+# the paths from d + os.sep up to (but not including) d followed by the
+# character after os.sep. They are found by bisecting the sorted list, so
+# deleting or moving a directory does not scan every key of the map.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import bisect
+import os
+
+
+# returns the range of the paths in a directory
+# @param path the path of the directory
+# @returns (lowest path, first path after the directory)
+def prefix_range(path):
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+class Path_Index(object):
+
+    # Constructor
+    # @param paths the paths to start with
+    def __init__(self, paths=()):
+        self._paths = sorted(set(paths))
+
+    # adds a path (if it is not in the index)
+    # @param path the path
+    def add(self, path):
+        index = bisect.bisect_left(self._paths, path)
+        if index == len(self._paths) or self._paths[index] != path:
+            self._paths.insert(index, path)
+
+    # removes a path (if it is in the index)
+    # @param path the path
+    def discard(self, path):
+        index = bisect.bisect_left(self._paths, path)
+        if index < len(self._paths) and self._paths[index] == path:
+            del self._paths[index]
+
+    # returns a path and everything in it
+    # @param path the path of a file or of a directory
+    # @returns a sorted list of the paths in the index
+    def under(self, path):
+        index = bisect.bisect_left(self._paths, path)
+        found = self._paths[index:index + 1]
+        if found != [path]:
+            found = []
+        low, high = prefix_range(path)
+        return found + self._paths[bisect.bisect_left(self._paths, low):
+                                   bisect.bisect_left(self._paths, high)]
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path):
+        index = bisect.bisect_left(self._paths, path)
+        return index < len(self._paths) and self._paths[index] == path
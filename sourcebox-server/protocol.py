@@ -0,0 +1,1032 @@
+#
+# Protocol
+# binary framing of the sourceBox wire protocol
+#
+# Every message is one frame: a fixed header followed by the path and the
+# payload. The header carries the opcode, some flags, the length of the path,
+# a sequence number and the length of the payload, so the receiver always
+# knows where a frame ends, no matter how the bytes were split or glued
+# together by TCP.
+#
+#   +--------+-------+----------+-----+-------------+------+---------+
+#   | opcode | flags | path_len | seq | payload_len | path | payload |
+#   |   1B   |  1B   |    2B    | 4B  |     8B      |      |         |
+#   +--------+-------+----------+-----+-------------+------+---------+
+#
+# Every request carries a sequence number chosen by its sender. OK and ERROR
+# frames carry the sequence number of the request they answer, so many
+# requests can be in flight on one connection at the same time.
+#
+# The client announces FLAG_COMPRESSED in its INIT frame if it can handle
+# compressed payloads. The server answers the INIT with an OK frame, which
+# carries FLAG_COMPRESSED if both sides compress. After that, file contents
+# may be sent zlib compressed (see compress_payload), marked by the flag.
+#
+# A BATCH frame carries many operations at once (see encode_batch). Its
+# payload is a sequence of complete frames without sequence numbers and it
+# is answered with a single OK or ERROR.
+#
+# Before a large file is sent, the sender announces its sha256 digest with a
+# HAVE frame. A receiver that already has that content applies it from its
+# own copy and answers OK, otherwise it answers NEED and the content follows.
+#
+# Files of CHUNKED_THRESHOLD bytes or more are sent in chunks (see
+# chunking.py): a CHUNKS frame lists the digests of the chunks of the file
+# (see encode_chunks). A receiver that has all of them puts the file
+# together and answers OK, otherwise it answers NEED with the indexes of the
+# missing chunks (see encode_missing). The sender sends them as CHUNK frames
+# and the CHUNKS frame again. Chunks are kept by the receiver, so a transfer
+# that was interrupted goes on where it stopped and after an edit only the
+# changed chunks are sent.
+#
+# A client that sets FLAG_MANIFEST in its INIT sends a MANIFEST frame after
+# the handshake: a list of everything in its box (see encode_manifest). The
+# server only sends the files that are missing or different on the client
+# instead of the whole box.
+#
+# File contents are sent with sendfile if the platform has it (os.sendfile
+# on Python 3, the sendfile module of pysendfile on Python 2): the kernel
+# copies from the file to the socket, the content never passes through
+# Python. Without it, files are read in chunks.
+#
+# This module is used by both the client and the server. The copies in
+# sourcebox-client and sourcebox-server have to be kept identical.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import binascii
+import cStringIO
+import errno
+import hashlib
+import mmap
+import os
+import select
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    from os import sendfile as _sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+# header layout (network byte order)
+HEADER = struct.Struct('!BBHIQ')
+
+# opcodes
+OP_INIT = 1
+OP_OK = 2
+OP_ERROR = 3
+OP_CLOSE = 4
+OP_NEED = 5
+OP_CREATE_FILE = 10
+OP_MODIFY = 11
+OP_REMOVE = 12
+OP_MOVE = 13
+OP_CREATE_DIR = 14
+OP_DELETE_DIR = 15
+OP_LOCK = 16
+OP_UNLOCK = 17
+OP_BATCH = 18
+OP_HAVE = 19
+OP_MANIFEST = 20
+OP_CHUNKS = 21
+OP_CHUNK = 22
+
+OPCODE_NAMES = {
+    OP_INIT: 'INIT',
+    OP_OK: 'OK',
+    OP_ERROR: 'ERROR',
+    OP_CLOSE: 'CLOSE',
+    OP_NEED: 'NEED',
+    OP_CREATE_FILE: 'CREATE_FILE',
+    OP_MODIFY: 'MODIFY',
+    OP_REMOVE: 'REMOVE',
+    OP_MOVE: 'MOVE',
+    OP_CREATE_DIR: 'CREATE_DIR',
+    OP_DELETE_DIR: 'DELETE_DIR',
+    OP_LOCK: 'LOCK',
+    OP_UNLOCK: 'UNLOCK',
+    OP_BATCH: 'BATCH',
+    OP_HAVE: 'HAVE',
+    OP_MANIFEST: 'MANIFEST',
+    OP_CHUNKS: 'CHUNKS',
+    OP_CHUNK: 'CHUNK',
+}
+
+# opcodes of the answers to requests
+ANSWER_OPCODES = (OP_OK, OP_ERROR, OP_NEED)
+
+# flags
+# the payload of a MODIFY is a delta (see delta.py) instead of the content
+FLAG_DELTA = 0x01
+# the payload is zlib compressed (in INIT and its answer: compression is supported)
+FLAG_COMPRESSED = 0x02
+# in INIT: a MANIFEST follows the handshake, in its answer: the server uses it
+FLAG_MANIFEST = 0x04
+
+# limits
+MAX_PATH = 0xFFFF
+MAX_PAYLOAD = 1 << 40
+MAX_SEQ = 0xFFFFFFFF
+
+# size of a single recv call
+RECV_SIZE = 64 * 1024
+
+# size of the chunks file content is streamed in
+CHUNK_SIZE = 1024 * 1024
+# largest number of bytes passed to a single sendfile call
+SENDFILE_SIZE = 8 * 1024 * 1024
+
+# payloads of these opcodes are written to a spool file instead of memory
+SPOOLED_OPCODES = (OP_CREATE_FILE, OP_MODIFY)
+# smallest payload that is spooled
+SPOOL_THRESHOLD = 64 * 1024
+
+# payloads of these opcodes are compressed (if negotiated)
+COMPRESSED_OPCODES = (OP_CREATE_FILE, OP_MODIFY, OP_BATCH, OP_MANIFEST, OP_CHUNK)
+# smallest and largest payload that is compressed
+COMPRESS_THRESHOLD = 1024
+COMPRESS_MAX_SIZE = 16 * 1024 * 1024
+COMPRESS_LEVEL = 6
+# operations that may be part of a BATCH
+BATCH_OPCODES = (OP_CREATE_FILE, OP_REMOVE, OP_MOVE, OP_CREATE_DIR, OP_DELETE_DIR)
+# largest payload of a BATCH and largest file in a BATCH (larger files are
+# sent on their own)
+BATCH_MAX_SIZE = 4 * 1024 * 1024
+BATCH_FILE_SIZE = 64 * 1024
+
+# smallest file whose digest is announced with HAVE before it is sent
+HAVE_THRESHOLD = 64 * 1024
+# payload of a HAVE: the opcode of the operation and the sha256 digest
+HAVE = struct.Struct('!B32s')
+
+# smallest file that is sent in chunks
+CHUNKED_THRESHOLD = 16 * 1024 * 1024
+# payload of a CHUNKS: the opcode of the operation and the size of the file,
+# followed by the sha256 digests of the chunks
+CHUNKS = struct.Struct('!BQ')
+# an entry of the payload of a NEED answering CHUNKS: the index of a missing chunk
+MISSING = struct.Struct('!I')
+
+# an entry of a MANIFEST: directory (1), file (0) or file deleted since it was
+# synced (2), length of the path, size, mtime in milliseconds, sha256 digest of
+# the content and sha256 digest of the version last synced with the server (all
+# zero if unknown), followed by the path
+MANIFEST_ENTRY = struct.Struct('!BHQQ32s32s')
+MANIFEST_DIR = 1
+MANIFEST_DELETED = 2
+_NO_DIGEST = '\0' * 32
+
+# a payload is only compressed if a sample of its start shrinks below this ratio
+COMPRESS_RATIO = 0.9
+COMPRESS_SAMPLE_SIZE = 16 * 1024
+
+
+# Raised when the peer sends something that is not a valid frame
+class Protocol_Error(IOError):
+    pass
+
+
+# An entry of a MANIFEST
+class Manifest_Entry(object):
+
+    # Constructor
+    # @param path the path relative to the box ('/' as separator)
+    # @param is_dir True for a directory
+    # @param size the size of the file
+    # @param mtime the modification time (seconds)
+    # @param digest the hex digest of the content (None if unknown)
+    # @param rev the hex digest of the version last synced with the server
+    #            (the last seen revision, None if unknown)
+    # @param deleted True for a file that was deleted since version rev was synced
+    def __init__(self, path, is_dir=False, size=0, mtime=0, digest=None, rev=None, deleted=False):
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.rev = rev
+        self.deleted = deleted
+
+    def __repr__(self):
+        if self.is_dir:
+            return '<Manifest_Entry %r/>' % self.path
+        if self.deleted:
+            return '<Manifest_Entry %r deleted>' % self.path
+        return '<Manifest_Entry %r %d bytes>' % (self.path, self.size)
+
+
+# A decoded frame
+# Large file contents are not held in memory: payload is empty then and
+# payload_file names a temporary file holding the content. The receiver of
+# the frame has to move that file into place or delete it.
+class Frame(object):
+
+    def __init__(self, opcode, flags=0, path='', payload='', seq=0, payload_file=None, size=None):
+        self.opcode = opcode
+        self.flags = flags
+        self.seq = seq
+        self.path = path
+        self.payload = payload
+        self.payload_file = payload_file
+        if size is None:
+            size = len(payload)
+        self.size = size
+
+    # name of the opcode (for logging)
+    def name(self):
+        return OPCODE_NAMES.get(self.opcode, str(self.opcode))
+
+    # removes the spool file (if the payload is not used)
+    def discard(self):
+        if self.payload_file is not None:
+            try:
+                os.remove(self.payload_file)
+            except OSError:
+                pass
+            self.payload_file = None
+
+    def __repr__(self):
+        return '<Frame %s #%d %r (%d bytes)>' % (self.name(), self.seq, self.path, self.size)
+
+
+# converts a local path to its representation on the wire
+# @param path the path relative to the sourceBox root
+# @returns a utf-8 encoded string with '/' as separator
+def encode_path(path):
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path.replace(os.sep, '/')
+
+
+# converts a path from the wire to a local path
+# @param path a utf-8 encoded string with '/' as separator
+# @returns the path relative to the sourceBox root
+def decode_path(path):
+    return path.replace('/', os.sep)
+
+
+# encodes the header and the path of a frame
+# @param opcode the opcode
+# @param path the path (relative to the source box)
+# @param payload_len the number of payload bytes following the path
+# @param flags the flags
+# @param seq the sequence number
+# @returns a string
+def encode_header(opcode, path='', payload_len=0, flags=0, seq=0):
+    path = encode_path(path)
+    if len(path) > MAX_PATH:
+        raise Protocol_Error('Path too long: ' + path[:64] + '...')
+    return HEADER.pack(opcode, flags, len(path), seq, payload_len) + path
+
+
+# encodes a complete frame
+# @param opcode the opcode
+# @param path the path (relative to the source box)
+# @param payload the payload
+# @param flags the flags
+# @param seq the sequence number
+# @returns a string
+def encode_frame(opcode, path='', payload='', flags=0, seq=0):
+    return encode_header(opcode, path, len(payload), flags, seq) + payload
+
+
+# encodes the operations of a BATCH
+# @param frames the operations (Frames with an opcode from BATCH_OPCODES)
+# @returns the payload of the BATCH frame
+def encode_batch(frames):
+    return ''.join(encode_frame(frame.opcode, frame.path, frame.payload, frame.flags)
+                   for frame in frames)
+
+
+# decodes the operations of a BATCH
+# @param payload the payload of the BATCH frame
+# @returns a list of Frames
+# @throws Protocol_Error if the payload is corrupt
+def decode_batch(payload):
+    decoder = Frame_Decoder(max_payload=len(payload))
+    decoder.feed(payload)
+    frames = list(decoder)
+    if decoder.pending():
+        raise Protocol_Error('Truncated batch')
+    for frame in frames:
+        if frame.opcode not in BATCH_OPCODES:
+            raise Protocol_Error(frame.name() + ' is not allowed in a batch')
+    return frames
+
+
+# computes the sha256 digest of a file (the digest announced with HAVE)
+# @param path the file
+# @returns the hex digest
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as open_file:
+        chunk = open_file.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = open_file.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+# computes the sha256 digest of a content
+# @param content the content
+# @returns the hex digest
+def hash_content(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+# encodes the payload of a HAVE frame
+# @param opcode the operation (OP_CREATE_FILE or OP_MODIFY)
+# @param digest the hex sha256 digest of the content
+# @returns the payload
+def encode_have(opcode, digest):
+    return HAVE.pack(opcode, binascii.unhexlify(digest))
+
+
+# decodes the payload of a HAVE frame
+# @param payload the payload
+# @returns (opcode, hex digest)
+# @throws Protocol_Error if the payload is corrupt
+def decode_have(payload):
+    if len(payload) != HAVE.size:
+        raise Protocol_Error('Invalid HAVE')
+    opcode, digest = HAVE.unpack(payload)
+    if opcode not in (OP_CREATE_FILE, OP_MODIFY):
+        raise Protocol_Error('Invalid HAVE for ' + OPCODE_NAMES.get(opcode, str(opcode)))
+    return opcode, binascii.hexlify(digest)
+
+
+# encodes the payload of a CHUNKS frame
+# @param opcode the operation (OP_CREATE_FILE or OP_MODIFY)
+# @param size the size of the file
+# @param digests the hex sha256 digests of the chunks, in order
+# @returns the payload
+def encode_chunks(opcode, size, digests):
+    return CHUNKS.pack(opcode, size) + ''.join(binascii.unhexlify(digest) for digest in digests)
+
+
+# decodes the payload of a CHUNKS frame
+# @param payload the payload
+# @returns (opcode, size, hex digests)
+# @throws Protocol_Error if the payload is corrupt
+def decode_chunks(payload):
+    if len(payload) < CHUNKS.size or (len(payload) - CHUNKS.size) % 32:
+        raise Protocol_Error('Invalid CHUNKS')
+    opcode, size = CHUNKS.unpack_from(payload)
+    if opcode not in (OP_CREATE_FILE, OP_MODIFY):
+        raise Protocol_Error('Invalid CHUNKS for ' + OPCODE_NAMES.get(opcode, str(opcode)))
+    digests = [binascii.hexlify(payload[pos:pos + 32])
+               for pos in xrange(CHUNKS.size, len(payload), 32)]
+    return opcode, size, digests
+
+
+# encodes the payload of a NEED answering CHUNKS
+# @param indexes the indexes of the missing chunks
+# @returns the payload
+def encode_missing(indexes):
+    return ''.join(MISSING.pack(index) for index in indexes)
+
+
+# decodes the payload of a NEED answering CHUNKS
+# @param payload the payload
+# @returns the indexes of the missing chunks
+# @throws Protocol_Error if the payload is corrupt
+def decode_missing(payload):
+    if len(payload) % MISSING.size:
+        raise Protocol_Error('Invalid list of missing chunks')
+    return [MISSING.unpack_from(payload, pos)[0] for pos in xrange(0, len(payload), MISSING.size)]
+
+
+# encodes the payload of a MANIFEST frame
+# @param entries the Manifest_Entries
+# @returns the payload
+def encode_manifest(entries):
+    parts = []
+    for entry in entries:
+        path = encode_path(entry.path)
+        if len(path) > MAX_PATH:
+            raise Protocol_Error('Path too long')
+        if entry.is_dir:
+            kind = MANIFEST_DIR
+        elif entry.deleted:
+            kind = MANIFEST_DELETED
+        else:
+            kind = 0
+        parts.append(MANIFEST_ENTRY.pack(
+            kind, len(path), entry.size, int(entry.mtime * 1000),
+            _encode_digest(entry.digest), _encode_digest(entry.rev)))
+        parts.append(path)
+    return ''.join(parts)
+
+
+# decodes the payload of a MANIFEST frame
+# @param payload the payload
+# @returns a list of Manifest_Entries
+# @throws Protocol_Error if the payload is corrupt
+def decode_manifest(payload):
+    entries = []
+    pos = 0
+    while pos < len(payload):
+        if len(payload) - pos < MANIFEST_ENTRY.size:
+            raise Protocol_Error('Truncated MANIFEST')
+        kind, path_len, size, mtime, digest, rev = MANIFEST_ENTRY.unpack_from(payload, pos)
+        pos += MANIFEST_ENTRY.size
+        if len(payload) - pos < path_len:
+            raise Protocol_Error('Truncated MANIFEST')
+        path = decode_path(payload[pos:pos + path_len])
+        pos += path_len
+        entries.append(Manifest_Entry(
+            path, kind == MANIFEST_DIR, size, mtime / 1000.0, _decode_digest(digest),
+            _decode_digest(rev), kind == MANIFEST_DELETED))
+    return entries
+
+
+def _encode_digest(digest):
+    if digest is None:
+        return _NO_DIGEST
+    return binascii.unhexlify(digest)
+
+
+def _decode_digest(digest):
+    if digest == _NO_DIGEST:
+        return None
+    return binascii.hexlify(digest)
+
+
+# guesses if data is worth compressing (compressed files, images, archives
+# are not) by compressing a sample of its start with the fastest level
+# @param data the data
+# @returns a boolean
+def compressible(data):
+    sample = data[:COMPRESS_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_RATIO
+
+
+# compresses the payload of a frame if that is worth it
+# @param opcode the opcode
+# @param payload the payload
+# @param flags the flags
+# @returns (payload, flags), flags contain FLAG_COMPRESSED if it was compressed
+def compress_payload(opcode, payload, flags=0):
+    if (opcode not in COMPRESSED_OPCODES or
+            not COMPRESS_THRESHOLD <= len(payload) <= COMPRESS_MAX_SIZE or
+            not compressible(payload)):
+        return payload, flags
+    compressed = zlib.compress(payload, COMPRESS_LEVEL)
+    if len(compressed) >= len(payload) * COMPRESS_RATIO:
+        return payload, flags
+    return compressed, flags | FLAG_COMPRESSED
+
+
+# sends a frame over a blocking socket
+# The payload is sent separately, so it is not copied into a new string.
+# @param sock the socket
+# @param opcode the opcode
+# @param path the path (relative to the source box)
+# @param payload the payload
+# @param flags the flags
+# @param seq the sequence number
+def send_frame(sock, opcode, path='', payload='', flags=0, seq=0):
+    header = encode_header(opcode, path, len(payload), flags, seq)
+    if len(payload) < 4096:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+# sends a frame with the content of a file as payload over a blocking socket
+# The file is streamed in chunks, it is never loaded into memory as a whole
+# (unless it is compressed).
+# @param sock the socket
+# @param opcode the opcode
+# @param path the path (relative to the source box)
+# @param source the file to send
+# @param flags the flags
+# @param seq the sequence number
+# @param compress if True, the content may be compressed
+def send_file_frame(sock, opcode, path, source, flags=0, seq=0, compress=False):
+    producer = Frame_Producer(opcode, path, source, flags, seq, compress)
+    try:
+        # the header
+        sock.sendall(producer.more())
+        while producer.remaining:
+            if producer.zero_copy:
+                if not producer.send_to(sock) and producer.zero_copy:
+                    # a socket with a timeout is non-blocking for sendfile
+                    select.select([], [sock], [], sock.gettimeout())
+            else:
+                sock.sendall(producer.more())
+    finally:
+        producer.close()
+
+
+# Reads a file in chunks for sending it as payload, or sends it directly
+# from the file to the socket (see send_to).
+# The size is taken when the file is opened. If the file shrinks while it is
+# sent, the rest is padded with zeros, so the frame stays intact.
+class File_Producer(object):
+
+    # Constructor
+    # @param source the file to send
+    def __init__(self, source):
+        self.file = open(source, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.remaining = self.size
+        # True while send_to can be used
+        self.zero_copy = _sendfile is not None
+
+    # sends the next part of the file with sendfile (only if zero_copy is set)
+    # @param sock the socket (blocking or not)
+    # @returns the number of bytes sent (0 if the socket is not ready, or
+    #          the file shrank and zero_copy was cleared)
+    def send_to(self, sock):
+        offset = self.size - self.remaining
+        try:
+            sent = _sendfile(sock.fileno(), self.file.fileno(), offset,
+                             min(self.remaining, SENDFILE_SIZE))
+        except (OSError, IOError), err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            if err.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK):
+                raise
+            # sendfile does not work for this file or socket
+            sent = 0
+        if not sent:
+            # the rest is read (and padded) by more
+            self.zero_copy = False
+            self.file.seek(offset)
+            return 0
+        self.remaining -= sent
+        return sent
+
+    # True if the next bytes can be sent with send_to
+    def direct(self):
+        return self.zero_copy and self.remaining > 0
+
+    # returns the next chunk or '' when the file is sent completely
+    def more(self):
+        if not self.remaining:
+            self.close()
+            return ''
+        chunk = self.file.read(min(CHUNK_SIZE, self.remaining))
+        if not chunk:
+            chunk = '\0' * min(CHUNK_SIZE, self.remaining)
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+
+# Produces a complete frame (header and the content of a file) chunk by chunk.
+# The first chunk is the header. If the content may be compressed, that is
+# decided in prepare, so a queued frame holds no content in memory.
+class Frame_Producer(File_Producer):
+
+    # Constructor
+    # @param opcode the opcode
+    # @param path the path (relative to the source box)
+    # @param source the file to send
+    # @param flags the flags
+    # @param seq the sequence number
+    # @param compress if True, the content may be compressed
+    def __init__(self, opcode, path, source, flags=0, seq=0, compress=False):
+        File_Producer.__init__(self, source)
+        self._frame = (opcode, path, flags, seq)
+        self._compress = compress and COMPRESS_THRESHOLD <= self.size <= COMPRESS_MAX_SIZE
+        self._header = None
+        if not self._compress:
+            self.prepare()
+
+    # True if the header is known
+    def prepared(self):
+        return self._header is not None
+
+    # compresses the content (if worth it) and encodes the header
+    # This reads the whole file if it is compressible and may take a while.
+    def prepare(self):
+        if self._header is not None:
+            return
+        opcode, path, flags, seq = self._frame
+        if self._compress:
+            # tried only once, after an error the content is sent as it is
+            self._compress = False
+            sample = self.file.read(COMPRESS_SAMPLE_SIZE)
+            if compressible(sample):
+                payload = None
+                try:
+                    # compressed from the page cache, without a copy on the heap
+                    content = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (mmap.error, ValueError, EnvironmentError):
+                    content = None
+                if content is not None and len(content) == self.size:
+                    try:
+                        payload, flags = compress_payload(opcode, content, flags)
+                    finally:
+                        content.close()
+                    if not flags & FLAG_COMPRESSED:
+                        payload = None
+                elif content is not None:
+                    # the file changed since it was opened
+                    content.close()
+                if payload is not None:
+                    self.file.close()
+                    self.file = cStringIO.StringIO(payload)
+                    self.remaining = len(payload)
+                    self.zero_copy = False
+        self.file.seek(0)
+        self._header = encode_header(opcode, path, self.remaining, flags, seq)
+
+    def direct(self):
+        return self._header == '' and File_Producer.direct(self)
+
+    def more(self):
+        self.prepare()
+        if self._header:
+            header, self._header = self._header, ''
+            return header
+        return File_Producer.more(self)
+
+
+# Incremental decoder for the frame stream of one connection.
+# Bytes are fed in as they are read from the socket, complete frames can be
+# taken out afterwards. A single feed may contain many frames or only a part
+# of one.
+# If a spool directory is given, large file contents are written straight to
+# a temporary file in that directory while they arrive (see Frame). An event
+# loop must not wait for the disk: it feeds the bytes and leaves decoding to
+# another thread as long as spools() is True.
+class Frame_Decoder(object):
+
+    # Constructor
+    # @param max_payload the largest payload that is accepted
+    # @param spool_dir directory for the spool files (None: keep everything in memory)
+    def __init__(self, max_payload=MAX_PAYLOAD, spool_dir=None):
+        self.max_payload = max_payload
+        self.spool_dir = spool_dir
+        self._buffer = bytearray()
+        self._offset = 0
+        # the frame whose payload is being spooled and the open spool file
+        self._spooling = None
+        self._spool = None
+        self._remaining = 0
+        # preallocated receive buffer
+        self._chunk = bytearray(CHUNK_SIZE)
+
+    # adds bytes read from the socket
+    # @param data the bytes
+    def feed(self, data):
+        self._buffer.extend(data)
+
+    # reads the next bytes from a socket
+    # While a payload is spooled and nothing else is buffered, the bytes go
+    # directly from the socket into the spool file.
+    # @param sock the socket
+    # @returns the number of bytes read (0 if the connection was closed)
+    def read_from(self, sock):
+        view = memoryview(self._chunk)
+        if self._spooling is not None and not self.pending():
+            count = sock.recv_into(view[:min(CHUNK_SIZE, self._remaining)])
+            self._spool.write(view[:count])
+            self._remaining -= count
+        else:
+            count = sock.recv_into(view)
+            self._buffer.extend(view[:count])
+        return count
+
+    # number of bytes that are buffered but not yet decoded
+    def pending(self):
+        return len(self._buffer) - self._offset
+
+    # takes the next complete frame out of the buffer
+    # @returns a Frame or None if no complete frame is buffered
+    # @throws Protocol_Error if the stream is corrupt
+    def next_frame(self):
+        if self._spooling is not None:
+            return self._continue_spool()
+
+        available = len(self._buffer) - self._offset
+        if available < HEADER.size:
+            self._compact()
+            return None
+
+        opcode, flags, path_len, seq, payload_len = HEADER.unpack_from(
+            buffer(self._buffer), self._offset)
+        if opcode not in OPCODE_NAMES:
+            raise Protocol_Error('Unknown opcode ' + str(opcode))
+        if payload_len > self.max_payload:
+            raise Protocol_Error('Payload too large: ' + str(payload_len))
+
+        if self._spooled(opcode, flags, payload_len):
+            if available < HEADER.size + path_len:
+                self._compact()
+                return None
+            start = self._offset + HEADER.size
+            path = str(self._buffer[start:start + path_len])
+            self._offset = start + path_len
+            self._start_spool(Frame(opcode, flags, decode_path(path), '', seq, size=payload_len))
+            return self._continue_spool()
+
+        frame_len = HEADER.size + path_len + payload_len
+        if available < frame_len:
+            self._compact()
+            return None
+
+        start = self._offset + HEADER.size
+        path = str(self._buffer[start:start + path_len])
+        start += path_len
+        payload = str(self._buffer[start:start + payload_len])
+        self._offset += frame_len
+
+        if flags & FLAG_COMPRESSED and opcode in COMPRESSED_OPCODES:
+            payload = self._decompress(payload)
+            flags &= ~FLAG_COMPRESSED
+        return Frame(opcode, flags, decode_path(path), payload, seq)
+
+    # checks if decoding the buffered bytes writes to a spool file: a payload
+    # is being spooled or the next frame is spooled
+    def spools(self):
+        if self._spooling is not None:
+            return True
+        if self.pending() < HEADER.size:
+            return False
+        opcode, flags, path_len, seq, payload_len = HEADER.unpack_from(
+            buffer(self._buffer), self._offset)
+        return self._spooled(opcode, flags, payload_len)
+
+    # iterates over all complete frames in the buffer
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    # removes a half received spool file (e.g. when the connection is lost)
+    def close(self):
+        if self._spooling is not None:
+            self._spool.close()
+            self._spooling.discard()
+            self._spooling = None
+            self._spool = None
+
+    # checks if the payload of a frame is spooled
+    def _spooled(self, opcode, flags, payload_len):
+        return (self.spool_dir is not None and opcode in SPOOLED_OPCODES
+                and not flags & FLAG_DELTA and payload_len >= SPOOL_THRESHOLD)
+
+    # opens the spool file for a frame
+    def _start_spool(self, frame):
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        handle, frame.payload_file = tempfile.mkstemp(prefix='.sb-', dir=self.spool_dir)
+        self._spool = os.fdopen(handle, 'wb')
+        self._spooling = frame
+        self._remaining = frame.size
+
+    # moves buffered payload bytes into the spool file
+    # @returns the Frame if its payload is complete, else None
+    def _continue_spool(self):
+        count = min(self._remaining, self.pending())
+        if count:
+            self._spool.write(buffer(self._buffer, self._offset, count))
+            self._offset += count
+            self._remaining -= count
+        self._compact()
+        if self._remaining:
+            return None
+
+        frame = self._spooling
+        self._spool.close()
+        self._spooling = None
+        self._spool = None
+        if frame.flags & FLAG_COMPRESSED:
+            self._decompress_spool(frame)
+        return frame
+
+    # decompresses a payload
+    # @throws Protocol_Error if it is corrupt or too large
+    def _decompress(self, payload):
+        inflater = zlib.decompressobj()
+        try:
+            data = inflater.decompress(payload, self.max_payload + 1)
+        except zlib.error, err:
+            raise Protocol_Error('Corrupt compressed payload: ' + str(err))
+        if len(data) > self.max_payload or inflater.unconsumed_tail:
+            raise Protocol_Error('Payload too large')
+        return data
+
+    # replaces the compressed spool file of a frame by the decompressed content
+    # @throws Protocol_Error if it is corrupt or too large
+    def _decompress_spool(self, frame):
+        inflater = zlib.decompressobj()
+        handle, payload_file = tempfile.mkstemp(prefix='.sb-', dir=self.spool_dir)
+        size = 0
+        try:
+            with open(frame.payload_file, 'rb') as source:
+                with os.fdopen(handle, 'wb') as target:
+                    chunk = source.read(CHUNK_SIZE)
+                    while chunk:
+                        data = inflater.decompress(chunk)
+                        size += len(data)
+                        if size > self.max_payload:
+                            raise Protocol_Error('Payload too large')
+                        target.write(data)
+                        chunk = source.read(CHUNK_SIZE)
+                    data = inflater.flush()
+                    size += len(data)
+                    target.write(data)
+        except (zlib.error, Protocol_Error), err:
+            frame.discard()
+            os.remove(payload_file)
+            raise Protocol_Error('Corrupt compressed payload: ' + str(err))
+        frame.discard()
+        frame.payload_file = payload_file
+        frame.size = size
+        frame.flags &= ~FLAG_COMPRESSED
+
+    # drops consumed bytes from the front of the buffer
+    def _compact(self):
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+
+
+# reads from a blocking socket until the next frame is complete
+# @param sock the socket
+# @param decoder the Frame_Decoder of the connection
+# @returns a Frame or None if the connection was closed
+def read_frame(sock, decoder):
+    frame = decoder.next_frame()
+    while frame is None:
+        if not decoder.read_from(sock):
+            return None
+        frame = decoder.next_frame()
+    return frame
+
+
+# A request that was sent and has not been answered yet
+class Pending_Request(object):
+
+    # Constructor
+    # @param seq the sequence number of the request
+    # @param opcode the opcode of the request
+    # @param path the path of the request
+    # @param callback called with (request) when the answer arrives or the request fails
+    # @param timeout seconds after the request was sent after which it fails
+    #        (None: the timeout of the tracker)
+    def __init__(self, seq, opcode, path, callback=None, timeout=None):
+        self.seq = seq
+        self.opcode = opcode
+        self.path = path
+        self.callback = callback
+        self.timeout = timeout
+        # the time the last byte was sent (None while it is sent, a large
+        # content does not use up the timeout)
+        self.sent_at = None
+        # True if answered with OK, False if answered with ERROR or failed
+        self.ok = None
+        # the answer frame (None if the request timed out)
+        self.answer = None
+        # reason if the request failed without an answer
+        self.reason = None
+        self._done = threading.Event()
+
+    # waits for the answer
+    # @param timeout the timeout in seconds
+    # @returns True if the request was answered with OK
+    # @throws IOError if there is no answer in time or the answer is an error
+    def wait(self, timeout):
+        if not self._done.wait(timeout):
+            raise IOError('Did not recieve a response for ' + self.describe())
+        if not self.ok:
+            raise IOError(self.reason or 'Error answer for ' + self.describe())
+        return True
+
+    # records that the last byte of the request was sent, the timeout starts now
+    def sent(self):
+        self.sent_at = time.time()
+
+    # whether the request is answered (or failed)
+    def done(self):
+        return self._done.is_set()
+
+    # a short description for log messages
+    def describe(self):
+        return '%s #%d %r' % (OPCODE_NAMES.get(self.opcode, str(self.opcode)), self.seq, self.path)
+
+    # marks the request as done
+    def _finish(self, ok, answer=None, reason=None):
+        self.ok = ok
+        self.answer = answer
+        self.reason = reason
+        self._done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+
+# Table of the requests in flight on one connection.
+# It hands out the sequence numbers, matches OK/ERROR answers to their
+# requests and limits how many requests may be in flight at the same time.
+class Request_Tracker(object):
+
+    # Constructor
+    # @param window maximum number of requests in flight
+    # @param timeout seconds after which a sent request without answer fails
+    def __init__(self, window=32, timeout=8.0):
+        self.window = max(1, window)
+        self.timeout = timeout
+        self._pending = {}
+        self._next_seq = 1
+        self._closed = False
+        self._condition = threading.Condition()
+
+    # registers a new request, blocks while the window is full
+    # @param opcode the opcode of the request
+    # @param path the path of the request
+    # @param callback called with (request) when the request is done
+    # @param block if False, return None instead of waiting for a free slot
+    # @param timeout seconds after the request was sent after which it fails
+    #        (None: the timeout of the tracker)
+    # @returns a Pending_Request with a fresh sequence number (the sender
+    #          calls its sent() once the request is sent)
+    # @throws IOError if the connection is closed
+    def register(self, opcode, path='', callback=None, block=True, timeout=None):
+        request = None
+        with self._condition:
+            expired = self._pop_overdue()
+            while block and len(self._pending) >= self.window and not self._closed:
+                self._condition.wait(0.5)
+                expired.extend(self._pop_overdue())
+            if self._closed:
+                raise IOError('Connection closed')
+
+            if len(self._pending) < self.window:
+                seq = self._next_seq
+                self._next_seq = seq % MAX_SEQ + 1
+                request = Pending_Request(seq, opcode, path, callback, timeout)
+                self._pending[seq] = request
+
+        for overdue in expired:
+            overdue._finish(False, reason='Did not recieve a response for ' + overdue.describe())
+        return request
+
+    # matches an answer frame to its request
+    # @param frame an OK or ERROR frame
+    # @returns the Pending_Request or None if the sequence number is unknown
+    def complete(self, frame):
+        with self._condition:
+            request = self._pending.pop(frame.seq, None)
+            self._condition.notify()
+        if request is not None:
+            request._finish(frame.opcode == OP_OK, frame, frame.payload or None)
+        return request
+
+    # removes a request that will never be answered (e.g. the send failed)
+    # @param request the Pending_Request
+    # @param reason the reason
+    def cancel(self, request, reason):
+        with self._condition:
+            cancelled = self._pending.pop(request.seq, None) is request
+            self._condition.notify()
+        if cancelled:
+            request._finish(False, reason=reason)
+
+    # fails every sent request that waited longer than the timeout
+    def expire(self):
+        with self._condition:
+            expired = self._pop_overdue()
+            self._condition.notify_all()
+        for request in expired:
+            request._finish(False, reason='Did not recieve a response for ' + request.describe())
+
+    # fails all pending requests, e.g. when the connection was lost
+    # @param reason the reason
+    def close(self, reason='Connection closed'):
+        with self._condition:
+            self._closed = True
+            pending = self._pending.values()
+            self._pending = {}
+            self._condition.notify_all()
+        for request in pending:
+            request._finish(False, reason=reason)
+
+    # number of requests in flight
+    def in_flight(self):
+        return len(self._pending)
+
+    # removes the overdue requests (the condition has to be held)
+    def _pop_overdue(self):
+        now = time.time()
+        overdue = [seq for seq, request in self._pending.iteritems()
+                   if request.sent_at is not None and
+                   now - request.sent_at > (request.timeout or self.timeout)]
+        return [self._pending.pop(seq) for seq in overdue]
@@ -160,6 +160,17 @@ class RCS:
                   (lockflag, rev, message, user, otherflags, name)
         return self._system(cmd)
 
+    def outdate(self, name_rev, revs):
+        """Remove the revisions REVS of NAME_REV (rcs -o).
+
+        The head revision and locked revisions cannot be removed.
+
+        """
+        name, rev = self.checkfile(name_rev)
+        for rev in revs:
+            cmd = "rcs -q -o%s \"%s\"" % (rev, name)
+            self._system(cmd)
+
     # --- Exported support methods ---
 
     def listfiles(self, pat=None):
@@ -0,0 +1,219 @@
+#
+# Retention
+# removes old revisions from the ,v files in the background
+#
+# Without it the ,v files (and rlog) grow with every revision. A policy
+# says which revisions of a file are kept:
+#
+#   keep_last   the newest revisions
+#   keep_daily  the newest revision of each of the last days with revisions
+#   max_age     days after which a revision is removed, even if one of the
+#               rules above keeps it
+#
+# A revision is kept if keep_last or keep_daily keeps it (everything is kept
+# if both are 0) and it is not older than max_age (0: no limit). The head
+# and locked revisions are always kept. The policy of a file is the first
+# rule whose pattern (fnmatch) matches its path.
+#
+# The job goes through all files every interval. It only works while the
+# server has not written or read a file for a while and writes at most rate
+# bytes per second, so it does not compete with the clients for the disk.
+# Removing revisions rewrites the ,v file with new diffs.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import calendar
+import fnmatch
+import logging
+import threading
+import time
+
+# seconds without foreground work before the job goes on
+IDLE_TIME = 1.0
+
+_DATE_FORMAT = '%Y.%m.%d.%H.%M.%S'
+
+
+class Retention_Policy(object):
+
+    # Constructor
+    # @param keep_last the number of newest revisions that are kept
+    # @param keep_daily the number of days whose newest revision is kept
+    # @param max_age days after which revisions are removed (0: no limit)
+    def __init__(self, keep_last=0, keep_daily=0, max_age=0):
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.max_age = max_age
+
+    def __repr__(self):
+        return '<Retention_Policy last %d, daily %d, max age %d days>' % (
+            self.keep_last, self.keep_daily, self.max_age)
+
+    # reads a policy from the config ("keep_last keep_daily max_age")
+    # @param value the value
+    # @throws ValueError if the value is invalid
+    @classmethod
+    def parse(cls, value):
+        numbers = [int(number) for number in value.split()]
+        if len(numbers) != 3 or min(numbers) < 0:
+            raise ValueError('Invalid retention policy ' + repr(value))
+        return cls(*numbers)
+
+    # selects the revisions to remove
+    # @param revisions (revision, time) of the revisions on the trunk, newest first
+    # @param now the current time
+    # @returns the revisions to remove
+    def expired(self, revisions, now):
+        if self.keep_last or self.keep_daily:
+            kept = set(rev for rev, date in revisions[:self.keep_last])
+            days = []
+            for rev, date in revisions:
+                day = time.gmtime(date)[:3]
+                if days and days[-1] == day:
+                    continue
+                if len(days) >= self.keep_daily:
+                    break
+                days.append(day)
+                kept.add(rev)
+        else:
+            kept = set(rev for rev, date in revisions)
+        if self.max_age:
+            kept = set(rev for rev, date in revisions
+                       if rev in kept and now - date <= self.max_age * 86400)
+        if revisions:
+            kept.add(revisions[0][0])
+        return [rev for rev, date in revisions if rev not in kept]
+
+
+class Retention_Rules(object):
+
+    # Constructor
+    # @param items (pattern, policy) as in the config, the first match wins
+    # @throws ValueError if a policy is invalid
+    def __init__(self, items):
+        self.rules = [(pattern, Retention_Policy.parse(value)) for pattern, value in items]
+
+    # returns the policy of a file
+    # @param path the path relative to the sourceBox
+    # @returns a Retention_Policy or None if no rule matches
+    def policy_for(self, path):
+        for pattern, policy in self.rules:
+            if fnmatch.fnmatchcase(path, pattern):
+                return policy
+        return None
+
+
+# returns the revisions on the trunk of a ,v file
+# @param rcs a native_rcs.RCS_File (the metadata is enough)
+# @returns (revision, time) newest first, or None if the file has branches
+def trunk(rcs):
+    revisions = []
+    rev = rcs.head
+    while rev is not None:
+        entry = rcs.delta(rev)
+        if entry.branches:
+            return None
+        date = entry.date
+        if len(date.split('.')[0]) == 2:
+            date = '19' + date
+        revisions.append((rev, calendar.timegm(time.strptime(date, _DATE_FORMAT))))
+        rev = entry.next
+    if len(revisions) != len(rcs.deltas):
+        return None
+    return revisions
+
+
+class Retention_Job(object):
+
+    # Constructor
+    # @param rules the Retention_Rules
+    # @param files returns the paths of all files (relative to the sourceBox)
+    # @param compact called as compact(path, policy), removes the expired
+    #        revisions of a file and returns (revisions removed, bytes
+    #        reclaimed, bytes written)
+    # @param idle_time returns the seconds since the last foreground work
+    # @param interval seconds between two passes
+    # @param rate bytes written per second at most (0: no limit)
+    def __init__(self, rules, files, compact, idle_time, interval, rate):
+        self.log = logging.getLogger("server")
+        self.rules = rules
+        self.files = files
+        self.compact = compact
+        self.idle_time = idle_time
+        self.interval = interval
+        self.rate = rate
+        self.passes = 0
+        self.compacted = 0
+        self.removed = 0
+        self.reclaimed = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name='Retention')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # goes through all files once
+    # @returns (files compacted, revisions removed, bytes reclaimed)
+    def run_once(self):
+        started = time.time()
+        compacted = removed = reclaimed = 0
+        for path in self.files():
+            policy = self.rules.policy_for(path)
+            if policy is None:
+                continue
+            if not self._wait_idle():
+                break
+            try:
+                revisions, freed, written = self.compact(path, policy)
+            except (IOError, OSError), err:
+                self.log.error('Could not remove old revisions of ' + path + ': ' + str(err))
+                with self._lock:
+                    self.failures += 1
+                continue
+            if revisions:
+                compacted += 1
+                removed += revisions
+                reclaimed += freed
+                with self._lock:
+                    self.compacted += 1
+                    self.removed += revisions
+                    self.reclaimed += freed
+            if self.rate > 0 and written:
+                self._stop.wait(float(written) / self.rate)
+        with self._lock:
+            self.passes += 1
+        self.log.info('Retention: %d files compacted, %d revisions removed, %d bytes reclaimed in %.1fs'
+                      % (compacted, removed, reclaimed, time.time() - started))
+        return compacted, removed, reclaimed
+
+    # stops the job (a file being compacted is finished)
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    # returns the counters of the job
+    # @returns a dictionary with passes, compacted, removed, reclaimed and failures
+    def stats(self):
+        with self._lock:
+            return {'passes': self.passes, 'compacted': self.compacted, 'removed': self.removed,
+                    'reclaimed': self.reclaimed, 'failures': self.failures}
+
+    # waits until the server is idle
+    # @returns False if the job was stopped
+    def _wait_idle(self):
+        while not self._stop.is_set():
+            idle = self.idle_time()
+            if idle >= IDLE_TIME:
+                return True
+            self._stop.wait(IDLE_TIME - idle)
+        return False
+
+    # the thread: one pass every interval
+    def _run_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception, err:
+                self.log.error('Retention pass failed: ' + str(err))
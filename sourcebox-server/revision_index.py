@@ -0,0 +1,241 @@
+#
+# Revision_Index
+# persistent index of the RCS metadata of every tracked file
+#
+# For every file with a ,v file the index records the head revision, the
+# user holding the lock on the head, the number of revisions and the author
+# of the head, so lock checks and history summaries do not have to read the
+# ,v file (or run rlog). The index lives in an sqlite database next to the
+# data directory and in a dictionary for the lookups. Every change is
+# written in one transaction after the RCS operation.
+#
+# On startup the index is compared to the ,v files: files whose size or
+# mtime changed (e.g. while the server was down or by the RCS tools) are
+# read again, many of them by a pool of processes.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+import native_rcs
+import path_index
+
+# a pool of processes reads the ,v files only if at least this many changed
+PARALLEL_THRESHOLD = 64
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS revisions (
+    path TEXT PRIMARY KEY,
+    head TEXT,
+    locker TEXT,
+    revisions INTEGER,
+    author TEXT,
+    rcs_mtime REAL,
+    rcs_size INTEGER
+)'''
+
+
+# The metadata of a tracked file
+class Revision_Info(object):
+
+    # Constructor
+    # @param path the path relative to the data directory
+    # @param head the head revision
+    # @param locker the user holding the lock on the head (None if unlocked)
+    # @param revisions the number of revisions
+    # @param author the author of the head
+    # @param rcs_mtime mtime of the ,v file when it was read
+    # @param rcs_size size of the ,v file when it was read
+    def __init__(self, path, head, locker, revisions, author, rcs_mtime, rcs_size):
+        self.path = path
+        self.head = head
+        self.locker = locker
+        self.revisions = revisions
+        self.author = author
+        self.rcs_mtime = rcs_mtime
+        self.rcs_size = rcs_size
+
+    def __repr__(self):
+        return '<Revision_Info %r %s (%d revisions, %s)%s>' % (
+            self.path, self.head, self.revisions, self.author,
+            ' locked by ' + self.locker if self.locker else '')
+
+
+# reads the metadata of a ,v file
+# @param path the path relative to the data directory
+# @param namev the ,v file
+# @returns a Revision_Info
+# @throws IOError, OSError if the file cannot be read or is corrupt
+def read_info(path, namev):
+    stat = os.stat(namev)
+    rcs = native_rcs.read_metadata(namev)
+    author = locker = None
+    if rcs.head is not None:
+        author = rcs.delta(rcs.head).author
+        locker = rcs.locker(rcs.head)
+    return Revision_Info(path, rcs.head, locker, len(rcs.deltas), author,
+                         stat.st_mtime, stat.st_size)
+
+
+# reads the metadata of a ,v file in a process of the pool
+# @param args (path, namev)
+# @returns (path, Revision_Info or None, error message or None)
+def _read_in_pool(args):
+    path, namev = args
+    try:
+        return path, read_info(path, namev), None
+    except (IOError, OSError), err:
+        return path, None, str(err)
+
+
+class Revision_Index(object):
+
+    # Constructor
+    # @param db_path the sqlite database
+    # @param data_dir the data directory
+    def __init__(self, db_path, data_dir):
+        self.log = logging.getLogger("server")
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute(_SCHEMA)
+        # path -> Revision_Info
+        self._entries = {}
+        for row in self._db.execute('SELECT path, head, locker, revisions, author, rcs_mtime, rcs_size '
+                                    'FROM revisions'):
+            self._entries[row[0]] = Revision_Info(*row)
+
+    # returns the metadata of a file
+    # @param path the path relative to the data directory
+    # @returns a Revision_Info or None if the file is not tracked
+    def get(self, path):
+        return self._entries.get(os.path.normpath(path))
+
+    # returns the metadata of all files
+    # @returns a list of Revision_Infos, sorted by path
+    def items(self):
+        entries = self._entries.values()
+        entries.sort(key=lambda entry: entry.path)
+        return entries
+
+    # reads the metadata of a file after an RCS operation
+    # @param path the path relative to the data directory
+    # @param namev the ,v file
+    # @throws IOError, OSError if the ,v file cannot be read
+    def update(self, path, namev):
+        self._store([read_info(os.path.normpath(path), namev)], [])
+
+    # forgets a file or everything in a directory
+    # @param path the path relative to the data directory
+    def remove(self, path):
+        self._store([], self._under(os.path.normpath(path)))
+
+    # moves the entries of a file or of everything in a directory
+    # @param old_path old path relative to the data directory
+    # @param new_path new path relative to the data directory
+    def move(self, old_path, new_path):
+        old_path = os.path.normpath(old_path)
+        new_path = os.path.normpath(new_path)
+        moved = []
+        for path in self._under(old_path):
+            entry = self._entries[path]
+            moved.append(Revision_Info(
+                new_path + path[len(old_path):], entry.head, entry.locker, entry.revisions,
+                entry.author, entry.rcs_mtime, entry.rcs_size))
+        self._store(moved, self._under(old_path))
+
+    # brings the index up to date with the ,v files
+    # @param found path relative to the data directory -> ,v file of every
+    #        tracked file (None: the ,v files in the data directory)
+    # @param workers number of processes reading changed files (None: one per CPU)
+    def rebuild(self, found=None, workers=None):
+        started = time.time()
+        if found is None:
+            found = self._scan()
+
+        stale = []
+        for path, namev in found.iteritems():
+            entry = self._entries.get(path)
+            try:
+                stat = os.stat(namev)
+            except OSError:
+                continue
+            if entry is None or entry.rcs_mtime != stat.st_mtime or entry.rcs_size != stat.st_size:
+                stale.append((path, namev))
+        removed = [path for path in self._entries if path not in found]
+
+        if len(stale) >= PARALLEL_THRESHOLD:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(_read_in_pool, stale, chunksize=32)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_read_in_pool, stale)
+
+        entries = []
+        for path, entry, error in results:
+            if entry is None:
+                self.log.error('Could not read the RCS file of ' + path + ': ' + error)
+                removed.append(path)
+            else:
+                entries.append(entry)
+        self._store(entries, removed)
+        self.log.info('Revision index: %d files, %d read, %d removed in %.2fs' % (
+            len(self._entries), len(entries), len(removed), time.time() - started))
+
+    # finds the ,v files in the data directory
+    # @returns path relative to the data directory -> ,v file
+    def _scan(self):
+        found = {}
+        for root, dirs, files in os.walk(self.data_dir):
+            relroot = os.path.relpath(root, self.data_dir)
+            if os.path.basename(root) == 'RCS':
+                relroot = os.path.dirname(relroot)
+            for name in files:
+                if name.endswith(',v'):
+                    path = os.path.normpath(os.path.join(relroot, name[:-2]))
+                    found[path] = os.path.join(root, name)
+        return found
+
+    # closes the database
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # the paths of the entries of a file or of everything in a directory (a range query on the
+    # primary key, the paths in a directory follow each other)
+    def _under(self, path):
+        low, high = path_index.prefix_range(path)
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT path FROM revisions WHERE path = ? OR (path >= ? AND path < ?)',
+                (path, low, high))]
+
+    # writes entries and removes paths in one transaction
+    # @param entries the Revision_Infos to write
+    # @param removed the paths to remove
+    def _store(self, entries, removed):
+        if not entries and not removed:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM revisions WHERE path = ?',
+                                     [(path,) for path in removed])
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(entry.path, entry.head, entry.locker, entry.revisions, entry.author,
+                      entry.rcs_mtime, entry.rcs_size) for entry in entries])
+            for path in removed:
+                self._entries.pop(path, None)
+            for entry in entries:
+                self._entries[entry.path] = entry
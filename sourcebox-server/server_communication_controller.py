@@ -2,36 +2,61 @@
 # Communication_Controller
 # handles the communication with the clients
 #
+# Requests to the client (e.g. the changes of other clients) are put into
+# an outbound queue and sent by a writer thread of the connection, so the
+# thread broadcasting a change never waits for a slow client.
+#
 # @encode  UTF-8, tabwidth = , newline = LF
 # @author  Paul
 import thread
 import threading
 import socket
 import logging
-from urllib import pathname2url, url2pathname 
+import Queue
+import time
+import protocol
 
 
 class Server_Communication_Controller(object):
 
     # command constants
-    COMMAND_GETCREATEFILE = 'CREATE_FILE'
-    COMMAND_SENDLOCKFILE = 'LOCK'
-    COMMAND_SENDUNLOCKFILE = 'UNLOCK'
-    COMMAND_SENDMODIFYFILE = 'MODIFY'
-    COMMAND_SENDDELETEFILE = 'REMOVE'
-    COMMAND_MOVE = 'MOVE'
-    COMMAND_SENDCREATEDIR = 'CREATE_DIR'
-    COMMAND_DELETEDIR = 'DELETE_DIR'
-    COMMAND_CONNECTIONCLOSE = 'CLOSE'
-
-    COMMAND_OK = "OK\n"
-    VERSION = "1.0"
+    COMMAND_GETCREATEFILE = protocol.OP_CREATE_FILE
+    COMMAND_SENDLOCKFILE = protocol.OP_LOCK
+    COMMAND_SENDUNLOCKFILE = protocol.OP_UNLOCK
+    COMMAND_SENDMODIFYFILE = protocol.OP_MODIFY
+    COMMAND_SENDDELETEFILE = protocol.OP_REMOVE
+    COMMAND_MOVE = protocol.OP_MOVE
+    COMMAND_SENDCREATEDIR = protocol.OP_CREATE_DIR
+    COMMAND_DELETEDIR = protocol.OP_DELETE_DIR
+    COMMAND_CONNECTIONCLOSE = protocol.OP_CLOSE
+    COMMAND_BATCH = protocol.OP_BATCH
+
+    COMMAND_HAVE = protocol.OP_HAVE
+    COMMAND_MANIFEST = protocol.OP_MANIFEST
+    COMMAND_CHUNKS = protocol.OP_CHUNKS
+    COMMAND_CHUNK = protocol.OP_CHUNK
+
+    COMMAND_OK = protocol.OP_OK
+    COMMAND_ERROR = protocol.OP_ERROR
+    COMMAND_NEED = protocol.OP_NEED
+    VERSION = "2.0"
+
+    # maximum number of requests in flight to one client
+    WINDOW = 32
+    # seconds to wait for the answer of the client, after the request was sent
+    TIMEOUT = 8.0
+    # bytes per second the client writes a content at least before it answers
+    WRITE_RATE = 16 * 1024 * 1024
+    # a client with more queued requests than this is disconnected
+    OUTBOX_LIMIT = 10000
 
     # Constructor
     # @param parent the parent object. The sourceBox server object
     # @param connection the connection to the client
     # @param computer_name the computer_name of the client
-    def __init__(self, parent, connection, computer_name):
+    # @param decoder the Frame_Decoder of the connection (may already hold frames sent after INIT)
+    # @param compress if True, file contents are compressed (negotiated in the INIT handshake)
+    def __init__(self, parent, connection, computer_name, decoder=None, compress=False):
         # catch logging object
         self.log = logging.getLogger("server")
 
@@ -43,9 +68,21 @@ class Server_Communication_Controller(object):
         self.parent = parent
         self.connection = connection
         self.computer_name = computer_name
-
-        # Create OK Event (which is fired when a ok is recieved)
-        self.ok = threading.Event()
+        self.decoder = decoder or protocol.Frame_Decoder()
+        self.compress = compress
+
+        # requests sent to the client that are not answered yet
+        self.requests = protocol.Request_Tracker(self.WINDOW, self.TIMEOUT)
+        # serializes the frames written by different threads
+        self._send_lock = threading.Lock()
+        self._init_stats()
+
+        # requests waiting to be sent by the writer thread
+        self.outbox = Queue.Queue()
+        self.writer = threading.Thread(
+            target=self._write_loop, name='Writer ' + self.computer_name)
+        self.writer.daemon = True
+        self.writer.start()
 
         # Wait for incoming events
         thread.start_new_thread(self._command_loop, (
@@ -63,47 +100,206 @@ class Server_Communication_Controller(object):
                 '[' + thread_name + '] ' + 'Created thread: ' + thread_name)
 
             while True:
-                data = connection.recv(1024).split(' ')
-                cmd = data[0]
-                self._parse_command(cmd, data)
+                # handle all frames that are already buffered
+                for frame in self.decoder:
+                    self._parse_command(frame)
+
+                if not self.decoder.read_from(connection):
+                    raise socket.error(104, 'Connection closed')
+        except protocol.Protocol_Error, e:
+            self.log.error('Protocol error, closing connection: ' + str(e))
+            self.decoder.close()
+            self.outbox.put(None)
+            self.requests.close()
+            self.parent.remove_client(self.computer_name)
+            connection.close()
         except socket.error, e:
+            self.decoder.close()
+            self.outbox.put(None)
+            self.requests.close()
             if e.errno == 104:
                 self.log.warning('Client closed connection unexpectedly ')
-                self.parent.remove_client(self)
-                connection.close()
-                thread.exit()
             else:
-                self.log.error("_command_loop error: " + e.string)
+                self.log.error("_command_loop error: " + str(e))
+            # the loop is over in any case, the client is gone
+            self.parent.remove_client(self.computer_name)
+            connection.close()
+            thread.exit()
 
     # Parse the command
-    def _parse_command(self, cmd, data):
-        self.log.debug('Recieved Command from the client '  + self.computer_name + ': ' + data[0])
+    # @param frame the recieved frame
+    def _parse_command(self, frame):
+        cmd = frame.opcode
+        self.log.debug('Recieved Command from the client ' + self.computer_name + ': ' + frame.name())
         if cmd == self.COMMAND_GETCREATEFILE:
-            self._get_create_file(data)
+            self._get_create_file(frame)
         elif cmd == self.COMMAND_SENDLOCKFILE:
-            self._get_lock_file(data)
+            self._get_lock_file(frame)
         elif cmd == self.COMMAND_SENDUNLOCKFILE:
-            self._get_unlock_file(data)
+            self._get_unlock_file(frame)
         elif cmd == self.COMMAND_SENDDELETEFILE:
-            self._get_delete_file(data)
+            self._get_delete_file(frame)
         elif cmd == self.COMMAND_SENDMODIFYFILE:
-            self._get_modify_file(data)
+            self._get_modify_file(frame)
         elif cmd == self.COMMAND_MOVE:
-            self._get_move(data)
+            self._get_move(frame)
         elif cmd == self.COMMAND_SENDCREATEDIR:
-            self._get_create_dir(data)
+            self._get_create_dir(frame)
         elif cmd == self.COMMAND_DELETEDIR:
-            self._get_delete_dir(data)        
+            self._get_delete_dir(frame)
+        elif cmd == self.COMMAND_BATCH:
+            self._get_batch(frame)
+        elif cmd == self.COMMAND_HAVE:
+            self._get_have(frame)
+        elif cmd == self.COMMAND_MANIFEST:
+            self._get_manifest(frame)
+        elif cmd == self.COMMAND_CHUNKS:
+            self._get_chunks(frame)
+        elif cmd == self.COMMAND_CHUNK:
+            self._get_chunk(frame)
         elif cmd == self.COMMAND_CONNECTIONCLOSE:
-            self._close_connection()
-        elif cmd == 'OK\n':
-            self.ok.set()
+            self._close_connection(frame)
+        elif cmd in protocol.ANSWER_OPCODES:
+            if self.requests.complete(frame) is None:
+                self.log.warning('recieved answer to unknown request: ' + repr(frame))
         else:
-            self.log.warning('recieved unknown command: ' + cmd)
+            self.log.warning('recieved unexpected command: ' + frame.name())
+
+    # sends a frame to the client
+    # @param opcode the opcode
+    # @param path the path (relative to the source box)
+    # @param payload the payload
+    # @param seq the sequence number
+    # @param source a file whose content is streamed as payload (instead of payload)
+    # @param flags the flags
+    def _send(self, opcode, path='', payload='', seq=0, source=None, flags=0):
+        if source is None and self.compress:
+            payload, flags = protocol.compress_payload(opcode, payload, flags)
+        with self._send_lock:
+            if source is not None:
+                protocol.send_file_frame(
+                    self.connection, opcode, path, source, flags, seq, self.compress)
+            else:
+                protocol.send_frame(self.connection, opcode, path, payload, flags, seq)
+
+    # queues a request to the client and returns immediately
+    # The writer thread sends it, the answer is handled by the callback.
+    # @param opcode the opcode
+    # @param path the path (relative to the source box)
+    # @param payload the payload
+    # @param wait ignored (requests are never waited for)
+    # @param source a file whose content is streamed as payload (instead of payload)
+    # @param flags the flags
+    # @param callback called with the Pending_Request when it is done
+    # @param timeout seconds to wait for the answer (None: TIMEOUT)
+    def _send_request(self, opcode, path='', payload='', wait=True, source=None, flags=0, callback=None,
+                      timeout=None):
+        if self.queue_depth() >= self.OUTBOX_LIMIT:
+            self.log.error('Client ' + self.computer_name + ' does not keep up, disconnecting')
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            return
+        self.outbox.put((time.time(), opcode, path, payload, source, flags, callback, timeout))
+
+    # writer thread, sends the queued requests
+    # Blocks while WINDOW requests are in flight.
+    def _write_loop(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+            queued, opcode, path, payload, source, flags, callback, timeout = item
+            try:
+                request = self.requests.register(
+                    opcode, path, self._delivery_callback(queued, callback), timeout=timeout)
+            except IOError:
+                # the connection is closed
+                return
+            self._deliver(request, opcode, path, payload, source, flags)
+
+    # sends a registered request
+    # @param request the Pending_Request
+    def _deliver(self, request, opcode, path, payload, source, flags):
+        try:
+            self._send(opcode, path, payload, request.seq, source, flags)
+        except (socket.error, IOError), err:
+            self.requests.cancel(request, 'Could not send to ' + self.computer_name + ': ' + str(err))
+            return
+        self._sent(request)
+
+    # starts the timeout of a request once its last byte is sent (_send
+    # returns when it is sent)
+    # @param request the Pending_Request
+    def _sent(self, request):
+        request.sent()
+
+    # returns the timeout of a request with a content, the client writes the
+    # content before it answers
+    # @param size the size of the content
+    def _content_timeout(self, size):
+        return self.TIMEOUT + float(size) / self.WRITE_RATE
+
+    # returns the callback of a queued request, it records the delivery latency
+    # @param queued the time the request was queued
+    # @param callback the callback given by the sender (None: _request_done)
+    def _delivery_callback(self, queued, callback):
+        def delivered(request):
+            latency = time.time() - queued
+            with self._stats_lock:
+                if request.ok:
+                    self._delivered_count += 1
+                else:
+                    self._failed_count += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+            (callback or self._request_done)(request)
+        return delivered
+
+    # called when a request that nobody waits for is done
+    # @param request the Pending_Request
+    def _request_done(self, request):
+        if not request.ok:
+            self.log.error('Client ' + self.computer_name + ': ' + str(request.reason))
+
+    # resets the delivery statistics
+    def _init_stats(self):
+        self._stats_lock = threading.Lock()
+        self._delivered_count = 0
+        self._failed_count = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    # number of requests waiting to be sent
+    def queue_depth(self):
+        return self.outbox.qsize()
+
+    # returns the delivery statistics since the last call
+    # @returns a dictionary with the number of queued, in flight, delivered and
+    # failed requests and the average and maximum delivery latency (seconds)
+    def stats(self):
+        with self._stats_lock:
+            done = self._delivered_count + self._failed_count
+            stats = {
+                'queued': self.queue_depth(),
+                'in_flight': self.requests.in_flight(),
+                'delivered': self._delivered_count,
+                'failed': self._failed_count,
+                'latency_avg': self._latency_total / done if done else 0.0,
+                'latency_max': self._latency_max,
+            }
+            self._delivered_count = 0
+            self._failed_count = 0
+            self._latency_total = 0.0
+            self._latency_max = 0.0
+        return stats
 
     # closes the connection to the client
-    def _close_connection(self):
-        self.connection.send('OK\n')
+    def _close_connection(self, frame):
+        self._send(self.COMMAND_OK, seq=frame.seq)
+        self.outbox.put(None)
+        self.requests.close()
         self.connection.close()
         self.parent.remove_client(self.computer_name)
         thread.exit()
@@ -111,305 +307,317 @@ class Server_Communication_Controller(object):
     # server notifies the client about a new file (uploaded by another user)
     # @param size the size of the file
     # @param path the path to the file (relative to the source box)
-    def send_create_file(self, size, path, content):
+    # @param content the content of the file
+    # @param wait if False, return without waiting for the answer of the client
+    # @param source the file to stream the content from (instead of content)
+    # @param digest the digest of the content (announced first for large files, if given)
+    def send_create_file(self, size, path, content='', wait=True, source=None, digest=None):
+        if digest is not None and size >= protocol.HAVE_THRESHOLD:
+            self._send_have(protocol.OP_CREATE_FILE, path, digest, self.send_create_file,
+                            (size, path, content, False, source), size)
+            return
         try:
             self.log.debug('Sending CREATE to client ' + self.computer_name)
-            mess = "CREATE" + ' ' + str(size) + ' ' + pathname2url(path)
-
-            self.connection.send(mess)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client ' + self.computer_name)
-            if not size == 0:
-                self.connection.send(content)
-                self.log.debug("send content to client")
-                # Wait for the recieve thread to send us a ok Event
-                status = self.ok.wait(8.0)
-                self.ok.clear()
-                if not status:
-                    raise IOError(
-                        'Did not recieve a response from the client ' + self.computer_name)
-
-           # self.log.debug('Hello. Creation worked. The client said he is ok :)')
+            self._send_request(protocol.OP_CREATE_FILE, path, content, wait, source,
+                               timeout=self._content_timeout(size))
         except IOError, err:
             self.log.error(str(err))
-        # NOTE
-        # Any notification would be eaten by the server command loop at the moment.
-        # We need a event solution similar to the client if we are interested in the
-        # successful execution of the file. Like the code above.
 
-    #
+    # announces the digest of a content, the content is only sent if the
+    # client does not have it
+    # @param opcode protocol.OP_CREATE_FILE or protocol.OP_MODIFY
+    # @param path the path to the file (relative to the source box)
+    # @param digest the hex digest
+    # @param send the function sending the content
+    # @param args the arguments of send
+    # @param size the size of the content (the client copies it before it answers)
+    def _send_have(self, opcode, path, digest, send, args, size):
+        # only a NEED asks for the content: after a timeout or an error the
+        # client may still have it, sending it anyway would double the work
+        def have_done(request):
+            if request.ok:
+                self.log.debug('Client ' + self.computer_name + ' had the content of ' + path)
+            elif request.answer is not None and request.answer.opcode == protocol.OP_NEED:
+                send(*args)
+            else:
+                self._request_done(request)
+
+        self.log.debug('Sending HAVE to client ' + self.computer_name)
+        self._send_request(protocol.OP_HAVE, path, protocol.encode_have(opcode, digest),
+                           callback=have_done, timeout=self._content_timeout(size))
+
+    # sends CLOSE (after the queued requests) and closes the connection
     def send_close(self):
-        self.connection.send('CLOSE\n')
-        status = self.ok.wait(8.0)
-        self.ok.clear()
-        if not status:
-            raise IOError(
-                'Did not recieve a response from the the client ' + self.computer_name)
+        self._send_request(protocol.OP_CLOSE)
+        self.outbox.put(None)
+        self.writer.join(self.TIMEOUT)
         self.connection.close()
 
     # server notifies the client about delete file (initiated by another user)
     # @param path the path to the file (relative to the source box)
-    def send_delete_file(self, path):
+    def send_delete_file(self, path, wait=True):
         self.log.debug('Sending REMOVE to client ' + self.computer_name)
-        mess = "REMOVE" + ' ' + pathname2url(path)
-
-        self.connection.send(mess)
-
-        # Wait for the recieve thread to send us a ok Event
-        status = self.ok.wait(8.0)
-        self.ok.clear()
-        if not status:
-            raise IOError(
-                'Did not recieve a response from the the client ' + self.computer_name)
-
-       # self.log.debug('Hello. Delete worked. The client said he is ok :)')
+        self._send_request(protocol.OP_REMOVE, path, wait=wait)
 
     # server notifies the client about modify file (initiated by another user)
     # @param path the path to the file (relative to the source box)
-    def send_modify_file(self, size, path, content):
-        self.log.debug('Sending MODIFY to client ' + self.computer_name)
-        mess = "MODIFY" + ' ' + str(size) + ' ' + pathname2url(path)
-
-        self.connection.send(mess)
-
-        # Wait for the recieve thread to send us a ok Event
-        status = self.ok.wait(8.0)
-        self.ok.clear()
-        if not status:
-            raise IOError(
-                'Did not recieve a response from the client ' + self.computer_name)
-        if not size == 0:
-            self.connection.send(content)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client ' + self.computer_name)
-
-       # self.log.debug('Hello. Modifying worked. The client said he is ok :)')
+    # @param content the content of the file
+    # @param source the file to stream the content from (instead of content)
+    # @param patch a delta against the previous version (sent first, if given)
+    # @param digest the digest of the content (announced first for large files, if given and there is no patch)
+    def send_modify_file(self, size, path, content='', wait=True, source=None, patch=None, digest=None):
+        if patch is None and digest is not None and size >= protocol.HAVE_THRESHOLD:
+            self._send_have(protocol.OP_MODIFY, path, digest, self.send_modify_file,
+                            (size, path, content, False, source), size)
+            return
+        if patch is None:
+            self.log.debug('Sending MODIFY to client ' + self.computer_name)
+            self._send_request(protocol.OP_MODIFY, path, content, wait, source,
+                               timeout=self._content_timeout(size))
+            return
+
+        # the whole file is sent only if the client rejects the delta
+        def delta_done(request):
+            if request.answer is None:
+                self._request_done(request)
+            elif not request.ok:
+                self.log.debug('Client ' + self.computer_name + ' rejected the delta, sending the whole file')
+                self.send_modify_file(size, path, content, False, source)
+
+        self.log.debug('Sending MODIFY (delta) to client ' + self.computer_name)
+        self._send_request(protocol.OP_MODIFY, path, patch,
+                           flags=protocol.FLAG_DELTA, callback=delta_done)
 
     # server notifies the client about lock file (initiated by another user)
     # @param path the path to the file (relative to the source box)
-    def send_lock_file(self, path):
+    def send_lock_file(self, path, wait=True):
         try:
             self.log.debug('Sending LOCK to client' + self.computer_name)
-            mess = "LOCK" + ' ' + pathname2url(path)
-
-            self.connection.send(mess)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client.' + self.computer_name)
-
-           # self.log.debug('Hello. Locking worked. The client said he is ok :)')
+            self._send_request(protocol.OP_LOCK, path, wait=wait)
         except IOError, err:
             self.log.error(str(err))
 
     # server notifies the client about unlock file (initiated by another user)
     # @param path the path to the file (relative to the source box)
-    def send_unlock_file(self, path):
+    def send_unlock_file(self, path, wait=True):
         self.log.debug('Sending UNLOCK to client' + self.computer_name)
-        mess = "UNLOCK" + ' ' + pathname2url(path)
         try:
-            self.connection.send(mess)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client ' + self.computer_name)
-
-           ## self.log.debug(
-            #    'Hello. Unlocking worked. The client said he is ok :)')
+            self._send_request(protocol.OP_UNLOCK, path, wait=wait)
         except IOError, err:
             self.log.error(str(err))
 
     # server notifies the client about a new Dir (initiated by another user)
     # @param path the path to the file (relative to the source box)
-    def send_create_dir(self, path):
+    def send_create_dir(self, path, wait=True):
         try:
             self.log.debug('Sending CREATE_DIR to client' + self.computer_name)
-            mess = "CREATE_DIR" + ' ' + pathname2url(path)
-
-            self.connection.send(mess)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client.' + self.computer_name)
+            self._send_request(protocol.OP_CREATE_DIR, path, wait=wait)
         except IOError, err:
             self.log.error(str(err))
 
-
     # server notifies the client about a deleted Dir (initiated by another user)
     # @param path the path to the file (relative to the source box)
-    def send_delete_dir(self, path):
+    def send_delete_dir(self, path, wait=True):
         try:
             self.log.debug('Sending DELETE_DIR to client' + self.computer_name)
-            mess = "DELETE_DIR" + ' ' + pathname2url(path)
-
-            self.connection.send(mess)
-
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client.' + self.computer_name)
+            self._send_request(protocol.OP_DELETE_DIR, path, wait=wait)
         except IOError, err:
             self.log.error(str(err))
 
     # server notifies the client about a moved Dir (initiated by another user)
-    def send_move(self, old_file_path, new_file_path):
+    def send_move(self, old_file_path, new_file_path, wait=True):
         try:
             self.log.debug('Sending MOVE to client' + self.computer_name)
-            mess = "MOVE" + ' ' + pathname2url(old_file_path) + ' ' + pathname2url(new_file_path)
-
-            self.connection.send(mess)
+            self._send_request(protocol.OP_MOVE, old_file_path,
+                               protocol.encode_path(new_file_path), wait)
+        except IOError, err:
+            self.log.error(str(err))
 
-            # Wait for the recieve thread to send us a ok Event
-            status = self.ok.wait(8.0)
-            self.ok.clear()
-            if not status:
-                raise IOError(
-                    'Did not recieve a response from the client.' + self.computer_name)
+    # server forwards a batch of operations (initiated by another user)
+    # @param entries the operations (Frames)
+    def send_batch(self, entries, wait=True):
+        try:
+            self.log.debug('Sending BATCH of ' + str(len(entries)) + ' operations to client ' + self.computer_name)
+            self._send_request(protocol.OP_BATCH, '', protocol.encode_batch(entries), wait)
         except IOError, err:
             self.log.error(str(err))
 
     # client sends a CREATE_FILE command to the server
-    # @param data a data array
+    # @param frame the recieved frame
 
-    def _get_create_file(self, data):
-        communication_data = self._recieve_command_with_content(data)
+    def _get_create_file(self, frame):
+        communication_data = self._recieve_command_with_content(frame)
+        if communication_data is None:
+            return
 
         # send create_file function to the server
-        answer = self.parent.create_file(communication_data['file_path'], communication_data['file_size'], self.computer_name, communication_data['content'])
-        if answer:
-            self.connection.send('OK\n')
+        answer = self.parent.create_file(communication_data['file_path'], communication_data['file_size'], self.computer_name, communication_data['content'], communication_data['content_file'])
+        self._answer(answer, frame)
 
     # client sends a LOCK command to the server
-    # @param data a data array
-    def _get_lock_file(self, data):
-        communication_data = self._recieve_command(data)
+    # @param frame the recieved frame
+    def _get_lock_file(self, frame):
+        communication_data = self._recieve_command(frame)
+        if communication_data is None:
+            return
 
         answer = self.parent.lock_file(communication_data['file_path'], self.computer_name)
-        if answer:
-            self.connection.send('OK\n')
+        self._answer(answer, frame)
 
     # client sends a UNLOCK command to the server
-    # @param data a data array
-    def _get_unlock_file(self, data):
-        communication_data = self._recieve_command(data)
+    # @param frame the recieved frame
+    def _get_unlock_file(self, frame):
+        communication_data = self._recieve_command(frame)
+        if communication_data is None:
+            return
         answer = self.parent.unlock_file(communication_data['file_path'], self.computer_name)
-        if answer == True:
-            self.connection.send('OK\n')
-        else:
-            self.connection.send('ERROR\n')
-    # client sends a REMOVE command to the server
-    # @param data a data array
+        self._answer(answer, frame)
 
-    def _get_delete_file(self, data):
-        communication_data = self._recieve_command(data)
+    # client sends a REMOVE command to the server
+    # @param frame the recieved frame
+    def _get_delete_file(self, frame):
+        communication_data = self._recieve_command(frame)
+        if communication_data is None:
+            return
         answer = self.parent.delete_file(communication_data['file_path'], self.computer_name)
-        if answer:
-            self.connection.send('OK\n')
-        else:
-            self.connection.send('ERROR\n')
+        self._answer(answer, frame)
 
     # the client sends a MODIFY command
-    # @param data a data array
-    def _get_modify_file(self, data):
-        communication_data = self._recieve_command_with_content(data)
+    # @param frame the recieved frame
+    def _get_modify_file(self, frame):
+        communication_data = self._recieve_command_with_content(frame)
+        if communication_data is None:
+            return
 
-        answer = self.parent.modify_file(communication_data['file_path'], communication_data['content'], self.computer_name)
-        if answer:
-            self.connection.send('OK\n')
+        # the payload may be a delta against the current version
+        patch = None
+        if frame.flags & protocol.FLAG_DELTA:
+            patch = communication_data['content']
+            communication_data['content'] = ''
+
+        answer = self.parent.modify_file(communication_data['file_path'], communication_data['content'], self.computer_name, communication_data['content_file'], patch)
+        self._answer(answer, frame)
 
     # the client sends a MOVE command
-    # @param data a data array
-    def _get_move(self, data):
-        old_file_path = url2pathname(data[1])
-        new_file_path = url2pathname(data[2])
+    # @param frame the recieved frame
+    def _get_move(self, frame):
+        old_file_path = frame.path
+        new_file_path = protocol.decode_path(frame.payload)
 
         # check if the data string is correct
         if len(old_file_path) == 0 or len(new_file_path) == 0:
-            self.connection.send('ERROR\n')
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
         else:
             answer = self.parent.move(old_file_path, new_file_path, self.computer_name)
-            if answer:
-                self.connection.send('OK\n')
+            self._answer(answer, frame)
 
     # the client sends a CREATE_DIR command
-    # @param data a data array
-    def _get_create_dir(self, data):
-        communication_data = self._recieve_command(data)
+    # @param frame the recieved frame
+    def _get_create_dir(self, frame):
+        communication_data = self._recieve_command(frame)
+        if communication_data is None:
+            return
         answer = self.parent.create_dir(communication_data['file_path'], self.computer_name)
-        if answer:
-            self.connection.send('OK\n')
-        else:
-            self.connection.send('ERROR\n')
+        self._answer(answer, frame)
 
     # the client sends a DELETE_DIR command
-    # @param data a data array
-    def _get_delete_dir(self, data):
-        communication_data = self._recieve_command(data)
+    # @param frame the recieved frame
+    def _get_delete_dir(self, frame):
+        communication_data = self._recieve_command(frame)
+        if communication_data is None:
+            return
         answer = self.parent.delete_dir(communication_data['file_path'], self.computer_name)
+        self._answer(answer, frame)
+
+    # the client announces the digest of a file it wants to send
+    # @param frame the recieved frame
+    def _get_have(self, frame):
+        try:
+            opcode, digest = protocol.decode_have(frame.payload)
+        except protocol.Protocol_Error, err:
+            self.log.error('Invalid HAVE from ' + self.computer_name + ': ' + str(err))
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
+            return
+        answer = self.parent.have_file(frame.path, opcode, digest, self.computer_name)
+        if answer is None:
+            self._send(self.COMMAND_NEED, seq=frame.seq)
+        else:
+            self._answer(answer, frame)
+
+    # the client sends the chunk list of a large file
+    # @param frame the recieved frame
+    def _get_chunks(self, frame):
+        try:
+            opcode, size, digests = protocol.decode_chunks(frame.payload)
+        except protocol.Protocol_Error, err:
+            self.log.error('Invalid CHUNKS from ' + self.computer_name + ': ' + str(err))
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
+            return
+        answer = self.parent.chunked_file(frame.path, opcode, size, digests, self.computer_name)
+        if isinstance(answer, list):
+            self._send(self.COMMAND_NEED, payload=protocol.encode_missing(answer), seq=frame.seq)
+        else:
+            self._answer(answer, frame)
+
+    # the client sends a chunk of a large file
+    # @param frame the recieved frame
+    def _get_chunk(self, frame):
+        self._answer(self.parent.add_chunk(frame.payload, self.computer_name), frame)
+
+    # the client lists its box after the handshake
+    # @param frame the recieved frame
+    def _get_manifest(self, frame):
+        try:
+            manifest = protocol.decode_manifest(frame.payload)
+        except protocol.Protocol_Error, err:
+            self.log.error('Invalid MANIFEST from ' + self.computer_name + ': ' + str(err))
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
+            return
+        self._answer(self.parent.sync_client(self, manifest), frame)
+
+    # the client sends a BATCH command
+    # @param frame the recieved frame
+    def _get_batch(self, frame):
+        try:
+            entries = protocol.decode_batch(frame.payload)
+        except protocol.Protocol_Error, err:
+            self.log.error('Invalid batch from ' + self.computer_name + ': ' + str(err))
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
+            return
+        answer = self.parent.apply_batch(entries, self.computer_name)
+        self._answer(answer, frame)
+
+    # sends OK or ERROR depending on the answer of the server
+    # @param answer the return value of the server method
+    # @param frame the frame that is answered
+    def _answer(self, answer, frame):
         if answer:
-            self.connection.send('OK\n')
+            self._send(self.COMMAND_OK, seq=frame.seq)
         else:
-            self.connection.send('ERROR\n')
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
 
     # helper function
-    # @param data a data array
+    # @param frame the recieved frame
     # @returns a dictionary like { 'command' : command, 'file_path' :  file_path} or None (if error)
-    def _recieve_command(self, data):
-        command = data[0]
-        self.log.debug('Recieved ' + str(data))
-        file_path = url2pathname(data[1])
-        self.log.debug('Recieve command ' + str(file_path))
-
-        if len(file_path) == 0:
-            self.connection.send('ERROR\n')
+    def _recieve_command(self, frame):
+        self.log.debug('Recieved ' + repr(frame))
+
+        if len(frame.path) == 0:
+            self._send(self.COMMAND_ERROR, seq=frame.seq)
             return None
         else:
-            return {'command': command, 'file_path':  file_path}
+            return {'command': frame.opcode, 'file_path': frame.path}
 
     # helper function
-    # @param data a data array
-    # @returns a dictionary like { 'command' : command, 'file_size' : file_size, 'file_path' :  file_path, 'content' : content}
-    def _recieve_command_with_content(self, data):
-        self.log.debug('Recieved ' + str(data))
-        command = data[0]
-        file_size = int(data[1])
-        file_path = url2pathname(data[2])
-
-        # check if the data string is correct
-        if len(file_path) == 0 or file_size < 0:
-            self.connection.send('ERROR\n')
-            return
+    # @param frame the recieved frame
+    # @returns a dictionary like { 'command' : command, 'file_size' : file_size, 'file_path' :  file_path, 'content' : content, 'content_file' : content_file} or None (if error)
+    # Large contents are not in 'content' but in the spool file 'content_file'.
+    def _recieve_command_with_content(self, frame):
+        communication_data = self._recieve_command(frame)
+        if communication_data is None:
+            frame.discard()
         else:
-            # return OK to the client. Client can initiate data transfer now.
-            self.connection.send('OK\n')
-
-            # read data from the socket
-            content = ''
-            while file_size > len(content):
-                data = self.connection.recv(1024)
-                if not data:
-                    break
-                content += data
-
-        return {'command': command, 'file_size': file_size, 'file_path':  file_path, 'content': content}
+            communication_data['file_size'] = frame.size
+            communication_data['content'] = frame.payload
+            communication_data['content_file'] = frame.payload_file
+        return communication_data
@@ -1,6 +1,13 @@
 import server_communication_controller
 import data_controller
+import protocol
+import config_parser
+import ignore_rules
+import async_server
+import lock_manager
+import retention
 import threading
+import time
 import os
 import socket
 import logging
@@ -14,9 +21,6 @@ import logging
 
 class SourceBoxServer(object):
 
-    # constants
-    LOCK_TIME = 30
-
     # Creates a new instance of the SourceBoxServer
     def __init__(self):
         try:
@@ -24,38 +28,84 @@ class SourceBoxServer(object):
             if os.path.exists("client.log"):
                 os.remove("client.log")
 
+            # Read the config file
+            config = config_parser.Config_Parser('./sb_server.conf')
+
             # Create the Data Controller
-            self.data = data_controller.Data_Controller('./data/')
+            self.data = data_controller.Data_Controller(
+                './data/', config.rcs, config.cache_size * 1024 * 1024,
+                config.commit_window, config.commit_depth,
+                config.durability, config.group_commit_ms / 1000.0,
+                config.storage_roots, config.migrate_rate,
+                retention.Retention_Rules(config.retention), config.retention_interval,
+                config.retention_rate * 1024, config.sweep_interval)
+
+            # The locks of the clients; the RCS locks only keep them across restarts
+            self.locks = lock_manager.Lock_Manager(config.lock_time, self._lock_expired)
+            for info in self.data.index.items():
+                if info.locker is not None:
+                    self.locks.acquire(info.path, info.locker)
+
+            # the paths that are neither stored nor forwarded (see ignore_rules.py)
+            self.rules = ignore_rules.Ignore_Rules(config.ignore)
 
             # Contains all active Communication Controllers
             self.active_clients = dict()
 
+            # compress file contents for clients that support it
+            self.compression = config.compression
+
+            # The event loop (only in async mode)
+            self.server = None
+
             # Create socket
-            self._create_socket()
+            if config.mode == 'async':
+                self.server = async_server.Async_Server(
+                    self, config.port, config.workers, config.backlog)
+            else:
+                self._create_socket(config.port)
 
             # create logger
             self.setupLogging(
                 "server", logging.DEBUG)  # replace DEBUG by INFO for less output
 
-            self.log.info('sourceBox server is running')
+            self.log.info('sourceBox server is running (' + config.mode + ' mode)')
+
+            # report the delivery statistics of the clients
+            if config.report_interval > 0:
+                reporter = threading.Thread(
+                    target=self._report_loop, args=(config.report_interval,), name='Reporter')
+                reporter.daemon = True
+                reporter.start()
 
-            self._command_loop(self.sock)
+            if self.server is not None:
+                self.server.serve_forever()
+            else:
+                self._command_loop(self.sock)
 
         # unexpected exit
         except KeyboardInterrupt:
-            self.sock.close()
+            if self.server is not None:
+                self.server.close()
+            else:
+                self.sock.close()
+            self.locks.close()
+            self.data.close()
             del self.data
             for comm in self.active_clients.keys():
                 self.active_clients[comm].send_close()
                 self.log.debug('Remove ' + comm)
                 self.remove_client(comm)
+            if self.server is not None:
+                self.server.shutdown()
             self.log.info('Terminating SourceBoxServer')
 
     # Creates a socket
+    # @param port the port to listen on
     # @author Martin Zellner
-    def _create_socket(self):
+    def _create_socket(self, port):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind(('', 50000))
+        self.sock.bind(('', port))
         self.sock.listen(5)  # Max 5 Clients
 
 
@@ -65,40 +115,173 @@ class SourceBoxServer(object):
     # @returns a communication controller
     def new_client(self, connection):
         # recieve init message from the client
-        init_message = connection.recv(20).split(' ')
+        decoder = protocol.Frame_Decoder(spool_dir=self.data.spool_dir)
+        try:
+            init_message = protocol.read_frame(connection, decoder)
+        except (protocol.Protocol_Error, socket.error), err:
+            self.log.warning('Init failed: ' + str(err))
+            connection.close()
+            return
 
-        if not init_message[0] == 'INIT':
+        if init_message is None or not init_message.opcode == protocol.OP_INIT:
             self.log.warning('Init failed')
+            connection.close()
         else:
-            computer_name = init_message[1]
+            computer_name = init_message.payload
             self.log.info('A new client (' + computer_name +
                           ')logged in. Creating a Communication Controller')
 
+            flags = self.negotiate(init_message)
+            try:
+                protocol.send_frame(connection, protocol.OP_OK, flags=flags, seq=init_message.seq)
+            except socket.error, err:
+                self.log.warning('Init failed: ' + str(err))
+                connection.close()
+                return
+
             # Create a new communication_controller
             comm = server_communication_controller.Server_Communication_Controller(
-                self, connection, computer_name)
-
-            # add the communication controller to the active_clients list (to
-            # keep track of all clients logged in)
-            self.active_clients[computer_name] = comm
-
-            # send all files to the client
-            for current_file in self.data.list_dir():
-                if not os.path.isdir(os.path.join(self.data.data_dir, current_file)) and ',v' not in current_file:
-                    file_size = self.get_file_size(os.path.join(self.data.data_dir, current_file))
-                    content = self.data.read_file(current_file)
-                    comm.send_create_file(file_size, current_file, content)
-
-            # log active clients
-            self.log.info('Active Clients are:')
-            self.log.info('\n'.join(self.active_clients.keys()))
+                self, connection, computer_name, decoder,
+                bool(flags & protocol.FLAG_COMPRESSED))
+
+            self.login_client(comm, bool(flags & protocol.FLAG_MANIFEST))
+
+    # Chooses the options of a connection from the INIT of the client
+    # @param init_message the INIT frame
+    # @returns the flags of the answer to the INIT
+    def negotiate(self, init_message):
+        flags = 0
+        if self.compression and init_message.flags & protocol.FLAG_COMPRESSED:
+            flags |= protocol.FLAG_COMPRESSED
+        if init_message.flags & protocol.FLAG_MANIFEST:
+            flags |= protocol.FLAG_MANIFEST
+        return flags
+
+    # Registers a client that passed the INIT handshake and sends it all files
+    # @param comm the communication controller of the client
+    # @param manifest if True, the client sends a MANIFEST and gets only what it misses
+    def login_client(self, comm, manifest=False):
+        computer_name = comm.computer_name
+
+        # add the communication controller to the active_clients list (to
+        # keep track of all clients logged in)
+        self.active_clients[computer_name] = comm
+
+        if not manifest:
+            self.sync_client(comm, [])
+
+        # log active clients
+        self.log.info('Active Clients are:')
+        self.log.info('\n'.join(self.active_clients.keys()))
+
+    # Sends a client everything that is missing or different in its box
+    # (without waiting for each answer)
+    # @param comm the communication controller of the client
+    # @param manifest the Manifest_Entries of the box of the client
+    # @returns True
+    def sync_client(self, comm, manifest):
+        known = dict((entry.path, entry) for entry in manifest)
+        sent = kept = 0
+        for current_path, is_dir in self.data.walk():
+            if self.rules.ignored(current_path, is_dir):
+                # stored before the rules said otherwise
+                continue
+            entry = known.get(current_path)
+            if is_dir:
+                if entry is None:
+                    comm.send_create_dir(current_path, wait=False)
+                    sent += 1
+                continue
+            if entry is not None and entry.is_dir:
+                self.log.warning(comm.computer_name + ' has a directory at ' + current_path)
+                continue
+            if entry is not None and entry.deleted:
+                if entry.rev is not None and entry.rev == self.data.get_digest(current_path):
+                    # deleted by the client since it synced it, the client deletes it here
+                    kept += 1
+                    continue
+                # changed here since, the client gets it again
+                entry = None
+
+            file_size = self.data.get_file_size(current_path)
+            digest = None
+            if entry is not None or file_size >= protocol.HAVE_THRESHOLD:
+                digest = self.data.get_digest(current_path)
+            if entry is not None:
+                if entry.size == file_size and entry.digest is not None and entry.digest == digest:
+                    continue
+                if entry.rev is not None and entry.rev == digest:
+                    # unchanged here since the client synced it, the client changed it
+                    kept += 1
+                    continue
+
+            # the client may have large files already (see HAVE), small ones
+            # come from the cache (many clients log in after a restart)
+            content = ''
+            source = self.data.get_path(current_path)
+            if digest is not None:
+                source = self.data.blobs.path(digest)
+            if file_size < protocol.HAVE_THRESHOLD:
+                try:
+                    content = self.data.read_file(current_path)
+                    source = None
+                except IOError, err:
+                    self.log.error('Could not read ' + current_path + ': ' + str(err))
+                    continue
+            if entry is None:
+                comm.send_create_file(
+                    file_size, current_path, content, wait=False, source=source, digest=digest)
+            else:
+                comm.send_modify_file(
+                    file_size, current_path, content, wait=False, source=source, digest=digest)
+            sent += 1
+
+        self.log.info('Initial sync of %s: %d entries in its manifest, %d sent, %d changed by the client'
+                      % (comm.computer_name, len(manifest), sent, kept))
+        return True
 
     # removes a client
     # @author Martin Zellner
     # @param client the communication controller of the client
     def remove_client(self, computer_name):
-        self.log.info('Remove client ' + computer_name)
-        del self.active_clients[computer_name]
+        if computer_name in self.active_clients:
+            self.log.info('Remove client ' + computer_name)
+            del self.active_clients[computer_name]
+
+    # logs the delivery statistics of all clients periodically
+    # @param interval seconds between two reports
+    def _report_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            self.report()
+
+    # logs the queue depth and the delivery latency of every client
+    def report(self):
+        for computer_name, comm in self.active_clients.items():
+            stats = comm.stats()
+            message = ('Client %s: %d queued, %d in flight, %d delivered, %d failed, '
+                       'latency avg %.3fs max %.3fs' % (
+                           computer_name, stats['queued'], stats['in_flight'],
+                           stats['delivered'], stats['failed'],
+                           stats['latency_avg'], stats['latency_max']))
+            if 'queued_bytes' in stats:
+                message += ', ' + str(stats['queued_bytes']) + ' bytes to send'
+            self.log.info(message)
+        stats = self.data.commits.stats()
+        self.log.info('Commit queue: %d files pending, %d modifications, %d revisions, %d failed, '
+                      '%d forced by a full queue, delay avg %.1fs max %.1fs' % (
+                          stats['pending'], stats['modifications'], stats['commits'],
+                          stats['failures'], stats['overflows'], stats['delay_avg'],
+                          stats['delay_max']))
+        stats = self.data.cache.stats()
+        self.log.info('Content cache: %d files, %d bytes, %d hits, %d misses, %d evicted' % (
+            stats['entries'], stats['size'], stats['hits'], stats['misses'], stats['evictions']))
+        if self.data.retention is not None:
+            stats = self.data.retention.stats()
+            self.log.info('Retention: %d passes, %d files compacted, %d revisions removed, '
+                          '%d bytes reclaimed, %d failed' % (
+                              stats['passes'], stats['compacted'], stats['removed'],
+                              stats['reclaimed'], stats['failures']))
 
     # The server command loop
     # @param sock the socket to listen on
@@ -112,6 +295,8 @@ class SourceBoxServer(object):
     # @param path the path relative to the source box root
     # @param computer_name the name of the computer creating the file
     def create_dir(self, path, computer_name):
+        if self._ignored(path, computer_name, True):
+            return True
 
         self.log.debug(computer_name + ' created the dir ' + path)
         # create file in backend
@@ -133,9 +318,12 @@ class SourceBoxServer(object):
     # @param computer_name the name of the computer creating the file
 
     def delete_dir(self, path, computer_name):
+        if self._ignored(path, computer_name, True):
+            return True
 
         self.log.debug(computer_name + ' deleted the dir ' + path)
         # create file in backend
+        self.locks.forget(path)
         self.data.delete_dir(path)
 
         # push changes to all other clients
@@ -154,18 +342,32 @@ class SourceBoxServer(object):
     # @param file_name the file name
     # @param content the content of the file
     # @param computer_name the name of the computer creating the file
-    def create_file(self, file_path, file_size, computer_name, content=''):
+    # @param content_file a spool file holding the content (instead of content)
+    # @param digest the hex digest of the content of content_file if it is known
+    def create_file(self, file_path, file_size, computer_name, content='', content_file=None,
+                    digest=None):
+        if self._ignored(file_path, computer_name):
+            self._discard(content_file)
+            return True
 
         self.log.debug('Creating the file ' + file_path)
         # create file in backend
-        self.data.create_file(file_path, computer_name, content)
+        self.data.create_file(file_path, computer_name, content, content_file, digest)
+
+        # large contents are streamed from the blob store (or the backend)
+        source = None
+        digest = self.data.digests.get(file_path)
+        if digest is not None and content_file is not None:
+            source = self.data.blobs.path(digest)
+        elif content_file is not None:
+            source = self.data.get_path(file_path)
 
         # push changes to all other clients
         for comm in self.active_clients.keys():
             if not comm == computer_name:
                 try:
                     self.active_clients[comm].send_create_file(
-                        file_size, file_path, content)
+                        file_size, file_path, content, source=source, digest=digest)
                 except IOError, err:
                     self.log.error('Error:' + str(err))
         # return true if successfully created
@@ -176,6 +378,16 @@ class SourceBoxServer(object):
     # @param path the path relative to the source box root
     # @param file_name the file name
     def lock_file(self,file_path, computer_name):
+        if self._ignored(file_path, computer_name):
+            return True
+        lease = self.locks.acquire(file_path, computer_name)
+        if lease is None:
+            self.log.info(computer_name + ' cannot lock ' + file_path + ', it is locked by '
+                          + str(self.locks.holder(file_path)))
+            return False
+        if lease.renewals > 0:
+            # the other clients know the lock already
+            return True
         self.data.lock_file(file_path, computer_name)
 
         # push changes to all other clients
@@ -183,10 +395,6 @@ class SourceBoxServer(object):
             if not comm == computer_name:
                 self.active_clients[comm].send_lock_file(file_path)
 
-                # set Timer to LOCK_TIME in sec for auto unlock
-                threading.Timer(self.LOCK_TIME, self.active_clients[
-                                comm].send_unlock_file, (file_path,)).start()
-
         # return true if successfully locked
         return True
 
@@ -195,6 +403,11 @@ class SourceBoxServer(object):
     # @param path the path relative to the source box root
     # @param file_name the file name
     def unlock_file(self, file_path, computer_name):
+        if self._ignored(file_path, computer_name):
+            return True
+        if self.locks.release(file_path, computer_name) is None:
+            # locked by another client, or the lease expired and the file is unlocked already
+            return self.locks.holder(file_path) is None
         self.data.unlock_file(file_path, computer_name)
 
         # push changes to all other clients
@@ -207,31 +420,130 @@ class SourceBoxServer(object):
         # return true if successfully unlocked
         return True
 
+    # Is called by the lock scheduler when a lock was not renewed in time.
+    # Unlocks the file in the backend and on the other clients
+    # @param lease the expired lock_manager.Lease
+    def _lock_expired(self, lease):
+        self.data.unlock_file(lease.path, lease.owner)
+        for comm in self.active_clients.keys():
+            if not comm == lease.owner:
+                self.active_clients[comm].send_unlock_file(lease.path, wait=False)
+
     # Is called when a client changes a file.
     # Updates the file on all clients and in the data backend
     # @param path the path relative to the source box root
     # @param file_name the file name
-    def modify_file(self, file_path, content, computer_name):
-        self.data.modify_file(file_path, content, computer_name)
+    # @param content_file a spool file holding the content (instead of content)
+    # @param patch a delta against the current version (instead of content)
+    # @param digest the hex digest of the content of content_file if it is known
+    def modify_file(self, file_path, content, computer_name, content_file=None, patch=None,
+                    digest=None):
+        if self._ignored(file_path, computer_name):
+            self._discard(content_file)
+            return True
+        if not self.data.modify_file(file_path, content, computer_name, content_file, patch, digest):
+            return False
+        self.locks.renew(file_path, computer_name)
+
+        # large contents (and the result of a delta) are streamed from the
+        # blob store (or the backend)
+        source = None
+        digest = self.data.digests.get(file_path)
+        if digest is not None and (content_file is not None or patch is not None):
+            source = self.data.blobs.path(digest)
+        elif content_file is not None or patch is not None:
+            source = self.data.get_path(file_path)
 
         # push changes to all other clients
+        file_size = self.data.get_file_size(file_path)
         for comm in self.active_clients.keys():
             if not comm == computer_name:
-                file_size = self.data.get_file_size(file_path)
                 try:
                     self.active_clients[comm].send_modify_file(
-                        file_size, file_path, content)
+                        file_size, file_path, content, source=source, patch=patch, digest=digest)
                 except IOError, err:
                     self.log.error('Error:' + str(err))
         # return true if successfully modified
         return True
 
+    # Is called when a client announces the digest of a file it wants to send.
+    # If the content is stored already, the file is created or modified with it.
+    # @param file_path the path relative to the source box root
+    # @param opcode protocol.OP_CREATE_FILE or protocol.OP_MODIFY
+    # @param digest the hex digest of the content
+    # @param computer_name the name of the computer sending the file
+    # @returns None if the content is not stored (the client has to send it)
+    def have_file(self, file_path, opcode, digest, computer_name):
+        if self._ignored(file_path, computer_name):
+            # nothing to send
+            return True
+        content_file = self.data.checkout_blob(digest)
+        if content_file is None:
+            return None
+        self.log.debug(computer_name + ' did not need to send ' + file_path)
+        if opcode == protocol.OP_CREATE_FILE:
+            return self.create_file(file_path, os.path.getsize(content_file), computer_name,
+                                    content_file=content_file, digest=digest)
+        return self.modify_file(file_path, '', computer_name, content_file, digest=digest)
+
+    # Is called when a client sends the chunk list of a large file.
+    # If all chunks are stored, the file is created or modified with them.
+    # @param file_path the path relative to the source box root
+    # @param opcode protocol.OP_CREATE_FILE or protocol.OP_MODIFY
+    # @param size the size of the file
+    # @param digests the hex digests of the chunks
+    # @param computer_name the name of the computer sending the file
+    # @returns the indexes of the chunks the client has to send, or whether
+    #          the file was created or modified
+    def chunked_file(self, file_path, opcode, size, digests, computer_name):
+        if self._ignored(file_path, computer_name):
+            # no chunks to send
+            return True
+        missing = self.data.chunks.missing(digests)
+        if missing:
+            self.log.debug('%s has to send %d of %d chunks of %s'
+                           % (computer_name, len(missing), len(digests), file_path))
+            return missing
+        try:
+            content_file, sizes, digest = self.data.chunks.assemble(digests, self.data.spool_dir)
+        except (IOError, OSError), err:
+            self.log.error('Could not assemble ' + file_path + ': ' + str(err))
+            return False
+        if os.path.getsize(content_file) != size:
+            self.log.error('The chunks of ' + file_path + ' do not add up to its size')
+            os.remove(content_file)
+            return False
+        if opcode == protocol.OP_CREATE_FILE:
+            done = self.create_file(file_path, size, computer_name, content_file=content_file,
+                                    digest=digest)
+        else:
+            done = self.modify_file(file_path, '', computer_name, content_file, digest=digest)
+        if done:
+            # the next version only needs the chunks that changed, they
+            # are read from the blob of this one
+            self.data.chunks.set_list(file_path, digests, self.data.get_digest(file_path), sizes)
+        return done
+
+    # Is called when a client sends a chunk of a large file
+    # @param content the content of the chunk
+    # @param computer_name the name of the computer sending the chunk
+    def add_chunk(self, content, computer_name):
+        try:
+            self.data.chunks.add(content)
+            return True
+        except (IOError, OSError), err:
+            self.log.error('Could not store a chunk of ' + computer_name + ': ' + str(err))
+            return False
+
     # Is called when a client deletes a file.
     # Deletes the file on all clients and in the data backend
     # @param path the path relative to the source box root
     # @param file_name the file name
     def delete_file(self, file_path, computer_name):
+        if self._ignored(file_path, computer_name):
+            return True
         # return true if successfully deleted
+        self.locks.forget(file_path)
         self.data.delete_file(file_path, computer_name)
 
         # push changes to all other clients
@@ -244,6 +556,74 @@ class SourceBoxServer(object):
         # return true if successfully deleted
         return True
 
+    # Is called when a client sends a batch of operations.
+    # Applies them in the data backend and forwards them to all other clients
+    # as one batch
+    # @param entries the operations (Frames)
+    # @param computer_name the name of the computer sending the batch
+    def apply_batch(self, entries, computer_name):
+        self.log.debug(computer_name + ' sent a batch of ' + str(len(entries)) + ' operations')
+        entries, complete = self._filter_batch(entries, computer_name)
+        applied = self.data.apply_batch(entries, computer_name)
+        for entry in applied:
+            if entry.opcode in (protocol.OP_REMOVE, protocol.OP_DELETE_DIR):
+                self.locks.forget(entry.path)
+            elif entry.opcode == protocol.OP_MOVE:
+                self.locks.move(entry.path, protocol.decode_path(entry.payload))
+
+        # push changes to all other clients
+        if applied:
+            for comm in self.active_clients.keys():
+                if not comm == computer_name:
+                    self.active_clients[comm].send_batch(applied)
+        # return true if all operations were applied
+        return complete and len(applied) == len(entries)
+
+    # leaves out the operations of a batch on ignored paths
+    # @param entries the operations (Frames)
+    # @param computer_name the name of the computer sending the batch
+    # @returns (the operations to apply, False if an operation cannot be applied)
+    def _filter_batch(self, entries, computer_name):
+        kept = []
+        complete = True
+        for entry in entries:
+            if entry.opcode == protocol.OP_MOVE:
+                is_dir = self.data.layout.is_dir(entry.path)
+                new_path = protocol.decode_path(entry.payload)
+                if self.rules.ignored(new_path, is_dir) and not self.rules.ignored(entry.path, is_dir):
+                    # moved out of the synced paths: gone for everybody else
+                    self.log.debug(computer_name + ' moved ' + entry.path + ' to an ignored path')
+                    entry = protocol.Frame(protocol.OP_DELETE_DIR if is_dir else protocol.OP_REMOVE,
+                                           path=entry.path)
+                elif self._ignored(entry.path, computer_name, is_dir):
+                    # the server does not have it (the client has to create it)
+                    complete = complete and self.rules.ignored(new_path, is_dir)
+                    continue
+            elif self._ignored(entry.path, computer_name,
+                               entry.opcode in (protocol.OP_CREATE_DIR, protocol.OP_DELETE_DIR)):
+                continue
+            kept.append(entry)
+        return kept, complete
+
+    # checks if a path is ignored (see ignore_rules.py)
+    # @param path the path relative to the source box root
+    # @param computer_name the name of the computer that sent the path
+    # @param is_dir True for a directory
+    def _ignored(self, path, computer_name, is_dir=False):
+        if self.rules.ignored(path, is_dir):
+            self.log.debug('Ignored ' + path + ' of ' + computer_name)
+            return True
+        return False
+
+    # removes the spool file of content that is not stored
+    # @param content_file the spool file (or None)
+    def _discard(self, content_file):
+        if content_file is not None:
+            try:
+                os.remove(content_file)
+            except OSError, err:
+                self.log.error('Could not remove ' + content_file + ': ' + str(err))
+
     # gets the size of a file
     # @param path the path relative to the source box root
     # @param file_name the file name
@@ -254,7 +634,19 @@ class SourceBoxServer(object):
             return False
     # Moves a file
     def move(self, old_file_path, new_file_path, computer_name):
+        is_dir = self.data.layout.is_dir(old_file_path)
+        if self.rules.ignored(new_file_path, is_dir):
+            if self._ignored(old_file_path, computer_name, is_dir):
+                return True
+            # moved out of the synced paths: gone for everybody else
+            if is_dir:
+                return self.delete_dir(old_file_path, computer_name)
+            return self.delete_file(old_file_path, computer_name)
+        if self._ignored(old_file_path, computer_name, is_dir):
+            # the server does not have it (the client has to create it)
+            return False
         # return true if successfully deleted
+        self.locks.move(old_file_path, new_file_path)
         self.data.move(old_file_path, new_file_path)
 
         # push changes to all other clients
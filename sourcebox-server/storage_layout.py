@@ -0,0 +1,271 @@
+#
+# Storage_Layout
+# where the files of the sourceBox are stored on disk
+#
+# The files are spread over one or more storage roots (e.g. one per disk).
+# Every file gets a name of its own when it is created and is stored as
+#   <root>/<first two hex digits>/<next two hex digits>/<name>
+# together with its ,v file. The root is chosen by the name, so the files
+# are spread evenly over the roots and no directory holds more than a few
+# entries. A map (path in the sourceBox -> location on disk) is kept in an
+# sqlite database and in a dictionary; directories are only entries in the
+# map. Moving a file or a directory only changes the map.
+#
+# Files of the old flat layout (the data directory, paths as in the
+# sourceBox) are added to the map where they are and moved into the roots
+# by migrate, one at a time, while the server is running.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+
+import path_index
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS locations (
+    path TEXT PRIMARY KEY,
+    location TEXT
+)'''
+
+
+class Storage_Layout(object):
+
+    # Constructor
+    # @param roots the storage roots
+    # @param db_path the sqlite database of the map
+    def __init__(self, roots, db_path):
+        if not roots:
+            raise ValueError('No storage roots')
+        self.log = logging.getLogger("server")
+        self.roots = list(roots)
+        # held while the map is changed
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute(_SCHEMA)
+        # path -> location (None for directories)
+        self._entries = dict(self._db.execute('SELECT path, location FROM locations'))
+
+    # returns the location of a file
+    # @param path the path relative to the sourceBox
+    # @returns the path on disk or None if there is no such file
+    def locate(self, path):
+        return self._entries.get(os.path.normpath(path))
+
+    # checks if a path is a directory
+    # @param path the path relative to the sourceBox
+    def is_dir(self, path):
+        path = os.path.normpath(path)
+        return path in self._entries and self._entries[path] is None
+
+    # returns the location of a file, a new one if the file is not stored yet
+    # @param path the path relative to the sourceBox
+    # @returns the path on disk (its directory exists)
+    def place(self, path):
+        path = os.path.normpath(path)
+        with self._lock:
+            location = self._entries.get(path)
+            if location is None:
+                location = self.new_location()
+                self._store(self._parents(path) + [(path, location)], [])
+        return location
+
+    # records a directory (and its parents)
+    # @param path the path relative to the sourceBox
+    def add_dir(self, path):
+        path = os.path.normpath(path)
+        with self._lock:
+            if path not in self._entries:
+                self._store(self._parents(path) + [(path, None)], [])
+
+    # removes a file or a directory with everything in it from the map
+    # @param path the path relative to the sourceBox
+    # @returns the locations of the removed files
+    def remove(self, path):
+        with self._lock:
+            removed = self._under(os.path.normpath(path))
+            locations = [self._entries[key] for key in removed if self._entries[key] is not None]
+            self._store([], removed)
+        return locations
+
+    # moves a file or a directory with everything in it (only in the map)
+    # @param old_path old path relative to the sourceBox
+    # @param new_path new path relative to the sourceBox
+    # @returns the locations of the files that were at new_path before
+    def move(self, old_path, new_path):
+        old_path = os.path.normpath(old_path)
+        new_path = os.path.normpath(new_path)
+        with self._lock:
+            moved = self._under(old_path)
+            if not moved:
+                return []
+            kept = set(moved)
+            replaced = [key for key in self._under(new_path) if key not in kept]
+            locations = [self._entries[key] for key in replaced if self._entries[key] is not None]
+            added = [(new_path + key[len(old_path):], self._entries[key]) for key in moved]
+            self._store(self._parents(new_path) + added, moved + replaced)
+        return locations
+
+    # lists everything, parents before their contents
+    # @returns a list of (path relative to the sourceBox, is_dir)
+    def walk(self):
+        return [(path, self._entries[path] is None) for path in sorted(self._entries.keys())]
+
+    # lists all files
+    # @returns a list of (path relative to the sourceBox, location)
+    def files(self):
+        return [(path, location) for path, location in self._entries.items()
+                if location is not None]
+
+    # returns a new location in one of the roots (and creates its directory)
+    def new_location(self):
+        name = uuid.uuid4().hex
+        root = self.roots[int(name[:8], 16) % len(self.roots)]
+        directory = os.path.join(root, name[:2], name[2:4])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, name)
+
+    # adds the files and directories of the flat layout to an empty map (the
+    # files stay where they are until they are migrated)
+    # @param data_dir the directory of the flat layout
+    # @returns the number of added entries
+    def adopt(self, data_dir):
+        with self._lock:
+            if self._entries or not os.path.isdir(data_dir):
+                return 0
+            added = []
+            for root, dirs, files in os.walk(data_dir):
+                relroot = os.path.relpath(root, data_dir)
+                if 'RCS' in dirs:
+                    dirs.remove('RCS')
+                for name in dirs:
+                    added.append((os.path.normpath(os.path.join(relroot, name)), None))
+                for name in files:
+                    if not name.endswith(',v') and not name.startswith('.sb-'):
+                        added.append((os.path.normpath(os.path.join(relroot, name)),
+                                      os.path.join(root, name)))
+            self._store(added, [])
+        return len(added)
+
+    # moves the files of the flat layout into the storage roots
+    # A file is copied (or linked) with its ,v file and the map is switched
+    # while write_lock is held, if the file did not change in the meantime.
+    # @param data_dir the directory of the flat layout
+    # @param write_lock held by everyone writing files
+    # @param rate files moved per second at most (0: no limit)
+    # @param stop a threading.Event that ends the migration
+    # @returns the number of moved files
+    def migrate(self, data_dir, write_lock, rate=0, stop=None):
+        prefix = os.path.join(data_dir, '')
+        moved = 0
+        for path, location in self.files():
+            if stop is not None and stop.is_set():
+                break
+            if not location.startswith(prefix):
+                continue
+            try:
+                if self._migrate_file(path, location, write_lock):
+                    moved += 1
+            except (IOError, OSError), err:
+                self.log.error('Could not migrate ' + path + ': ' + str(err))
+            if rate > 0 and stop is not None:
+                stop.wait(1.0 / rate)
+        else:
+            # only empty directories are left
+            with write_lock:
+                if os.path.isdir(data_dir) and not any(files for root, dirs, files in os.walk(data_dir)):
+                    shutil.rmtree(data_dir, True)
+        return moved
+
+    # closes the database
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # moves one file of the flat layout into the roots
+    # @returns True if it was moved
+    def _migrate_file(self, path, location, write_lock):
+        target = self.new_location()
+        copied = []
+        stats = []
+        # the ,v file may be in an RCS directory
+        namev = location + ',v'
+        if not os.path.exists(namev):
+            namev = os.path.join(os.path.dirname(location), 'RCS', os.path.basename(namev))
+        try:
+            for source, copy in ((location, target), (namev, target + ',v')):
+                if not os.path.exists(source):
+                    continue
+                stats.append((source, _signature(source)))
+                _link_or_copy(source, copy)
+                copied.append(copy)
+            with write_lock:
+                unchanged = (self._entries.get(path) == location and
+                             all(_signature(name) == signature for name, signature in stats))
+                if unchanged:
+                    with self._lock:
+                        self._store([(path, target)], [])
+                    for name, signature in stats:
+                        os.remove(name)
+                    copied = []
+            return unchanged
+        finally:
+            # the file changed while it was copied, it is moved another time
+            for name in copied:
+                os.remove(name)
+
+    # the parents of a path that are not in the map
+    def _parents(self, path):
+        parents = []
+        parent = os.path.dirname(path)
+        while parent and parent not in self._entries:
+            parents.append((parent, None))
+            parent = os.path.dirname(parent)
+        return parents
+
+    # the entries of a file or of everything in a directory (a range query on the
+    # primary key, the paths in a directory follow each other)
+    def _under(self, path):
+        low, high = path_index.prefix_range(path)
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT path FROM locations WHERE path = ? OR (path >= ? AND path < ?)',
+                (path, low, high))]
+
+    # writes entries and removes paths in one transaction
+    # @param entries (path, location) to write
+    # @param removed the paths to remove
+    def _store(self, entries, removed):
+        if not entries and not removed:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM locations WHERE path = ?',
+                                     [(path,) for path in removed])
+                self._db.executemany('INSERT OR REPLACE INTO locations VALUES (?, ?)', entries)
+            for path in removed:
+                self._entries.pop(path, None)
+            for path, location in entries:
+                self._entries[path] = location
+
+
+# size, mtime and inode of a file (to see if it changed or was replaced)
+def _signature(name):
+    stat = os.stat(name)
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+# hard links a file or copies it, if linking is not possible (other filesystem)
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except (AttributeError, OSError):
+        shutil.copy2(source, target)
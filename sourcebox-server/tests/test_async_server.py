@@ -0,0 +1,183 @@
+#
+# tests of the event loop server: the workers, the order of the commands of
+# a client, and a connection driven by the loop
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import asyncore
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import async_server
+import protocol
+
+
+class Serial_Queue_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = async_server.Executor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_failing_task_does_not_stop_the_worker(self):
+        done = threading.Event()
+        executor = async_server.Executor(1)
+        try:
+            executor.submit(lambda: 1 / 0)
+            executor.submit(done.set)
+            self.assertTrue(done.wait(5))
+        finally:
+            executor.shutdown()
+
+    def test_tasks_of_a_queue_run_in_order(self):
+        done = threading.Event()
+        order = []
+        queues = [async_server.Serial_Queue(self.executor) for number in range(3)]
+
+        def task(number, pause):
+            time.sleep(pause)
+            order.append(number)
+            if len(order) == 30:
+                done.set()
+        for number in range(10):
+            for queue in queues:
+                queue.submit(task, (queues.index(queue), number), 0.01 * (number % 3))
+        self.assertTrue(done.wait(10))
+        for index in range(3):
+            self.assertEqual([number for queue, number in order if queue == index], range(10))
+        self.assertEqual(queues[0].depth(), 0)
+
+
+# the objects of the server a connection uses
+class _Fake_Server(object):
+
+    def __init__(self, spool_dir):
+        self.map = {}
+        self.loop_thread = threading.current_thread()
+        self.executor = async_server.Executor(2)
+        self.trigger = async_server.Trigger(self.map)
+        self.parent = self
+        self.data = self
+        self.spool_dir = spool_dir
+        self.logins = []
+        self.removed = []
+
+    def negotiate(self, frame):
+        return frame.flags & protocol.FLAG_MANIFEST
+
+    def login_client(self, comm, manifest):
+        self.logins.append((comm.computer_name, manifest))
+
+    def remove_client(self, computer_name):
+        self.removed.append(computer_name)
+
+
+# a controller that records the frames of the client
+class _Fake_Controller(object):
+
+    computer_name = 'box'
+
+    def __init__(self):
+        self.requests = self
+        self.frames = []
+        self.closed = False
+
+    def handle_frame(self, frame):
+        if frame.payload_file is not None:
+            with open(frame.payload_file, 'rb') as payload_file:
+                frame.payload = payload_file.read()
+            frame.discard()
+        self.frames.append((frame.opcode, frame.payload))
+
+    def close(self):
+        self.closed = True
+
+
+class Async_Connection_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = _Fake_Server(self.directory)
+        sock, self.peer = socket.socketpair()
+        self.peer.settimeout(5)
+        self.connection = async_server.Async_Connection(self.server, sock)
+
+    def tearDown(self):
+        asyncore.close_all(self.server.map)
+        self.server.executor.shutdown()
+        self.peer.close()
+        shutil.rmtree(self.directory)
+
+    # runs the loop until a condition holds
+    def _loop_until(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline, 'timed out')
+            asyncore.loop(timeout=0.05, map=self.server.map, count=1)
+
+    # reads the frames the connection sent until the peer has count of them
+    def _receive(self, count):
+        decoder = protocol.Frame_Decoder()
+        frames = []
+        while len(frames) < count:
+            self._loop_until(lambda: not self.connection._out)
+            decoder.feed(self.peer.recv(65536))
+            frames.extend(decoder)
+        return frames
+
+    def test_init_handshake(self):
+        self.peer.sendall(protocol.encode_frame(protocol.OP_INIT, '', 'box', protocol.FLAG_MANIFEST, 1))
+        self._loop_until(lambda: self.server.logins)
+        self.assertEqual(self.server.logins, [('box', True)])
+        frame = self._receive(1)[0]
+        self.assertEqual((frame.opcode, frame.flags, frame.seq),
+                         (protocol.OP_OK, protocol.FLAG_MANIFEST, 1))
+
+    def test_other_frame_before_init_closes(self):
+        self.peer.sendall(protocol.encode_frame(protocol.OP_OK))
+        self._loop_until(lambda: not self.connection.connected)
+        self.assertEqual(self.peer.recv(10), '')
+
+    def test_spooled_content_is_written_by_a_worker(self):
+        controller = self.connection.controller = _Fake_Controller()
+        content = os.urandom(protocol.SPOOL_THRESHOLD + 1000)
+        self.peer.sendall(protocol.encode_frame(protocol.OP_CREATE_FILE, 'a', 'small') +
+                          protocol.encode_frame(protocol.OP_CREATE_FILE, 'b', content) +
+                          protocol.encode_frame(protocol.OP_OK))
+        self._loop_until(lambda: len(controller.frames) == 3)
+        self.assertEqual(controller.frames, [(protocol.OP_CREATE_FILE, 'small'),
+                                             (protocol.OP_CREATE_FILE, content),
+                                             (protocol.OP_OK, '')])
+        self.assertTrue(self.connection.readable())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_push_from_worker_and_close_when_done(self):
+        def answer():
+            self.connection.push('abc', 'def')
+            self.connection.close_when_done()
+        self.server.executor.submit(answer)
+        self._loop_until(lambda: not self.connection.connected)
+        self.assertEqual(self.peer.recv(10), 'abcdef')
+        self.assertEqual(self.peer.recv(10), '')
+
+    def test_disconnect_removes_client(self):
+        controller = self.connection.controller = _Fake_Controller()
+        self.peer.sendall(protocol.encode_frame(protocol.OP_CREATE_FILE, 'b',
+                                                'x' * (protocol.SPOOL_THRESHOLD + 1))[:-10])
+        self.peer.close()
+        self._loop_until(lambda: self.server.removed)
+        self.assertEqual(self.server.removed, ['box'])
+        self.assertTrue(controller.closed)
+        self.assertEqual(controller.frames, [])
+        self._loop_until(lambda: not os.listdir(self.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#
+# tests of the blob store: which blobs sweep removes
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import blob_store
+
+
+class Blob_Store_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = blob_store.Blob_Store(os.path.join(self.directory, 'blobs'),
+                                           os.path.join(self.directory, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # writes a file and adds it
+    # @returns (path, hex digest)
+    def _add(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as data_file:
+            data_file.write(content)
+        return path, self.store.add(path)
+
+    # adds a blob of a file that is gone, unused for a while (as after a restart)
+    def _unused(self):
+        path, digest = self._add('a', 'content')
+        os.remove(path)
+        time.sleep(0.3)
+        self.store._used.clear()
+        return digest
+
+    def test_referenced_blob_is_kept(self):
+        path, digest = self._add('a', 'content')
+        if os.stat(path).st_nlink > 1:
+            # a hard link of the file
+            self.assertEqual(self.store.sweep(set(), 0), (0, 0))
+        self.assertEqual(self.store.sweep(set([digest]), 0), (0, 0))
+        self.assertTrue(self.store.has(digest))
+
+    def test_unused_blob_is_removed(self):
+        digest = self._unused()
+        self.assertEqual(self.store.sweep(set(), 0.2), (1, 7))
+        self.assertFalse(self.store.has(digest))
+
+    def test_released_blob_is_kept_for_a_while(self):
+        digest = self._unused()
+        self.store.release([digest])
+        self.assertEqual(self.store.sweep(set(), 0.2), (0, 0))
+        self.assertEqual(self.store.sweep(set(), 0), (1, 7))
+
+    def test_checked_out_blob_is_kept_for_a_while(self):
+        digest = self._unused()
+        os.remove(self.store.checkout(digest))
+        self.assertEqual(self.store.sweep(set(), 0.2), (0, 0))
+        self.assertTrue(self.store.has(digest))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#
+# tests of the chunk store: chunks read from the blob of a stored file
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import blob_store
+import chunk_store
+import protocol
+
+
+class Chunk_Store_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = os.path.join(self.directory, 'spool')
+        self.blobs = blob_store.Blob_Store(os.path.join(self.directory, 'blobs'), self.spool)
+        self.store = self._open()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        return chunk_store.Chunk_Store(os.path.join(self.directory, 'chunks'),
+                                       os.path.join(self.directory, 'chunks.db'), self.blobs.path)
+
+    # assembles a file and stores it like the server does
+    # @returns the hex digests of the chunks
+    def _store_file(self, path, chunks):
+        digests = [self.store.add(chunk) for chunk in chunks]
+        self.assertEqual(self.store.missing(digests), [])
+        content_file, sizes, digest = self.store.assemble(digests, self.spool)
+        self.assertEqual(digest, protocol.hash_content(''.join(chunks)))
+        self.blob = self.blobs.add(content_file, digest)
+        self.store.set_list(path, digests, self.blob, sizes)
+        return digests
+
+    def _assembled(self, digests):
+        content_file, sizes, digest = self.store.assemble(digests, self.spool)
+        with open(content_file, 'rb') as assembled:
+            return assembled.read()
+
+    def test_chunks_are_read_from_blob(self):
+        digests = self._store_file('a', ['one', 'two', 'one', 'three'])
+        for digest in digests:
+            self.assertFalse(os.path.exists(self.store.path(digest)))
+        self.assertTrue(self.store.has(digests[1]))
+        self.assertEqual(self._assembled(digests[2:] + digests[:2]), 'onethreeonetwo')
+
+    def test_locations_survive_restart(self):
+        digests = self._store_file('a', ['one', 'two'])
+        self.store.close()
+        self.store = self._open()
+        self.assertEqual(self.store.blobs(), set([self.blob]))
+        self.assertEqual(self._assembled(digests), 'onetwo')
+
+    def test_moved_list_keeps_blob(self):
+        digests = self._store_file('d/a', ['one', 'two'])
+        self.store.move('d', 'e')
+        self.assertEqual(self.store.get_list('e/a'), digests)
+        self.assertEqual(self.store.missing(digests), [])
+
+    def test_removed_list_chunks_are_missing(self):
+        digests = self._store_file('a', ['one', 'two'])
+        self.store.remove('a')
+        self.assertEqual(self.store.blobs(), set())
+        self.assertEqual(self.store.missing(digests), [0, 1])
+
+    def test_sweep_keeps_chunks_of_lists(self):
+        kept = self.store.add('kept')
+        unused = self.store.add('unused')
+        self.store.set_list('a', [kept])
+        self.assertEqual(self.store.sweep(0), (1, 6))
+        self.assertTrue(self.store.has(kept))
+        self.assertFalse(self.store.has(unused))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#
+# tests of the chunking: chunk sizes, and chunk boundaries that stay where
+# they are after an edit
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import chunking
+
+
+class Chunking_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(3 * chunking.MAX_SIZE)
+        self.chunks = chunking.chunk_content(self.content)
+
+    def _digests(self, chunks):
+        return [digest for offset, size, digest in chunks]
+
+    def test_chunks_cover_content(self):
+        self.assertTrue(len(self.chunks) > 3)
+        offset = 0
+        for start, size, digest in self.chunks:
+            self.assertEqual(start, offset)
+            self.assertTrue(chunking.MIN_SIZE <= size <= chunking.MAX_SIZE or
+                            start + size == len(self.content))
+            offset += size
+        self.assertEqual(offset, len(self.content))
+        self.assertEqual(chunking.chunk_content(self.content), self.chunks)
+
+    def test_small_content_and_no_anchors(self):
+        self.assertEqual(chunking.chunk_content(''), [])
+        self.assertEqual(len(chunking.chunk_content('a' * chunking.MIN_SIZE)), 1)
+        sizes = [size for offset, size, digest in chunking.chunk_content(
+            'a' * (2 * chunking.MAX_SIZE + 1))]
+        self.assertEqual(sizes, [chunking.MAX_SIZE, chunking.MAX_SIZE, 1])
+
+    def test_insert_changes_only_nearby_chunks(self):
+        middle = len(self.content) // 2
+        edited = self.content[:middle] + os.urandom(1000) + self.content[middle:]
+        old = self._digests(self.chunks)
+        new = self._digests(chunking.chunk_content(edited))
+        self.assertTrue(len([digest for digest in new if digest not in old]) <= 2)
+        self.assertTrue(len([digest for digest in old if digest not in new]) <= 2)
+
+    def test_delete_changes_only_nearby_chunks(self):
+        edited = self.content[:1000] + self.content[2000:]
+        old = self._digests(self.chunks)
+        new = self._digests(chunking.chunk_content(edited))
+        self.assertTrue(len([digest for digest in new if digest not in old]) <= 2)
+        self.assertEqual(new[-3:], old[-3:])
+
+    def test_chunk_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'a')
+            with open(path, 'wb') as data_file:
+                data_file.write(self.content)
+            self.assertEqual(chunking.chunk_file(path), self.chunks)
+            open(path, 'wb').close()
+            self.assertEqual(chunking.chunk_file(path), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
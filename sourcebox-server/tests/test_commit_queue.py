@@ -0,0 +1,79 @@
+#
+# tests of the commit queue: windows, flush and discard
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import threading
+import time
+import unittest
+
+import commit_queue
+
+
+class Commit_Queue_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.commits = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.queue = None
+
+    def tearDown(self):
+        self.release.set()
+        if self.queue is not None:
+            self.queue.close()
+
+    # the check in: records it, waits for release
+    def _commit(self, path, user, changes):
+        self.started.set()
+        self.release.wait()
+        self.commits.append((path, user, changes))
+
+    def test_modifications_within_window_are_one_revision(self):
+        self.queue = commit_queue.Commit_Queue(self._commit, 60, 100)
+        self.queue.add('a', 'x')
+        self.queue.add('a', 'y')
+        self.queue.add('b', 'x')
+        self.queue.flush('a')
+        self.assertEqual(self.commits, [('a', 'y', 2)])
+        self.queue.flush()
+        self.assertEqual(self.commits, [('a', 'y', 2), ('b', 'x', 1)])
+
+    def test_discard_drops_directory(self):
+        self.queue = commit_queue.Commit_Queue(self._commit, 60, 100)
+        self.queue.add('d/a', 'x')
+        self.queue.add('d/e/b', 'x')
+        self.queue.add('dd', 'x')
+        self.assertEqual(sorted(pending.path for pending in self.queue.discard('d')),
+                         ['d/a', 'd/e/b'])
+        self.queue.flush()
+        self.assertEqual(self.commits, [('dd', 'x', 1)])
+
+    def test_full_queue_commits_oldest(self):
+        self.queue = commit_queue.Commit_Queue(self._commit, 60, 2)
+        for path in ('a', 'b', 'c'):
+            self.queue.add(path, 'x')
+        self.assertEqual(self.commits, [('a', 'x', 1)])
+        self.assertEqual(self.queue.stats()['overflows'], 1)
+
+    def test_flush_waits_for_running_commit(self):
+        self.release.clear()
+        self.queue = commit_queue.Commit_Queue(self._commit, 0, 100)
+        self.queue.add('a', 'x')
+        # the thread of the queue is checking in a now
+        self.assertTrue(self.started.wait(5))
+        flushed = threading.Event()
+        flusher = threading.Thread(target=lambda: (self.queue.flush('a'), flushed.set()))
+        flusher.start()
+        time.sleep(0.2)
+        self.assertFalse(flushed.is_set())
+        self.release.set()
+        flusher.join(5)
+        self.assertTrue(flushed.is_set())
+        self.assertEqual(self.commits, [('a', 'x', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#
+# tests of the content cache: eviction and contents read before a change
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import unittest
+
+import content_cache
+
+
+class Content_Cache_Test(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = content_cache.Content_Cache(10, 10)
+        cache.put('a', 'aaaa')
+        cache.put('b', 'bbbb')
+        cache.get('a')
+        cache.put('c', 'cccc')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.size, 8)
+
+    def test_large_contents_are_not_cached(self):
+        cache = content_cache.Content_Cache(100, 4)
+        cache.put('a', 'aaaaa')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.size, 0)
+
+    def test_invalidate_directory(self):
+        cache = content_cache.Content_Cache(100, 100)
+        cache.put('d/a', 'a')
+        cache.put('d/e/b', 'b')
+        cache.put('dd', 'c')
+        cache.invalidate('d')
+        self.assertEqual(cache.get('d/a'), None)
+        self.assertEqual(cache.get('d/e/b'), None)
+        self.assertEqual(cache.get('dd'), 'c')
+        self.assertEqual(cache.size, 1)
+
+    def test_content_read_before_a_change_is_dropped(self):
+        cache = content_cache.Content_Cache(100, 100)
+        generation = cache.generation()
+        # a writer puts the new content while the reader has the old one
+        cache.put('a', 'new')
+        cache.put('a', 'old', generation)
+        self.assertEqual(cache.get('a'), 'new')
+        generation = cache.generation()
+        cache.invalidate('a')
+        cache.put('a', 'old', generation)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_content_read_without_change_is_cached(self):
+        cache = content_cache.Content_Cache(100, 100)
+        generation = cache.generation()
+        cache.put('a', 'content', generation)
+        self.assertEqual(cache.get('a'), 'content')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#
+# tests of the deltas: round trips and damaged deltas
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import random
+import unittest
+
+import delta
+
+
+class Delta_Test(unittest.TestCase):
+
+    def _round_trip(self, basis, data, block_size=None):
+        patch = delta.compute(delta.signature(basis, block_size), data)
+        self.assertEqual(delta.apply(basis, patch), data)
+        return patch
+
+    def test_round_trip(self):
+        generator = random.Random(1)
+        basis = ''.join(chr(generator.randrange(256)) for index in xrange(100000))
+        edited = basis[:5000] + 'inserted' + basis[5000:70000] + basis[70100:]
+        for basis_text, data in [('', ''), ('', 'new'), ('old', ''), (basis, basis),
+                                 (basis, edited), (edited, basis), (basis, basis[::-1])]:
+            self._round_trip(basis_text, data)
+
+    def test_small_edit_gives_small_delta(self):
+        basis = os.urandom(1024 * 1024)
+        data = basis[:300000] + 'x' + basis[300001:]
+        patch = self._round_trip(basis, data)
+        self.assertTrue(len(patch) < 3 * delta.block_size_for(len(basis)))
+
+    def test_unaligned_blocks_and_short_tail(self):
+        basis = os.urandom(10000)
+        self._round_trip(basis, 'abc' + basis + 'tail', 2048)
+        self._round_trip(basis, basis[7:9999], 2048)
+
+    def test_wrong_basis_is_rejected(self):
+        basis = os.urandom(10000)
+        patch = delta.compute(delta.signature(basis), basis + 'more')
+        self.assertRaises(delta.Delta_Error, delta.apply, basis[:-1] + 'x', patch)
+
+    def test_damaged_delta_is_rejected(self):
+        basis = os.urandom(10000)
+        patch = delta.compute(delta.signature(basis), 'new' + basis)
+        self.assertRaises(delta.Delta_Error, delta.apply, basis, patch[:10])
+        self.assertRaises(delta.Delta_Error, delta.apply, basis, 'XXXX' + patch[4:])
+        self.assertRaises(delta.Delta_Error, delta.apply, basis, patch[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
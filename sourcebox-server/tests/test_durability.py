@@ -0,0 +1,88 @@
+#
+# tests of the durable writer: the temporary files and the fsyncs of each mode
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import durability
+
+
+class Durable_Writer_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+        shutil.rmtree(self.directory)
+
+    def _writer(self, mode):
+        writer = durability.Durable_Writer(mode, interval=0.01)
+        self.writers.append(writer)
+        return writer
+
+    # writes a content the way the callers do and returns the final path
+    def _write(self, writer, name, content):
+        path = os.path.join(self.directory, 'd', name)
+        temp = writer.write_temp(content, os.path.dirname(path))
+        writer.prepare(temp)
+        os.rename(temp, path)
+        writer.committed(path)
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as data_file:
+            return data_file.read()
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, durability.Durable_Writer, 'sometimes')
+
+    def test_temporary_file_next_to_the_final_path(self):
+        writer = self._writer(durability.MODE_NONE)
+        temp = writer.write_temp('abc', os.path.join(self.directory, 'd'), prefix='.x-')
+        self.assertEqual(os.path.dirname(temp), os.path.join(self.directory, 'd'))
+        self.assertTrue(os.path.basename(temp).startswith('.x-'))
+        self.assertEqual(self._read(temp), 'abc')
+
+    def test_none_does_not_fsync(self):
+        writer = self._writer(durability.MODE_NONE)
+        path = self._write(writer, 'a', 'abc')
+        writer.sync()
+        self.assertEqual(self._read(path), 'abc')
+        self.assertEqual(writer.stats(), {'mode': 'none', 'fsyncs': 0, 'groups': 0, 'pending': 0})
+
+    def test_fsync_syncs_file_and_directory(self):
+        writer = self._writer(durability.MODE_FSYNC)
+        self._write(writer, 'a', 'abc')
+        self.assertEqual(writer.stats()['fsyncs'], 2)
+        self.assertEqual(writer.stats()['groups'], 0)
+
+    def test_group_syncs_writes_together(self):
+        writer = self._writer(durability.MODE_GROUP)
+        paths = [self._write(writer, name, name) for name in ('a', 'b', 'c')]
+        writer.sync()
+        stats = writer.stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertTrue(1 <= stats['groups'] <= 3)
+        # one fsync per file and one per directory and group at most
+        self.assertTrue(4 <= stats['fsyncs'] <= 6)
+        self.assertEqual([self._read(path) for path in paths], ['a', 'b', 'c'])
+
+    def test_close_writes_pending_files_and_stops(self):
+        writer = durability.Durable_Writer(durability.MODE_GROUP, interval=0.01)
+        self._write(writer, 'a', 'abc')
+        writer.close()
+        self.assertEqual(writer.stats()['pending'], 0)
+        self.assertTrue(writer.stats()['groups'] >= 1)
+        self.assertFalse(writer._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#
+# tests of the frame decoder: frames split over and packed into reads, and
+# large contents spooled to files
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import zlib
+
+import protocol
+
+
+class Frame_Decoder_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = protocol.Frame_Decoder()
+
+    def tearDown(self):
+        self.decoder.close()
+
+    def test_frame_fed_byte_by_byte(self):
+        data = protocol.encode_frame(protocol.OP_MODIFY, os.path.join('d', 'a'), 'content', seq=7)
+        for byte in data[:-1]:
+            self.decoder.feed(byte)
+            self.assertEqual(self.decoder.next_frame(), None)
+        self.decoder.feed(data[-1])
+        frame = self.decoder.next_frame()
+        self.assertEqual((frame.opcode, frame.path, frame.payload, frame.seq),
+                         (protocol.OP_MODIFY, os.path.join('d', 'a'), 'content', 7))
+        self.assertEqual(self.decoder.pending(), 0)
+
+    def test_many_frames_in_one_read(self):
+        self.decoder.feed(protocol.encode_frame(protocol.OP_LOCK, 'a', seq=1) +
+                          protocol.encode_frame(protocol.OP_OK, seq=1) +
+                          protocol.encode_frame(protocol.OP_MOVE, 'a', 'b', seq=2)[:10])
+        self.assertEqual([(frame.name(), frame.seq) for frame in self.decoder],
+                         [('LOCK', 1), ('OK', 1)])
+        self.assertTrue(self.decoder.pending() > 0)
+
+    def test_compressed_payload(self):
+        content = 'abc' * 1000
+        payload, flags = protocol.compress_payload(protocol.OP_CREATE_FILE, content)
+        self.assertTrue(flags & protocol.FLAG_COMPRESSED)
+        self.decoder.feed(protocol.encode_frame(protocol.OP_CREATE_FILE, 'a', payload, flags))
+        frame = self.decoder.next_frame()
+        self.assertEqual(frame.payload, content)
+        self.assertFalse(frame.flags & protocol.FLAG_COMPRESSED)
+
+    def test_corrupt_streams(self):
+        self.decoder.feed(struct.pack('!B', 99) + protocol.encode_frame(protocol.OP_OK)[1:])
+        self.assertRaises(protocol.Protocol_Error, self.decoder.next_frame)
+
+        decoder = protocol.Frame_Decoder(max_payload=4)
+        decoder.feed(protocol.encode_frame(protocol.OP_MODIFY, 'a', 'too large'))
+        self.assertRaises(protocol.Protocol_Error, decoder.next_frame)
+
+        decoder = protocol.Frame_Decoder(max_payload=100)
+        bomb = zlib.compress('x' * 1000)
+        decoder.feed(protocol.encode_frame(protocol.OP_MODIFY, 'a', bomb, protocol.FLAG_COMPRESSED))
+        self.assertRaises(protocol.Protocol_Error, decoder.next_frame)
+
+
+
+class Spooling_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.decoder = protocol.Frame_Decoder(spool_dir=os.path.join(self.directory, 'spool'))
+        self.content = os.urandom(protocol.SPOOL_THRESHOLD + 1000)
+
+    def tearDown(self):
+        self.decoder.close()
+        shutil.rmtree(self.directory)
+
+    def _read(self, frame):
+        with open(frame.payload_file, 'rb') as payload_file:
+            return payload_file.read()
+
+    def _spooled(self):
+        return os.listdir(os.path.join(self.directory, 'spool'))
+
+    def test_large_content_is_spooled(self):
+        data = protocol.encode_frame(protocol.OP_CREATE_FILE, 'a', self.content, seq=3)
+        data += protocol.encode_frame(protocol.OP_OK, seq=4)
+        self.assertFalse(self.decoder.spools())
+        self.decoder.feed(data[:1000])
+        self.assertTrue(self.decoder.spools())
+        self.assertEqual(self.decoder.next_frame(), None)
+        self.decoder.feed(data[1000:])
+        frame = self.decoder.next_frame()
+        self.assertEqual((frame.payload, frame.size, frame.seq), ('', len(self.content), 3))
+        self.assertEqual(self._read(frame), self.content)
+        self.assertFalse(self.decoder.spools())
+        self.assertEqual(self.decoder.next_frame().opcode, protocol.OP_OK)
+        frame.discard()
+        self.assertEqual(self._spooled(), [])
+
+    def test_small_content_and_delta_stay_in_memory(self):
+        self.decoder.feed(protocol.encode_frame(protocol.OP_MODIFY, 'a', 'small'))
+        self.decoder.feed(protocol.encode_frame(protocol.OP_MODIFY, 'a', self.content,
+                                                protocol.FLAG_DELTA))
+        self.assertFalse(self.decoder.spools())
+        self.assertEqual([frame.payload_file for frame in self.decoder], [None, None])
+
+    def test_compressed_content_is_decompressed_into_the_spool_file(self):
+        content = 'abc' * protocol.SPOOL_THRESHOLD
+        payload = zlib.compress(content)
+        self.assertTrue(len(payload) < protocol.SPOOL_THRESHOLD)
+        payload += os.urandom(protocol.SPOOL_THRESHOLD)
+        # only the compressed stream counts, the rest is unused data
+        self.decoder.feed(protocol.encode_frame(protocol.OP_CREATE_FILE, 'a', payload,
+                                                protocol.FLAG_COMPRESSED))
+        frame = self.decoder.next_frame()
+        self.assertEqual((self._read(frame), frame.size), (content, len(content)))
+        self.assertFalse(frame.flags & protocol.FLAG_COMPRESSED)
+        self.assertEqual(len(self._spooled()), 1)
+
+    def test_read_from_socket_into_spool_file(self):
+        reader, writer = socket.socketpair()
+        try:
+            writer.sendall(protocol.encode_frame(protocol.OP_MODIFY, 'a', self.content))
+            frame = None
+            while frame is None:
+                self.assertTrue(self.decoder.read_from(reader) > 0)
+                frame = self.decoder.next_frame()
+            self.assertEqual(self._read(frame), self.content)
+        finally:
+            reader.close()
+            writer.close()
+
+    def test_close_removes_half_received_file(self):
+        data = protocol.encode_frame(protocol.OP_MODIFY, 'a', self.content)
+        self.decoder.feed(data[:-10])
+        self.assertEqual(self.decoder.next_frame(), None)
+        self.assertEqual(len(self._spooled()), 1)
+        self.decoder.close()
+        self.assertEqual(self._spooled(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#
+# tests of the ignore rules: the gitignore semantics listed in ignore_rules.py
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import unittest
+
+import ignore_rules
+
+
+class Ignore_Rules_Test(unittest.TestCase):
+
+    def test_name_pattern_matches_at_any_depth(self):
+        rules = ignore_rules.Ignore_Rules(['*.pyc'])
+        self.assertTrue(rules.ignored('a.pyc'))
+        self.assertTrue(rules.ignored('src/lib/a.pyc'))
+        self.assertTrue(rules.ignored('cache.pyc', True))
+        self.assertFalse(rules.ignored('a.py'))
+        self.assertFalse(rules.ignored('a.pyc.txt'))
+
+    def test_directory_pattern(self):
+        rules = ignore_rules.Ignore_Rules(['build/'])
+        self.assertTrue(rules.ignored('build', True))
+        self.assertTrue(rules.ignored('src/build', True))
+        self.assertTrue(rules.ignored('build/out/a.o'))
+        self.assertFalse(rules.ignored('build'))
+        self.assertFalse(rules.ignored('src/build'))
+
+    def test_pattern_with_slash_is_anchored(self):
+        rules = ignore_rules.Ignore_Rules(['/TODO', 'doc/draft'])
+        self.assertTrue(rules.ignored('TODO'))
+        self.assertFalse(rules.ignored('src/TODO'))
+        self.assertTrue(rules.ignored('doc/draft'))
+        self.assertFalse(rules.ignored('src/doc/draft'))
+
+    def test_double_star(self):
+        rules = ignore_rules.Ignore_Rules(['doc/**/*.tmp', '**/cache', 'out/**'])
+        self.assertTrue(rules.ignored('doc/a.tmp'))
+        self.assertTrue(rules.ignored('doc/x/y/a.tmp'))
+        self.assertFalse(rules.ignored('src/doc/a.tmp'))
+        self.assertTrue(rules.ignored('cache'))
+        self.assertTrue(rules.ignored('a/b/cache'))
+        self.assertTrue(rules.ignored('out/a/b'))
+        self.assertFalse(rules.ignored('out', True))
+
+    def test_single_star_and_question_mark_stay_in_a_component(self):
+        rules = ignore_rules.Ignore_Rules(['/a*b', '/x?z'])
+        self.assertTrue(rules.ignored('aXXb'))
+        self.assertFalse(rules.ignored('a/b'))
+        self.assertTrue(rules.ignored('xyz'))
+        self.assertFalse(rules.ignored('x/z'))
+
+    def test_last_match_decides(self):
+        rules = ignore_rules.Ignore_Rules(['*.pyc', '!keep.pyc', 'sub/keep.pyc'])
+        self.assertTrue(rules.ignored('a.pyc'))
+        self.assertFalse(rules.ignored('keep.pyc'))
+        self.assertFalse(rules.ignored('lib/keep.pyc'))
+        self.assertTrue(rules.ignored('sub/keep.pyc'))
+
+    def test_negation_cannot_bring_back_a_path_in_an_ignored_directory(self):
+        rules = ignore_rules.Ignore_Rules(['build/', '!build/keep.txt', '!keep.txt'])
+        self.assertTrue(rules.ignored('build/keep.txt'))
+        self.assertTrue(rules.ignored('build/sub/keep.txt'))
+        self.assertFalse(rules.ignored('keep.txt'))
+
+    def test_comments_blank_lines_and_escapes(self):
+        rules = ignore_rules.Ignore_Rules('# a comment\n\n   \n\\#notes\n\\!bang\n')
+        self.assertEqual(len(rules), 2)
+        self.assertTrue(rules.ignored('#notes'))
+        self.assertTrue(rules.ignored('!bang'))
+        self.assertFalse(rules.ignored('# a comment'))
+        self.assertFalse(rules.ignored('notes'))
+
+    def test_character_classes(self):
+        rules = ignore_rules.Ignore_Rules(['/[ab].txt', '/[!ab].log', '/[0-9]*'])
+        self.assertTrue(rules.ignored('a.txt'))
+        self.assertFalse(rules.ignored('c.txt'))
+        self.assertTrue(rules.ignored('c.log'))
+        self.assertFalse(rules.ignored('a.log'))
+        self.assertTrue(rules.ignored('7days'))
+
+    def test_invalid_patterns(self):
+        self.assertRaises(ValueError, ignore_rules.Ignore_Rules, ['[abc'])
+        self.assertRaises(ValueError, ignore_rules.Ignore_Rules, ['!'])
+        self.assertRaises(ValueError, ignore_rules.Ignore_Rules, ['/'])
+
+    def test_paths(self):
+        rules = ignore_rules.Ignore_Rules(['/build/'])
+        self.assertTrue(rules.ignored(os.path.join('build', 'a.o')))
+        self.assertTrue(rules.ignored('/build/a.o'))
+        self.assertFalse(rules.ignored(''))
+        self.assertFalse(rules.ignored('.'))
+        self.assertFalse(ignore_rules.Ignore_Rules().ignored('a.pyc'))
+
+    def test_cached_directories(self):
+        rules = ignore_rules.Ignore_Rules(['tmp/'])
+        for index in range(3):
+            self.assertTrue(rules.ignored('a/tmp/f%d' % index))
+            self.assertFalse(rules.ignored('a/src/f%d' % index))
+
+
+if __name__ == '__main__':
+    unittest.main()
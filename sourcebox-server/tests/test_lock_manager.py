@@ -0,0 +1,79 @@
+#
+# tests of the lock manager: leases, renewal and expiry
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import threading
+import time
+import unittest
+
+import lock_manager
+
+
+class Lock_Manager_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.expired = []
+        self.expiry = threading.Event()
+        self.locks = lock_manager.Lock_Manager(60, self._on_expire)
+
+    def tearDown(self):
+        self.locks.close()
+
+    def _on_expire(self, lease):
+        self.expired.append(lease.path)
+        self.expiry.set()
+
+    def test_only_owner_renews_and_releases(self):
+        self.assertEqual(self.locks.acquire('a', 'x').renewals, 0)
+        self.assertEqual(self.locks.acquire('a', 'y'), None)
+        self.assertEqual(self.locks.acquire('a', 'x').renewals, 1)
+        self.assertFalse(self.locks.renew('a', 'y'))
+        self.assertEqual(self.locks.release('a', 'y'), None)
+        self.assertEqual(self.locks.holder('a'), 'x')
+        self.assertEqual(self.locks.release('a', 'x').owner, 'x')
+        self.assertEqual(self.locks.holder('a'), None)
+
+    def test_lease_expires(self):
+        self.locks.acquire('a', 'x', 0.1)
+        self.assertTrue(self.expiry.wait(5))
+        self.assertEqual(self.expired, ['a'])
+        self.assertEqual(self.locks.holder('a'), None)
+        # another client may lock it now
+        self.assertNotEqual(self.locks.acquire('a', 'y'), None)
+
+    def test_renewed_lease_does_not_expire_early(self):
+        self.locks.acquire('a', 'x', 0.2)
+        self.locks.acquire('a', 'x', 60)
+        time.sleep(0.4)
+        self.assertEqual(self.expired, [])
+        self.assertEqual(self.locks.holder('a'), 'x')
+
+    def test_released_lease_does_not_expire(self):
+        self.locks.acquire('a', 'x', 0.1)
+        self.locks.release('a', 'x')
+        self.locks.acquire('b', 'x', 0.2)
+        self.assertTrue(self.expiry.wait(5))
+        self.assertEqual(self.expired, ['b'])
+
+    def test_moved_lease_expires_at_new_path(self):
+        self.locks.acquire(os.path.join('d', 'a'), 'x', 0.2)
+        self.locks.acquire('dd', 'x')
+        self.locks.move('d', 'e')
+        self.assertEqual(self.locks.holder(os.path.join('e', 'a')), 'x')
+        self.assertEqual(self.locks.holder('dd'), 'x')
+        self.assertTrue(self.expiry.wait(5))
+        self.assertEqual(self.expired, [os.path.join('e', 'a')])
+
+    def test_forget_directory(self):
+        self.locks.acquire(os.path.join('d', 'a'), 'x')
+        self.locks.acquire(os.path.join('d', 'e', 'b'), 'y')
+        self.locks.acquire('dd', 'x')
+        self.assertEqual(len(self.locks.forget('d')), 2)
+        self.assertEqual([lease.path for lease in self.locks.leases()], ['dd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#
+# tests of the native RCS engine: diffs and ,v files with \r and binary data
+#
+# The fixtures are written like GNU RCS writes them (ci with -kb), lines
+# are only split at \n.
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import native_rcs
+
+# 1.2 is 'a\rb\nc\n', 1.1 is 'a\rb\n'
+CR_FIXTURE = '''head	1.2;
+access;
+symbols;
+locks; strict;
+comment	@# @;
+expand	@b@;
+
+
+1.2
+date	2014.01.02.10.00.00;	author a;	state Exp;
+branches;
+next	1.1;
+
+1.1
+date	2014.01.01.10.00.00;	author a;	state Exp;
+branches;
+next	;
+
+
+desc
+@@
+
+
+1.2
+log
+@second
+@
+text
+@a\rb
+c
+@
+
+
+1.1
+log
+@Initial revision
+@
+text
+@d2 1
+@
+'''
+
+# 1.2 is BINARY_NEW, 1.1 is BINARY_OLD (an @ is doubled in a ,v file)
+BINARY_OLD = '\x00\x01@\r\n\xff\rtail'
+BINARY_NEW = '\x00\x01@\r\nnew\r\n\xff\rtail'
+BINARY_FIXTURE = '''head	1.2;
+access;
+symbols;
+locks; strict;
+expand	@b@;
+
+
+1.2
+date	2014.01.02.10.00.00;	author a;	state Exp;
+branches;
+next	1.1;
+
+1.1
+date	2014.01.01.10.00.00;	author a;	state Exp;
+branches;
+next	;
+
+
+desc
+@@
+
+
+1.2
+log
+@second
+@
+text
+@''' + BINARY_NEW.replace('@', '@@') + '''@
+
+
+1.1
+log
+@Initial revision
+@
+text
+@d2 1
+@
+'''
+
+
+class Diff_Test(unittest.TestCase):
+
+    def test_apply_splits_only_at_newline(self):
+        self.assertEqual(native_rcs.apply_diff('a\rb\nc\n', 'd2 1\n'), 'a\rb\n')
+
+    def test_compute_splits_only_at_newline(self):
+        script = native_rcs.compute_diff('x\rz\n', 'x\ry\n')
+        self.assertEqual(script, 'd1 1\na1 1\nx\ry\n')
+        self.assertEqual(native_rcs.apply_diff('x\rz\n', script), 'x\ry\n')
+
+    def test_round_trip(self):
+        texts = ['', 'one\n', 'one\ntwo', 'a\r\nb\r\n', 'x\ry\rz', BINARY_OLD, BINARY_NEW,
+                 '\n\n\n', 'one\ntwo\nthree\n']
+        for newer in texts:
+            for older in texts:
+                script = native_rcs.compute_diff(newer, older)
+                self.assertEqual(native_rcs.apply_diff(newer, script), older)
+
+
+class Native_RCS_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.name = os.path.join(self.directory, 'file')
+        self.rcs = native_rcs.Native_RCS()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # writes a ,v file and a work file (rcslib puts a missing work file
+    # into the current directory)
+    def _fixture(self, content):
+        with open(self.name + ',v', 'wb') as rcs_file:
+            rcs_file.write(content)
+        open(self.name, 'wb').close()
+
+    # the text of a revision (rcslib does not accept a . in a revision)
+    def _checkout(self, rev):
+        return self.rcs._text(self.rcs._read(self.name), rev)
+
+    def _checkin(self, text):
+        self.rcs.checkout(self.name, 'a', True)
+        with open(self.name, 'wb') as work_file:
+            work_file.write(text)
+        self.rcs.checkin(self.name, 'a', 'changed')
+
+    def test_checkout_cr_fixture(self):
+        self._fixture(CR_FIXTURE)
+        self.assertEqual(self._checkout('1.2'), 'a\rb\nc\n')
+        self.assertEqual(self._checkout('1.1'), 'a\rb\n')
+
+    def test_checkout_binary_fixture(self):
+        self._fixture(BINARY_FIXTURE)
+        self.assertEqual(self._checkout('1.2'), BINARY_NEW)
+        self.assertEqual(self._checkout('1.1'), BINARY_OLD)
+
+    def test_checkin_writes_rcs_diffs(self):
+        self._fixture(CR_FIXTURE)
+        self._checkin('a\rB\nc\n')
+        with open(self.name + ',v', 'rb') as rcs_file:
+            rcs = native_rcs.parse_file(rcs_file.read())
+        self.assertEqual(rcs.head, '1.3')
+        # 'a\rb\n' is one line for RCS
+        self.assertEqual(rcs.delta('1.2').text, 'd1 1\na1 1\na\rb\n')
+        self.assertEqual(self._checkout('1.3'), 'a\rB\nc\n')
+        self.assertEqual(self._checkout('1.2'), 'a\rb\nc\n')
+        self.assertEqual(self._checkout('1.1'), 'a\rb\n')
+
+    def test_checkin_binary(self):
+        self._fixture(BINARY_FIXTURE)
+        newest = BINARY_NEW.replace('new', 'newer\r@@')
+        self._checkin(newest)
+        self.assertEqual(self._checkout('1.3'), newest)
+        self.assertEqual(self._checkout('1.2'), BINARY_NEW)
+        self.assertEqual(self._checkout('1.1'), BINARY_OLD)
+
+    def test_outdate_keeps_other_revisions(self):
+        self._fixture(CR_FIXTURE)
+        self._checkin('a\rb\nc\rd\n')
+        self.rcs.outdate(self.name, ['1.2'])
+        with open(self.name + ',v', 'rb') as rcs_file:
+            rcs = native_rcs.parse_file(rcs_file.read())
+        self.assertEqual([entry.rev for entry in rcs.deltas], ['1.3', '1.1'])
+        self.assertEqual(self._checkout('1.3'), 'a\rb\nc\rd\n')
+        self.assertEqual(self._checkout('1.1'), 'a\rb\n')
+
+    def test_lock_only_changes_the_admin_section(self):
+        self._fixture(CR_FIXTURE)
+        with open(self.name, 'wb') as work_file:
+            work_file.write('work')
+        before = os.stat(self.name)
+        self.rcs.lock(self.name, 'b')
+        with open(self.name + ',v', 'rb') as rcs_file:
+            data = rcs_file.read()
+        self.assertEqual(native_rcs.parse_file(data).locker('1.2'), 'b')
+        self.assertEqual(data[data.index('\n1.2\ndate'):],
+                         CR_FIXTURE[CR_FIXTURE.index('\n1.2\ndate'):])
+        after = os.stat(self.name)
+        self.assertEqual((after.st_ino, after.st_mtime), (before.st_ino, before.st_mtime))
+        self.rcs.unlock(self.name, 'b')
+        self.assertEqual(self.rcs._read(self.name, 0).locks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
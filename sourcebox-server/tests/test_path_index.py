@@ -0,0 +1,43 @@
+#
+# tests of the path index: the paths of a file or of a directory
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import unittest
+
+import path_index
+
+
+class Path_Index_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = ['d', os.path.join('d', 'a'), os.path.join('d', 'e', 'b'), 'd!', 'd0', 'dd', 'c']
+        self.index = path_index.Path_Index(self.paths)
+
+    def test_under_directory(self):
+        self.assertEqual(self.index.under('d'),
+                         ['d', os.path.join('d', 'a'), os.path.join('d', 'e', 'b')])
+        self.assertEqual(self.index.under(os.path.join('d', 'e')), [os.path.join('d', 'e', 'b')])
+        self.assertEqual(self.index.under('dd'), ['dd'])
+        self.assertEqual(self.index.under('x'), [])
+
+    def test_under_matches_a_scan(self):
+        for path in self.paths + ['e', os.path.join('d', 'e')]:
+            prefix = path + os.sep
+            scanned = sorted(key for key in self.paths if key == path or key.startswith(prefix))
+            self.assertEqual(self.index.under(path), scanned, path)
+
+    def test_add_and_discard(self):
+        self.index.add('c')
+        self.assertEqual(len(self.index), len(self.paths))
+        self.index.discard(os.path.join('d', 'a'))
+        self.index.discard('x')
+        self.assertFalse(os.path.join('d', 'a') in self.index)
+        self.assertTrue('d' in self.index)
+        self.assertEqual(self.index.under('d'), ['d', os.path.join('d', 'e', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
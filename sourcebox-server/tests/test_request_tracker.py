@@ -0,0 +1,56 @@
+#
+# tests of the request tracker: timeouts start when a request is sent
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import time
+import unittest
+
+import protocol
+
+
+class Request_Tracker_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = protocol.Request_Tracker(4, 0.1)
+        self.done = []
+
+    def _register(self):
+        return self.tracker.register(protocol.OP_MODIFY, 'a', self.done.append)
+
+    def test_request_being_sent_does_not_expire(self):
+        request = self._register()
+        time.sleep(0.2)
+        self.tracker.expire()
+        self.assertEqual(self.done, [])
+        request.sent()
+        self.tracker.expire()
+        self.assertEqual(self.done, [])
+        time.sleep(0.2)
+        self.tracker.expire()
+        self.assertEqual(self.done, [request])
+        self.assertFalse(request.ok)
+        self.assertEqual(request.answer, None)
+
+    def test_answer_is_matched(self):
+        first = self._register()
+        second = self._register()
+        first.sent()
+        second.sent()
+        self.assertIs(self.tracker.complete(protocol.Frame(protocol.OP_NEED, seq=second.seq)), second)
+        self.assertEqual(self.done, [second])
+        self.assertFalse(second.ok)
+        self.assertEqual(second.answer.opcode, protocol.OP_NEED)
+        self.assertEqual(self.tracker.in_flight(), 1)
+
+    def test_own_timeout(self):
+        request = self.tracker.register(protocol.OP_HAVE, 'a', self.done.append, timeout=5)
+        request.sent()
+        time.sleep(0.2)
+        self.tracker.expire()
+        self.assertEqual(self.done, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
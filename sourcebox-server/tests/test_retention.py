@@ -0,0 +1,90 @@
+#
+# tests of the retention: which revisions a policy removes, and the job
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import unittest
+
+import retention
+
+DAY = 86400
+NOW = 100 * DAY + DAY // 2
+
+
+# (revision, time) newest first: two revisions a day on the last five days
+def _revisions():
+    revisions = []
+    for number in range(10, 0, -1):
+        revisions.append(('1.%d' % number, NOW - (10 - number) // 2 * DAY - number % 2 * 60))
+    return revisions
+
+
+class Retention_Policy_Test(unittest.TestCase):
+
+    def test_parse(self):
+        policy = retention.Retention_Policy.parse('3 2 30')
+        self.assertEqual((policy.keep_last, policy.keep_daily, policy.max_age), (3, 2, 30))
+        for value in ('3 2', '3 -2 30', 'a b c'):
+            self.assertRaises(ValueError, retention.Retention_Policy.parse, value)
+
+    def test_zero_keeps_everything(self):
+        self.assertEqual(retention.Retention_Policy().expired(_revisions(), NOW), [])
+
+    def test_keep_last(self):
+        self.assertEqual(retention.Retention_Policy(keep_last=7).expired(_revisions(), NOW),
+                         ['1.3', '1.2', '1.1'])
+
+    def test_keep_daily_keeps_newest_of_each_day(self):
+        self.assertEqual(retention.Retention_Policy(keep_daily=2).expired(_revisions(), NOW),
+                         ['1.9', '1.7', '1.6', '1.5', '1.4', '1.3', '1.2', '1.1'])
+        self.assertEqual(retention.Retention_Policy(keep_last=1, keep_daily=5).expired(
+            _revisions(), NOW), ['1.9', '1.7', '1.5', '1.3', '1.1'])
+
+    def test_max_age_overrides_but_keeps_head(self):
+        policy = retention.Retention_Policy(keep_last=10, max_age=2)
+        self.assertEqual(policy.expired(_revisions(), NOW), ['1.5', '1.4', '1.3', '1.2', '1.1'])
+        self.assertEqual(policy.expired(_revisions(), NOW + 30 * DAY),
+                         [rev for rev, date in _revisions()[1:]])
+
+    def test_first_matching_rule_wins(self):
+        rules = retention.Retention_Rules([('*.log', '1 0 0'), ('*', '0 0 30')])
+        self.assertEqual(rules.policy_for('d/a.log').keep_last, 1)
+        self.assertEqual(rules.policy_for('a.txt').max_age, 30)
+        self.assertEqual(retention.Retention_Rules([('*.log', '1 0 0')]).policy_for('a'), None)
+
+
+class Retention_Job_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = retention.Retention_Rules([('*.tmp', '0 0 0'), ('*', '1 0 0')])
+        self.compacted = []
+        self.idle = 60
+        self.job = retention.Retention_Job(self.rules, lambda: ['a', 'b.tmp', 'c', 'bad'],
+                                           self._compact, lambda: self.idle, 3600, 0)
+
+    def tearDown(self):
+        self.job.close()
+
+    def _compact(self, path, policy):
+        if path == 'bad':
+            raise IOError('corrupt')
+        self.compacted.append(path)
+        return (2, 100, 50) if path == 'a' else (0, 0, 0)
+
+    def test_run_once(self):
+        self.assertEqual(self.job.run_once(), (1, 2, 100))
+        # every file has a rule, the first one just does not remove anything
+        self.assertEqual(self.compacted, ['a', 'b.tmp', 'c'])
+        self.assertEqual(self.job.stats(), {'passes': 1, 'compacted': 1, 'removed': 2,
+                                            'reclaimed': 100, 'failures': 1})
+
+    def test_stopped_job_does_not_wait_for_idle_server(self):
+        self.idle = 0
+        self.job._stop.set()
+        self.assertEqual(self.job.run_once(), (0, 0, 0))
+        self.assertEqual(self.compacted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
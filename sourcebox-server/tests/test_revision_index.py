@@ -0,0 +1,145 @@
+#
+# tests of the revision index: the metadata of the ,v files, and bringing it
+# up to date after a restart
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import revision_index
+
+# a ,v file with two revisions of 'one\n' (1.1) and 'one\ntwo\n' (1.2)
+FIXTURE = '''head	1.2;
+access;
+symbols;
+locks%s; strict;
+comment	@# @;
+
+
+1.2
+date	2014.01.02.10.00.00;	author b;	state Exp;
+branches;
+next	1.1;
+
+1.1
+date	2014.01.01.10.00.00;	author a;	state Exp;
+branches;
+next	;
+
+
+desc
+@@
+
+
+1.2
+log
+@second
+@
+text
+@one
+two
+@
+
+
+1.1
+log
+@Initial revision
+@
+text
+@d2 1
+@
+'''
+
+
+class Revision_Index_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.directory, 'data')
+        os.mkdir(self.data_dir)
+        self.index = self._open()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        return revision_index.Revision_Index(os.path.join(self.directory, 'revisions.db'),
+                                             self.data_dir)
+
+    # writes the ,v file of a path (in RCS/ if rcs_dir)
+    def _write(self, path, locker=None, rcs_dir=False):
+        directory, name = os.path.split(os.path.join(self.data_dir, path))
+        if rcs_dir:
+            directory = os.path.join(directory, 'RCS')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        namev = os.path.join(directory, name + ',v')
+        with open(namev, 'wb') as rcs_file:
+            rcs_file.write(FIXTURE % ('\n\t' + locker + ':1.2' if locker else ''))
+        return namev
+
+    def test_update_reads_the_metadata(self):
+        self.index.update('a', self._write('a', locker='c'))
+        entry = self.index.get('a')
+        self.assertEqual((entry.head, entry.locker, entry.revisions, entry.author),
+                         ('1.2', 'c', 2, 'b'))
+        self.index.update('a', self._write('a'))
+        self.assertEqual(self.index.get('a').locker, None)
+        self.assertEqual(self.index.get('b'), None)
+
+    def test_move_and_remove_directory(self):
+        for path in (os.path.join('d', 'a'), os.path.join('d', 'e', 'b'), 'dd'):
+            self.index.update(path, self._write(path))
+        self.index.move('d', 'f')
+        self.assertEqual([entry.path for entry in self.index.items()],
+                         ['dd', os.path.join('f', 'a'), os.path.join('f', 'e', 'b')])
+        self.index.remove('f')
+        self.assertEqual([entry.path for entry in self.index.items()], ['dd'])
+
+    def test_index_survives_restart(self):
+        self.index.update('a', self._write('a', locker='c'))
+        self.index.close()
+        self.index = self._open()
+        self.assertEqual(self.index.get('a').locker, 'c')
+
+    def test_rebuild_reads_only_changed_files(self):
+        namev = self._write('a')
+        self.index.update('a', namev)
+        self.index.update('gone', self._write('gone'))
+        os.remove(os.path.join(self.data_dir, 'gone,v'))
+        self._write(os.path.join('d', 'b'), rcs_dir=True)
+        self.index.close()
+        # changed while the server was down
+        self._write('a', locker='c')
+        os.utime(namev, (0, 0))
+        self.index = self._open()
+        self.index.rebuild()
+        self.assertEqual([entry.path for entry in self.index.items()],
+                         ['a', os.path.join('d', 'b')])
+        self.assertEqual(self.index.get('a').locker, 'c')
+
+        entry = self.index.get(os.path.join('d', 'b'))
+        self.index.rebuild()
+        self.assertTrue(self.index.get(os.path.join('d', 'b')) is entry)
+
+    def test_rebuild_in_pool(self):
+        found = {}
+        for number in range(revision_index.PARALLEL_THRESHOLD):
+            path = 'f%03d' % number
+            found[path] = self._write(path)
+        found['broken'] = os.path.join(self.data_dir, 'broken,v')
+        with open(found['broken'], 'wb') as rcs_file:
+            rcs_file.write('head 1.1')
+        self.index.rebuild(found, workers=2)
+        self.assertEqual(len(self.index.items()), revision_index.PARALLEL_THRESHOLD)
+        self.assertEqual(self.index.get('f000').revisions, 2)
+        self.assertEqual(self.index.get('broken'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
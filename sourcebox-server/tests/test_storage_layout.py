@@ -0,0 +1,96 @@
+#
+# tests of the storage layout: the map and the migration of the flat layout
+#
+# @encode  UTF-8, tabwidth = 4 , newline = LF
+# @author  Martin
+#
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import storage_layout
+
+
+class Storage_Layout_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.directory, 'data')
+        self.roots = [os.path.join(self.directory, 'one'), os.path.join(self.directory, 'two')]
+        self.layout = self._open()
+
+    def tearDown(self):
+        self.layout.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        return storage_layout.Storage_Layout(self.roots, os.path.join(self.directory, 'locations.db'))
+
+    def _write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as data_file:
+            data_file.write(content)
+
+    def _read(self, path):
+        with open(path, 'rb') as data_file:
+            return data_file.read()
+
+    def test_place_records_parents(self):
+        location = self.layout.place(os.path.join('d', 'e', 'a'))
+        self.assertTrue(any(location.startswith(root) for root in self.roots))
+        self.assertTrue(os.path.isdir(os.path.dirname(location)))
+        self.assertTrue(self.layout.is_dir('d'))
+        self.assertTrue(self.layout.is_dir(os.path.join('d', 'e')))
+        self.assertEqual(self.layout.place(os.path.join('d', 'e', 'a')), location)
+
+    def test_move_directory_replaces_target(self):
+        moved = self.layout.place(os.path.join('d', 'a'))
+        replaced = self.layout.place(os.path.join('e', 'a'))
+        self.assertEqual(self.layout.move('d', 'e'), [replaced])
+        self.assertEqual(self.layout.locate(os.path.join('e', 'a')), moved)
+        self.assertEqual(self.layout.locate(os.path.join('d', 'a')), None)
+        self.assertEqual(self.layout.remove('e'), [moved])
+        self.assertEqual(self.layout.walk(), [])
+
+    def test_map_survives_restart(self):
+        location = self.layout.place('a')
+        self.layout.add_dir('d')
+        self.layout.close()
+        self.layout = self._open()
+        self.assertEqual(self.layout.locate('a'), location)
+        self.assertTrue(self.layout.is_dir('d'))
+
+    def test_adopt_and_migrate(self):
+        self._write(os.path.join(self.data_dir, 'a'), 'a')
+        self._write(os.path.join(self.data_dir, 'a,v'), 'a,v')
+        self._write(os.path.join(self.data_dir, 'd', 'b'), 'b')
+        self._write(os.path.join(self.data_dir, 'd', 'RCS', 'b,v'), 'b,v')
+        self.assertEqual(self.layout.adopt(self.data_dir), 3)
+        self.assertEqual(self.layout.locate('a'), os.path.join(self.data_dir, 'a'))
+        # only an empty map adopts
+        self.assertEqual(self.layout.adopt(self.data_dir), 0)
+
+        self.assertEqual(self.layout.migrate(self.data_dir, threading.RLock()), 2)
+        self.assertFalse(os.path.exists(self.data_dir))
+        for path, content in (('a', 'a'), (os.path.join('d', 'b'), 'b')):
+            location = self.layout.locate(path)
+            self.assertTrue(any(location.startswith(root) for root in self.roots))
+            self.assertEqual(self._read(location), content)
+            self.assertEqual(self._read(location + ',v'), content + ',v')
+        self.assertTrue(self.layout.is_dir('d'))
+
+    def test_migration_stops(self):
+        self._write(os.path.join(self.data_dir, 'a'), 'a')
+        self.layout.adopt(self.data_dir)
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(self.layout.migrate(self.data_dir, threading.RLock(), stop=stop), 0)
+        self.assertEqual(self.layout.locate('a'), os.path.join(self.data_dir, 'a'))
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, 'a')))
+
+
+if __name__ == '__main__':
+    unittest.main()